@@ -25,6 +25,21 @@ log.addHandler(handler)
 from maas_deployer.vmaas.engine import DeploymentEngine
 from maas_deployer.vmaas.util import CONF as cfg
 
+COMMAND_BAKE = 'bake'
+
+
+def get_command(args, config):
+    """
+    Returns the (command, target) given by the positional arguments. The
+    command is None unless the first argument is 'bake' (and it is not also
+    the only argument and the name of a target).
+    """
+    if (args and args[0] == COMMAND_BAKE and
+            (len(args) > 1 or COMMAND_BAKE not in config)):
+        return (COMMAND_BAKE, args[1] if len(args) > 1 else None)
+
+    return (None, args[0] if args else None)
+
 
 def main():
     cfg.parser.add_argument('-c', '--config', type=str,
@@ -55,8 +70,23 @@ def main():
                                  'qemu+ssh://user@somehypervisor/system. The '
                                  'default value is the local system at '
                                  'qemu:///system')
-    cfg.parser.add_argument('target', metavar='target', type=str, nargs='?',
-                            help='Target environment to run')
+    cfg.parser.add_argument('--fetch-on-hypervisor', action='store_true',
+                            default=False,
+                            help='When the hypervisor is reached over ssh '
+                                 '(e.g. qemu+ssh://user@host/system), have '
+                                 'the hypervisor host download the cloud '
+                                 'image and verify its checksum itself, '
+                                 'caching it in ~/.cache/maas-deployer on '
+                                 'the host, rather than downloading it here '
+                                 'and uploading it to the host.')
+    cfg.parser.add_argument('args', metavar='[bake] target', type=str,
+                            nargs='*',
+                            help='Target environment to run. With bake, '
+                                 'builds the pre-installed MAAS base image '
+                                 'for the target ({release}-{arch}-maas-base '
+                                 'in its pool), which is then used for the '
+                                 'MAAS vm of any target with the same '
+                                 'release and arch.')
     cfg.parse_args()
 
     # File logger is always DEBUG but stdout is default INFO.
@@ -74,7 +104,10 @@ def main():
     with open(cfg.config, 'r') as fd:
         config = yaml.safe_load(fd)
 
-    target = cfg.target
+    if len(cfg.args) > 2:
+        cfg.parser.error("unexpected arguments: %s" % ' '.join(cfg.args[2:]))
+
+    command, target = get_command(cfg.args, config)
 
     if target is None and len(config.keys()) == 1:
         target = config.keys()[0]
@@ -85,14 +118,20 @@ def main():
 
     try:
         engine = DeploymentEngine(config, target)
-        engine.deploy(target)
+        if command == COMMAND_BAKE:
+            engine.bake(target)
+        else:
+            engine.deploy(target)
     except:
         # Remove console handler to avoid displaying the exception twice
         log.removeHandler(handler)
         log.exception("MAAS deployment failed.")
         raise
     else:
-        log.info("MAAS deployment completed.")
+        if command == COMMAND_BAKE:
+            log.info("MAAS base image baked.")
+        else:
+            log.info("MAAS deployment completed.")
 
 
 if __name__ == '__main__':
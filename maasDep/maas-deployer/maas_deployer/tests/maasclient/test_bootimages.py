@@ -6,6 +6,7 @@
 import unittest
 
 from maas_deployer.vmaas.maasclient import bootimages
+from mock import MagicMock
 
 
 class TestBootImages(unittest.TestCase):
@@ -14,3 +15,117 @@ class TestBootImages(unittest.TestCase):
         sequence = bootimages.sequence_no(1)
         for i in xrange(500, 1000000):
             sequence.next()
+
+
+def _resource(name, size, progress=0, complete=False):
+    return {'name': 'ubuntu/%s' % (name), 'architecture': 'amd64/generic',
+            'sets': {'20160101': {'size': size, 'complete': complete,
+                                  'progress': progress}}}
+
+
+def _image(release, purpose='commissioning'):
+    return {'osystem': 'ubuntu', 'release': release,
+            'architecture': 'amd64', 'subarchitecture': 'generic',
+            'label': 'release', 'purpose': purpose}
+
+
+class TestBootResourceMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.client = MagicMock()
+        self.client.get_boot_resources.return_value = [
+            {'id': 1, 'type': 'Synced'}, {'id': 2, 'type': 'Synced'},
+            {'id': 3, 'type': 'Uploaded'}]
+        self.client.is_importing_boot_resources.return_value = True
+        self.client.get_nodegroups.return_value = ['ng']
+        self.client.get_boot_images.return_value = [
+            _image('trusty'), _image('xenial')]
+        self.details = {1: _resource('trusty', 100 << 20),
+                        2: _resource('xenial', 100 << 20)}
+        self.client.get_boot_resource.side_effect = self.details.get
+        self.monitor = bootimages.BootResourceMonitor(
+            self.client, stall_timeout=300, clock=lambda: self.now)
+
+    def test_progress(self):
+        self.assertFalse(self.monitor.poll())
+        self.assertEqual(self.monitor.done, 0)
+        self.assertIsNone(self.monitor.eta)
+
+        self.now += 10
+        self.details[1] = _resource('trusty', 100 << 20, complete=True)
+        self.details[2] = _resource('xenial', 100 << 20, progress=50)
+        self.assertFalse(self.monitor.poll())
+        self.assertEqual(self.monitor.done, 150 << 20)
+        self.assertEqual(self.monitor.rate, 15 << 20)
+        self.assertAlmostEqual(self.monitor.eta, 50 / 15.0)
+        self.assertEqual([str(r) for r in self.monitor.pending],
+                         ['ubuntu/xenial/amd64/generic'])
+        self.assertIn('75% of 200.0 MiB, 1 of 2 resources, 15.0 MiB/s',
+                      self.monitor.format_status())
+
+        # Complete resources are not read again
+        self.client.get_boot_resource.reset_mock()
+        self.monitor.poll()
+        self.assertEqual(
+            [c[0][0] for c in self.client.get_boot_resource.call_args_list],
+            [2])
+
+        # The import is complete once the clusters have the images
+        self.details[2] = _resource('xenial', 100 << 20, complete=True)
+        self.client.is_importing_boot_resources.return_value = False
+        self.client.get_boot_images.return_value = []
+        self.assertFalse(self.monitor.poll())
+        self.client.get_boot_images.return_value = [
+            _image('trusty'), _image('xenial')]
+        self.assertTrue(self.monitor.poll())
+
+    def test_stalled(self):
+        self.details[2] = _resource('xenial', 100 << 20, progress=10)
+        self.monitor.poll()
+        self.now += 200
+        self.monitor.poll()
+        self.assertFalse(self.monitor.stalled)
+        self.now += 200
+        self.monitor.poll()
+        self.assertTrue(self.monitor.stalled)
+        self.monitor.reset_stall()
+        self.assertFalse(self.monitor.stalled)
+
+        self.details[2] = _resource('xenial', 100 << 20, progress=20)
+        self.now += 400
+        self.monitor.poll()
+        self.assertFalse(self.monitor.stalled)
+
+    def test_not_started(self):
+        # Resources already imported only count as complete once the
+        # import has been seen running or after start_timeout.
+        for i in self.details:
+            self.details[i]['sets']['20160101']['complete'] = True
+        self.client.is_importing_boot_resources.return_value = False
+        self.assertFalse(self.monitor.poll())
+        self.now += bootimages.IMPORT_START_TIMEOUT + 1
+        self.assertTrue(self.monitor.poll())
+
+        # No resources yet
+        self.client.get_boot_resources.return_value = []
+        monitor = bootimages.BootResourceMonitor(self.client,
+                                                 clock=lambda: self.now)
+        self.assertFalse(monitor.poll())
+
+    def test_clusters_partly_synced(self):
+        # Clusters with the images of an earlier import, e.g. of the first
+        # stage of a staged import, are not synced until they have those of
+        # every resource.
+        for i in self.details:
+            self.details[i]['sets']['20160101']['complete'] = True
+        self.client.is_importing_boot_resources.return_value = False
+        self.client.get_boot_images.return_value = [
+            _image('xenial'), _image('xenial', purpose='install')]
+        self.now += bootimages.IMPORT_START_TIMEOUT + 1
+        self.assertFalse(self.monitor.poll())
+        self.assertIn('syncing clusters', self.monitor.format_status())
+
+        self.client.get_boot_images.return_value = [
+            _image('xenial'), _image('trusty')]
+        self.assertTrue(self.monitor.poll())
@@ -0,0 +1,133 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# Unit tests for cloud-init progress parsing
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch, MagicMock
+
+from maas_deployer.vmaas import cloudinit
+
+
+CLOUDINIT_OUTPUT = """
+Cloud-init v. 0.7.5 running 'init' at Mon, 11 May 2015 10:00:00 +0000.
+Get:1 http://archive.ubuntu.com trusty InRelease [65.9 kB]
+Hit http://ppa.launchpad.net trusty/main amd64 Packages
+Fetched 20.1 MB in 10s (2,010 kB/s)
+Get:1 http://archive.ubuntu.com/ubuntu/ trusty/main jq amd64 1.3-1 [82 kB]
+Get:2 http://ppa.lp.net/maas trusty/main maas-region-controller all 1.9 [9 kB]
+Fetched 90.2 MB in 30s (3,006 kB/s)
+Unpacking jq (1.3-1) ...
+Unpacking maas-region-controller (1.9.0) ...
+Setting up jq (1.3-1) ...
+Setting up maas-region-controller (1.9.0) ...
++ sudo maas-region-admin createadmin --username=ubuntu --password=ubuntu
++ apikey=abc:def:ghi
++ echo 'Configuring MAAS as a gateway'
+Configuring MAAS as a gateway
+MAAS controller is now configured.
+"""
+
+
+class TestCloudInitProgress(unittest.TestCase):
+
+    @patch.object(cloudinit, 'log', MagicMock())
+    def test_feed(self):
+        clock = iter(xrange(1000)).next
+        progress = cloudinit.CloudInitProgress(clock=clock)
+        for line in CLOUDINIT_OUTPUT.splitlines():
+            progress.feed(line)
+
+        self.assertTrue(progress.finished)
+        self.assertEqual(progress.api_key, 'abc:def:ghi')
+        self.assertEqual(progress.downloaded, 2)
+        self.assertEqual(progress.unpacked, 2)
+        self.assertEqual(progress.setup, 2)
+        self.assertEqual(progress.durations().keys(),
+                         [cloudinit.STAGE_BOOT,
+                          cloudinit.STAGE_APT_UPDATE,
+                          cloudinit.STAGE_DOWNLOAD,
+                          cloudinit.STAGE_UNPACK,
+                          cloudinit.STAGE_SETUP,
+                          cloudinit.STAGE_CONFIG_MAAS])
+        items = [i for i, _ in progress.items]
+        self.assertIn(('download', 'maas-region-controller'), items)
+        self.assertIn(('setup', 'maas-region-controller'), items)
+        self.assertIn(('config-maas', 'maas-region-admin createadmin'),
+                      items)
+        self.assertEqual(progress.status, 'done')
+
+    def test_not_finished(self):
+        progress = cloudinit.CloudInitProgress()
+        self.assertFalse(progress.feed('Unpacking jq (1.3-1) ...'))
+        self.assertTrue(progress.status.startswith('unpack jq (1/0)'))
+
+    def test_golden_image_ready(self):
+        progress = cloudinit.CloudInitProgress()
+        progress.feed('Setting up jq (1.3-1) ...')
+        self.assertFalse(progress.golden_image_ready)
+        progress.feed(cloudinit.GOLDEN_IMAGE_READY_MESSAGE)
+        self.assertTrue(progress.golden_image_ready)
+        self.assertFalse(progress.finished)
+
+    def test_start_message(self):
+        # A clone of a golden image starts with the output of the run the
+        # image was captured from, which is replayed before its own.
+        clock = iter(xrange(1000)).next
+        start = '%s maas-golden-1' % (cloudinit.CLONE_START_MESSAGE)
+        progress = cloudinit.CloudInitProgress(clock=clock,
+                                               start_message=start)
+        stale = CLOUDINIT_OUTPUT.split('+ sudo maas-region-admin')[0]
+        for line in stale.splitlines():
+            progress.feed(line)
+        progress.feed(cloudinit.GOLDEN_IMAGE_READY_MESSAGE)
+        self.assertFalse(progress.golden_image_ready)
+        self.assertEqual(progress.downloaded, 0)
+        self.assertEqual(progress.stage, None)
+
+        progress.feed(start)
+        for line in CLOUDINIT_OUTPUT.splitlines()[-5:]:
+            progress.feed(line)
+
+        self.assertTrue(progress.finished)
+        self.assertFalse(progress.golden_image_ready)
+        self.assertEqual(progress.unpacked, 0)
+        self.assertEqual(progress.durations().keys(),
+                         [cloudinit.STAGE_BOOT, cloudinit.STAGE_CONFIG_MAAS])
+
+
+class TestTimings(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache', 'timings.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @patch.object(cloudinit, 'log')
+    def test_record_timings(self, mock_log):
+        total = cloudinit.record_timings('default', {'setup': 500.0,
+                                                     'boot': 100.0},
+                                         path=self.path)
+        self.assertEqual(total, 600.0)
+        self.assertEqual(mock_log.info.call_count, 1)
+
+        total = cloudinit.record_timings('fast', {'setup': 200.0,
+                                                  'boot': 100.0},
+                                         path=self.path)
+        self.assertEqual(total, 300.0)
+        mock_log.info.assert_called_with(
+            "  last run with the '%s' profile took %.1fs (%+.1fs, %+.0f%%)",
+            'default', 600.0, -300.0, -50.0)
+        with open(self.path) as fd:
+            history = json.load(fd)
+
+        self.assertEqual(sorted(history), ['default', 'fast'])
+        self.assertEqual(history['fast']['stages'], {'setup': 200.0,
+                                                     'boot': 100.0})
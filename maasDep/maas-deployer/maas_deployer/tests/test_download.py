@@ -0,0 +1,240 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+
+import BaseHTTPServer
+import hashlib
+import os
+import shutil
+import SimpleHTTPServer
+import StringIO
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from maas_deployer.vmaas import (
+    download,
+    exception,
+)
+from mock import patch, MagicMock
+
+IMAGE_URL = ('https://cloud-images.ubuntu.com/trusty/current/'
+             'trusty-server-cloudimg-amd64-disk1.img')
+SHA256SUMS = """\
+0c7b2a4e5fbb2e1b1e6e0e3d1f7c0b2c1a3d8f2e5b4c7a6d9e8f1a2b3c4d5e6f *trusty-server-cloudimg-amd64-disk1.img
+5d1c2a4e5fbb2e1b1e6e0e3d1f7c0b2c1a3d8f2e5b4c7a6d9e8f1a2b3c4d5e6f *trusty-server-cloudimg-i386-disk1.img
+"""  # noqa
+
+
+class RangeRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serves files from the server's directory with Range support."""
+
+    def translate_path(self, path):
+        return os.path.join(self.server.directory, path.lstrip('/'))
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.headers.getheader('Range'))
+        range_hdr = self.headers.getheader('Range')
+        if not self.server.ranges or not range_hdr:
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+        with open(self.translate_path(self.path), 'rb') as fd:
+            content = fd.read()
+
+        start, end = [int(i) for i in range_hdr.split('=')[1].split('-')]
+        end = min(end, len(content) - 1)
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                         (start, end, len(content)))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(content[start:end + 1])
+
+
+class TestDownload(unittest.TestCase):
+
+    @patch.object(download, 'log', MagicMock())
+    @patch.object(download.urllib2, 'urlopen')
+    def test_get_checksum(self, mock_urlopen):
+        mock_urlopen.return_value = StringIO.StringIO(SHA256SUMS)
+        self.assertEqual(download.get_checksum(IMAGE_URL),
+                         '0c7b2a4e5fbb2e1b1e6e0e3d1f7c0b2c'
+                         '1a3d8f2e5b4c7a6d9e8f1a2b3c4d5e6f')
+        mock_urlopen.assert_called_once_with(
+            'https://cloud-images.ubuntu.com/trusty/current/SHA256SUMS',
+            timeout=30)
+
+        mock_urlopen.return_value = StringIO.StringIO(SHA256SUMS)
+        self.assertIsNone(download.get_checksum(IMAGE_URL + '.xz'))
+
+    def test_hypervisor_uri(self):
+        uri = 'qemu+ssh://ubuntu@10.0.0.1:2222/system?keyfile=/tmp/id_rsa'
+        self.assertTrue(download.is_ssh_uri(uri))
+        self.assertFalse(download.is_ssh_uri('qemu:///system'))
+        self.assertEqual(download.get_hypervisor_ssh_cmd(uri),
+                         ['ssh', '-o', 'BatchMode=yes', '-p', '2222',
+                          '-i', '/tmp/id_rsa', 'ubuntu@10.0.0.1'])
+        self.assertEqual(download.get_hypervisor_local_uri(uri),
+                         'qemu:///system')
+
+    @patch.object(download, 'log', MagicMock())
+    @patch.object(download, 'execc')
+    def test_fetch_on_hypervisor(self, mock_execc):
+        download.fetch_on_hypervisor('qemu+ssh://10.0.0.1/system', IMAGE_URL,
+                                     'default', 'trusty-amd64-base',
+                                     sha256='abcd')
+        cmd = mock_execc.call_args[0][0]
+        self.assertEqual(cmd, ['ssh', '-o', 'BatchMode=yes', '10.0.0.1',
+                               'sh', '-s'])
+        script = mock_execc.call_args[1]['stdin']
+        self.assertIn('wget -q -c -O "$part" "%s"' % (IMAGE_URL), script)
+        self.assertIn('echo "abcd  $1" | sha256sum -c', script)
+        self.assertIn('virsh -c "qemu:///system" vol-upload --pool "default" '
+                      '--vol "trusty-amd64-base"', script)
+        self.assertIn('qemu-img info --output=json "$image"', script)
+        self.assertIn('vol-create-as --pool "default" --name '
+                      '"trusty-amd64-base" \\\n    --capacity "$capacity" '
+                      '--format "$format"', script)
+
+    def test_fetch_script_interrupted(self):
+        # An interrupted download is never left in the cache to be used by
+        # later deployments.
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        bindir = os.path.join(tmpdir, 'bin')
+        os.mkdir(bindir)
+        for name, content in [('wget', 'echo partial > "$4"; exit 4'),
+                              ('virsh', 'exit 0'),
+                              ('qemu-img', 'exit 1')]:
+            path = os.path.join(bindir, name)
+            with open(path, 'w') as fd:
+                fd.write('#!/bin/sh\n%s\n' % (content))
+            os.chmod(path, 0755)
+
+        script = download.template.load('fetch-image.sh', {
+            'url': IMAGE_URL, 'filename': 'disk1.img', 'sha256': None,
+            'uri': 'qemu:///system', 'pool': 'default', 'name': 'base'})
+        env = dict(os.environ, HOME=tmpdir,
+                   PATH='%s:%s' % (bindir, os.environ['PATH']))
+        proc = subprocess.Popen(['sh', '-s'], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, env=env)
+        _, err = proc.communicate(script)
+        self.assertNotEqual(proc.returncode, 0)
+        self.assertEqual(err, 'Unable to fetch %s\n' % (IMAGE_URL))
+        cache = os.path.join(tmpdir, '.cache', 'maas-deployer')
+        self.assertEqual(os.listdir(cache), [])
+
+        # A complete one is moved into place
+        with open(os.path.join(bindir, 'wget'), 'w') as fd:
+            fd.write('#!/bin/sh\necho image > "$4"\n')
+        proc = subprocess.Popen(['sh', '-s'], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, env=env)
+        proc.communicate(script)
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual(os.listdir(cache), ['disk1.img'])
+
+
+class TestDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.content = os.urandom(100000)
+        with open(os.path.join(self.tmpdir, 'disk1.img'), 'wb') as fd:
+            fd.write(self.content)
+
+        self.sha256 = hashlib.sha256(self.content).hexdigest()
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                RangeRequestHandler)
+        self.server.directory = self.tmpdir
+        self.server.ranges = True
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/disk1.img' % (self.server.server_port)
+        self.dest = os.path.join(self.tmpdir, 'downloaded.img')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def _read_dest(self):
+        with open(self.dest, 'rb') as fd:
+            return fd.read()
+
+    @patch.object(download, 'log', MagicMock())
+    @patch.object(download, 'sys', MagicMock())
+    def test_parallel_ranges(self):
+        # The first url is not reachable and is skipped
+        urls = ['http://127.0.0.1:1/disk1.img', self.url]
+        downloader = download.Downloader(urls, self.dest,
+                                         sha256=self.sha256, connections=3,
+                                         chunk_size=16384, retries=1)
+        downloader.run()
+        self.assertEqual(self._read_dest(), self.content)
+        self.assertFalse(os.path.exists(downloader.part))
+        self.assertFalse(os.path.exists(downloader.state_file))
+        # One probe plus one request for each of the 7 chunks
+        self.assertEqual(len(self.server.requests), 8)
+
+    @patch.object(download, 'log', MagicMock())
+    @patch.object(download, 'sys', MagicMock())
+    def test_resume(self):
+        downloader = download.Downloader(self.url, self.dest,
+                                         sha256=self.sha256,
+                                         chunk_size=16384)
+        with open(downloader.part, 'wb') as fd:
+            fd.write(self.content[:32768])
+            fd.truncate(len(self.content))
+
+        downloader._save_state(len(self.content), set([0, 1]))
+        downloader.run()
+        self.assertEqual(self._read_dest(), self.content)
+        self.assertNotIn('bytes=0-16383', self.server.requests)
+        self.assertIn('bytes=32768-49151', self.server.requests)
+
+    @patch.object(download, 'log', MagicMock())
+    @patch.object(download, 'sys', MagicMock())
+    def test_no_range_support(self):
+        self.server.ranges = False
+        downloader = download.Downloader(self.url, self.dest,
+                                         sha256=self.sha256,
+                                         chunk_size=16384)
+        downloader.run()
+        self.assertEqual(self._read_dest(), self.content)
+
+    @patch.object(download, 'log', MagicMock())
+    @patch.object(download, 'sys', MagicMock())
+    def test_checksum_mismatch(self):
+        downloader = download.Downloader(self.url, self.dest, sha256='0')
+        self.assertRaises(exception.MAASDeployerDownloadError,
+                          downloader.run)
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertFalse(os.path.exists(downloader.part))
+
+    def test_rate_limiter(self):
+        now = [0.0]
+        slept = []
+        limiter = download.RateLimiter(1 << 20, clock=lambda: now[0],
+                                       sleep=slept.append)
+        # The bucket starts full
+        limiter.consume(1 << 20)
+        self.assertEqual(slept, [])
+        limiter.consume(512 << 10)
+        self.assertEqual(slept, [0.5])
+        now[0] = 10.0
+        limiter.consume(1 << 20)
+        self.assertEqual(len(slept), 1)
+
+    def test_parse_rate(self):
+        self.assertEqual(download.parse_rate('10M'), 10 << 20)
+        self.assertEqual(download.parse_rate('512k'), 512 << 10)
+        self.assertEqual(download.parse_rate(1000), 1000)
+        self.assertIsNone(download.parse_rate(None))
@@ -3,8 +3,12 @@
 #
 # Unit tests for util functions
 
-import unittest
+import itertools
+import os
+import shutil
 import sys
+import tempfile
+import unittest
 
 from mock import (
     call,
@@ -131,3 +135,587 @@ class TestEngine(unittest.TestCase):
                        {"url": "http://myarchive/images/ephemeral/daily/"}}
         e = engine.DeploymentEngine({}, 'test-env')
         e.configure_boot_source(mock_client, maas_config)
+
+    @patch('time.sleep', lambda arg: None)
+    @patch.object(engine.vm, 'wait_for_domain_running')
+    @patch.object(engine.util, 'execc')
+    @patch.object(engine.util, 'is_port_open')
+    def test_wait_for_vm_ready(self, mock_is_port_open, mock_execc,
+                               mock_wait_for_domain_running):
+        mock_is_port_open.side_effect = [False, False, True]
+        e = engine.DeploymentEngine({}, 'test-env')
+        e.wait_for_vm_ready('ubuntu', '10.0.0.2', domain='maas')
+        self.assertEqual(mock_wait_for_domain_running.call_count, 1)
+        domain, timeout = mock_wait_for_domain_running.call_args[0]
+        self.assertEqual(domain, 'maas')
+        self.assertTrue(0 <= timeout <= engine.VM_READY_TIMEOUT)
+        # ssh is only attempted once the port is open
+        self.assertEqual(mock_execc.call_count, 1)
+        # Both are timed without a console
+        self.assertIsNone(e.maas_console)
+        self.assertIn('time_to_boot', e.timings)
+        self.assertIn('time_to_sshd', e.timings)
+
+    @patch('time.sleep', lambda arg: None)
+    @patch.object(engine.util, 'execc')
+    @patch.object(engine.util, 'is_port_open')
+    def test_wait_for_vm_ready_timeout(self, mock_is_port_open, mock_execc):
+        mock_is_port_open.return_value = False
+        e = engine.DeploymentEngine({}, 'test-env')
+        self.assertRaises(exception.MAASDeployerTimeout, e.wait_for_vm_ready,
+                          'ubuntu', '10.0.0.2', timeout=0)
+        self.assertFalse(mock_execc.called)
+
+    @patch('time.sleep', lambda arg: None)
+    @patch.object(engine.vm, 'wait_for_domain_running')
+    @patch.object(engine.util, 'execc')
+    @patch.object(engine.util, 'is_port_open')
+    @patch.object(engine.time, 'time')
+    def test_wait_for_vm_ready_remaining_time(self, mock_time,
+                                              mock_is_port_open, mock_execc,
+                                              mock_wait_for_domain_running):
+        mock_time.side_effect = itertools.chain([100],
+                                                itertools.repeat(130))
+        mock_is_port_open.return_value = True
+        e = engine.DeploymentEngine({}, 'test-env')
+        e.maas_vm_created = 70
+        e.wait_for_vm_ready('ubuntu', '10.0.0.2', domain='maas', timeout=60)
+        # Time spent before the domain is waited on counts against it
+        mock_wait_for_domain_running.assert_called_once_with('maas', 30)
+        self.assertEqual(e.timings['time_to_boot'], 60)
+        self.assertEqual(e.timings['time_to_sshd'], 60)
+
+    @patch('time.sleep', lambda arg: None)
+    @patch('sys.stdout', MagicMock())
+    @patch.object(engine.cloudinit, 'record_timings')
+    @patch.object(engine.util, 'stream_lines')
+    def test_wait_for_cloudinit_finished_retry(self, mock_stream_lines,
+                                               mock_record_timings):
+        def _stream(lines, error=False):
+            for line in lines:
+                yield line
+
+            if error:
+                raise engine.CalledProcessError(255, 'ssh')
+
+        mock_stream_lines.side_effect = [
+            _stream(['Setting up jq (1.3-1)\n', '+ apikey=foo\n'],
+                    error=True),
+            _stream(['+ maas-region-admin createadmin\n',
+                     engine.cloudinit.FINAL_MESSAGE + '\n']),
+        ]
+        e = engine.DeploymentEngine({}, 'test-env')
+        e.wait_for_cloudinit_finished({'user': 'ubuntu'}, '10.0.0.2')
+        commands = [c[0][0] for c in mock_stream_lines.call_args_list]
+        self.assertIn('+1', commands[0])
+        # The log is resumed after the lines already seen
+        self.assertIn('+3', commands[1])
+        self.assertEqual(e.cloudinit_lines_seen, 4)
+        self.assertEqual(e.api_key, 'foo')
+        self.assertTrue(mock_record_timings.called)
+
+    @patch('sys.stdout', MagicMock())
+    @patch.object(engine.cloudinit, 'record_timings')
+    @patch.object(engine.util, 'stream_lines')
+    def test_wait_for_cloudinit_finished_console(self, mock_stream_lines,
+                                                 mock_record_timings):
+        e = engine.DeploymentEngine({}, 'test-env')
+        e.api_key = 'foo'
+        e.maas_console = MagicMock()
+        e.maas_console.seen = {}
+
+        def _stream():
+            yield '+ apikey=foo\n'
+            # The final message shows on the console but not in the log
+            e.maas_console.seen[engine.console.MARKER_FINAL_MESSAGE] = 1
+            while True:
+                yield None
+
+        mock_stream_lines.return_value = _stream()
+        e.wait_for_cloudinit_finished({'user': 'ubuntu'}, '10.0.0.2')
+        self.assertEqual(mock_stream_lines.call_args[1],
+                         {'idle_timeout': engine.CONSOLE_CHECK_INTERVAL})
+        self.assertEqual(e.cloudinit_lines_seen, 1)
+
+    @patch('sys.stdout', MagicMock())
+    @patch.object(engine.cloudinit, 'record_timings')
+    @patch.object(engine.util, 'stream_lines')
+    @patch.object(engine.DeploymentEngine, 'capture_golden_image')
+    def test_wait_for_cloudinit_finished_clone(self, mock_capture,
+                                               mock_stream_lines,
+                                               mock_record_timings):
+        # The log of a clone of a golden image starts with the output of the
+        # run the image was captured from.
+        e = engine.DeploymentEngine({}, 'test-env')
+        e.maas_node = MagicMock()
+        e.maas_node.installed_image = 'trusty-amd64-maas-golden-1'
+        e.maas_node.instance_id = 'maas-golden-1'
+        mock_stream_lines.return_value = (line for line in [
+            'Setting up maas-region-controller (1.9.0) ...\n',
+            engine.cloudinit.GOLDEN_IMAGE_READY_MESSAGE + '\n',
+            '%s maas-golden-1\n' % (engine.cloudinit.CLONE_START_MESSAGE),
+            '+ apikey=foo\n',
+            engine.cloudinit.FINAL_MESSAGE + '\n',
+        ])
+        e.wait_for_cloudinit_finished({'user': 'ubuntu'}, '10.0.0.2')
+        self.assertFalse(mock_capture.called)
+        self.assertEqual(e.api_key, 'foo')
+        self.assertNotIn(engine.cloudinit.STAGE_SETUP,
+                         mock_record_timings.call_args[0][1])
+
+    @patch.object(engine.time, 'time')
+    def test_wait_for_console_boot(self, mock_time):
+        mock_time.return_value = 100
+        e = engine.DeploymentEngine({}, 'test-env')
+        e.maas_console = MagicMock()
+
+        def _wait_for(marker, timeout):
+            mock_time.return_value += 10
+            return mock_time.return_value
+
+        e.maas_console.wait_for.side_effect = _wait_for
+        self.assertTrue(e._wait_for_console_boot(80, 120))
+        self.assertEqual(e.maas_console.wait_for.call_args_list, [
+            call(engine.console.MARKER_KERNEL,
+                 engine.CONSOLE_KERNEL_TIMEOUT),
+            call(engine.console.MARKER_CLOUDINIT, 110)])
+        self.assertEqual(e.timings, {'time_to_kernel': 30,
+                                     'time_to_cloudinit': 40})
+
+    @patch.object(engine.vm, 'wait_for_ip_address')
+    def test_get_maas_ip_address(self, mock_wait_for_ip_address):
+        e = engine.DeploymentEngine({}, 'test-env')
+        maas_config = {'name': 'maas', 'ip_address': '10.0.0.2'}
+        self.assertEqual(e._get_maas_ip_address(maas_config), '10.0.0.2')
+
+        maas_config = {'name': 'maas',
+                       'network_config': 'auto eth0\n'
+                                         'iface eth0 inet static\n'
+                                         '  address 10.0.0.3\n'}
+        self.assertEqual(e._get_maas_ip_address(maas_config), '10.0.0.3')
+        self.assertEqual(maas_config['ip_address'], '10.0.0.3')
+
+        mock_wait_for_ip_address.return_value = '10.0.0.4'
+        maas_config = {'name': 'maas'}
+        self.assertEqual(e._get_maas_ip_address(maas_config), '10.0.0.4')
+        mock_wait_for_ip_address.assert_called_once_with(
+            'maas', engine.IP_DISCOVERY_TIMEOUT)
+
+    @patch.object(engine.sys, 'stdin')
+    @patch.object(engine.vm, 'wait_for_ip_address')
+    def test_get_maas_ip_address_unattended(self, mock_wait_for_ip_address,
+                                            mock_stdin):
+        mock_stdin.isatty.return_value = False
+        mock_wait_for_ip_address.side_effect = \
+            exception.MAASDeployerTimeout('timeout')
+        e = engine.DeploymentEngine({}, 'test-env')
+        self.assertRaises(exception.MAASDeployerTimeout,
+                          e._get_maas_ip_address, {'name': 'maas'})
+
+    @patch.object(engine.vm, 'get_domain_macs', lambda: {})
+    @patch.object(engine.util, 'CONF')
+    def test_get_node_params(self, mock_cfg):
+        e = engine.DeploymentEngine({}, 'test-env')
+        node_config = {'name': 'node1', 'tags': 'compute',
+                       'interfaces': ['bridge=virbr0,model=virtio']}
+        maas_config = {'virsh': {'uri': 'qemu+ssh://ubuntu@10.0.0.1/system'}}
+        node = e._get_node_params(node_config, maas_config)
+        self.assertEqual(node['mac_addresses'],
+                         [engine.util.generate_mac('test-env', 'node1', 0)])
+        self.assertEqual(node['power_parameters_power_id'], 'node1')
+        self.assertEqual(node['tags'], 'compute')
+
+    @patch.object(engine.vm, 'get_domain_macs')
+    def test_get_macs(self, mock_get_domain_macs):
+        mac = engine.util.generate_mac('test-env', 'node2', 0)
+        mock_get_domain_macs.return_value = {mac: 'other-env-node'}
+        e = engine.DeploymentEngine({}, 'test-env')
+        params = {'name': 'node1', 'interfaces': ['bridge=virbr0']}
+        macs = e._get_macs(params)
+        self.assertEqual(e._get_macs(params), macs)
+        # The MAC of an existing domain is not reused
+        params = {'name': 'node2', 'interfaces': ['bridge=virbr0']}
+        self.assertNotEqual(e._get_macs(params), [mac])
+        self.assertEqual(mock_get_domain_macs.call_count, 1)
+
+    @patch.object(engine.vm, 'Instance')
+    def test_define_node_existing_domain(self, mock_instance):
+        instance = mock_instance.return_value.__enter__.return_value
+        instance.mac_addresses = ['52:54:00:aa:bb:01']
+        e = engine.DeploymentEngine({}, 'test-env')
+        params = {'name': 'node1', 'interfaces': ['bridge=virbr0']}
+        node = {'name': 'node1', 'mac_addresses': ['52:54:00:00:00:01'],
+                'sticky_ip_address': {'requested_address': '10.0.0.5'}}
+        e._define_node(params, node)
+        self.assertEqual(mock_instance.call_args[0][0]['mac_addresses'],
+                         ['52:54:00:00:00:01'])
+        self.assertTrue(instance.define.called)
+        self.assertEqual(node['mac_addresses'], ['52:54:00:aa:bb:01'])
+        self.assertEqual(node['sticky_ip_address']['mac_address'],
+                         '52:54:00:aa:bb:01')
+
+    @patch.object(engine.vm, 'get_domain_macs', lambda: {})
+    @patch.object(engine.vm, 'attach_console')
+    @patch.object(engine.vm, 'CloudInstance')
+    def test_deploy_maas_node_prefetched(self, mock_instance, mock_console):
+        instance = mock_instance.return_value
+        instance.__enter__.return_value = instance
+        result = MagicMock()
+        instance.prefetch.return_value = [result]
+        e = engine.DeploymentEngine({}, 'test-env')
+        params = {'name': 'maas', 'interfaces': ['bridge=virbr0']}
+        e.prefetch_maas_node(params)
+        self.assertTrue(instance.prefetch.called)
+        self.assertFalse(instance.create.called)
+
+        # The prefetched instance is used once its volumes are ready
+        e.deploy_maas_node(params)
+        self.assertEqual(mock_instance.call_count, 1)
+        self.assertTrue(result.get.called)
+        self.assertTrue(instance.create.called)
+
+    @patch.object(engine.vm, 'get_domain_macs', lambda: {})
+    @patch.object(engine.vm, 'attach_console')
+    @patch.object(engine.vm, 'CloudInstance')
+    def test_deploy_maas_node_prefetch_error(self, mock_instance,
+                                             mock_console):
+        instance = mock_instance.return_value
+        instance.__enter__.return_value = instance
+        result = MagicMock()
+        result.get.side_effect = exception.MAASDeployerDownloadError('bad')
+        instance.prefetch.return_value = [result]
+        e = engine.DeploymentEngine({}, 'test-env')
+        self.assertRaises(exception.MAASDeployerDownloadError,
+                          e.deploy_maas_node, {'name': 'maas'})
+        self.assertFalse(instance.create.called)
+        self.assertTrue(instance.__exit__.called)
+
+    @patch.object(engine.proxy, 'get_local_address')
+    @patch.object(engine.proxy, 'ensure_running')
+    def test_start_caching_proxy(self, mock_ensure_running,
+                                 mock_get_local_address):
+        mock_get_local_address.return_value = '192.168.122.1'
+        e = engine.DeploymentEngine({}, 'test-env')
+        maas_config = {'caching_proxy': {'max_size': '1G'},
+                       'network_config': 'iface eth0 inet static\n'
+                                         '  address 192.168.122.2'}
+        self.assertEqual(e.start_caching_proxy(maas_config),
+                         'http://192.168.122.1:8123/')
+        mock_ensure_running.assert_called_once_with(
+            8123, engine.proxy.PROXY_CACHE_DIR, '1G', address='192.168.122.1')
+        mock_get_local_address.assert_called_once_with('192.168.122.2')
+        self.assertEqual(maas_config['apt_http_proxy'],
+                         'http://192.168.122.1:8123/')
+
+        client = MagicMock()
+        client.get_boot_sources.return_value = []
+        e.configure_boot_source(client, maas_config)
+        client.set_config.assert_called_once_with(
+            'http_proxy', 'http://192.168.122.1:8123/')
+
+        # Nothing is started unless configured
+        mock_ensure_running.reset_mock()
+        e = engine.DeploymentEngine({}, 'test-env')
+        self.assertIsNone(e.start_caching_proxy({}))
+        self.assertFalse(mock_ensure_running.called)
+
+    @patch.object(engine.proxy, 'get_local_address')
+    @patch.object(engine.mirror, 'ensure_running')
+    @patch.object(engine.mirror.SimpleStreamsMirror, 'update')
+    def test_start_boot_source_mirror(self, mock_update, mock_ensure_running,
+                                      mock_get_local_address):
+        mock_get_local_address.return_value = '192.168.122.1'
+        e = engine.DeploymentEngine({}, 'test-env')
+        selection = {'release': 'trusty', 'os': 'ubuntu', 'arches': 'amd64',
+                     'subarches': '*', 'labels': 'release'}
+        maas_config = {'boot_source_mirror': {'offline': True},
+                       'boot_source': {'selections': {1: selection}},
+                       'ip_address': '192.168.122.2'}
+        url = ('http://192.168.122.1:8124/'
+               'maas.ubuntu.com_images_ephemeral-v2_releases/')
+        self.assertEqual(e.start_boot_source_mirror(maas_config), url)
+        mock_ensure_running.assert_called_once_with(
+            8124, engine.mirror.MIRROR_DIR, address='192.168.122.1')
+        e.boot_source_mirror_sync.get()
+        mock_update.assert_called_once_with(True)
+        self.assertIsNone(e.boot_source_mirror_staged_sync)
+
+        client = MagicMock()
+        client.get_boot_sources.side_effect = [[], [{'id': 1, 'url': url}]]
+        client.get_boot_source_selections.return_value = []
+        e.configure_boot_source(client, maas_config)
+        client.create_boot_source.assert_called_once_with(
+            url, keyring_filename=engine.mirror.DEFAULT_KEYRING)
+        client.create_boot_source_selection.assert_called_once_with(
+            1, 'trusty', 'ubuntu', 'amd64', '*', 'release')
+
+        # The selections of the first stage of a staged import go first
+        mock_update.reset_mock()
+        e = engine.DeploymentEngine({}, 'test-env')
+        e.start_boot_source_mirror(dict(maas_config,
+                                        staged_boot_image_import=True))
+        e.boot_source_mirror_staged_sync.get()
+        e.boot_source_mirror_sync.get()
+        self.assertEqual(mock_update.call_count, 2)
+
+        # The selections to mirror are required
+        e = engine.DeploymentEngine({}, 'test-env')
+        self.assertRaises(exception.MAASDeployerConfigError,
+                          e.start_boot_source_mirror,
+                          {'boot_source_mirror': True})
+        self.assertIsNone(e.start_boot_source_mirror({}))
+
+    @patch.object(engine.util, 'exec_script_remote')
+    @patch.object(engine.util, 'execc')
+    def test_boot_resources_cache(self, mock_execc, mock_exec_script_remote):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        def fake_execc(cmd, **kwargs):
+            if cmd[0] == 'scp' and cmd[-1].endswith('.part'):
+                with open(cmd[-1], 'w') as fd:
+                    fd.write('archive')
+            elif 'dpkg-query' in cmd:
+                return '1.9.4+bzr4592-0ubuntu1~14.04.1', ''
+
+            return '', ''
+
+        mock_execc.side_effect = fake_execc
+        maas_config = {'user': 'ubuntu', 'release': 'xenial',
+                       'boot_resources_cache': {'path': tmpdir},
+                       'boot_source': {'selections': {1: {
+                           'release': 'xenial', 'arches': 'amd64'}}}}
+        e = engine.DeploymentEngine({}, 'test-env')
+        e.ip_addr = '192.168.122.2'
+        archive = e._get_boot_resources_archive(maas_config)
+        self.assertEqual(os.path.dirname(archive), tmpdir)
+        self.assertFalse(e.restore_boot_resources(maas_config))
+        self.assertEqual(e.export_boot_resources(maas_config), archive)
+        self.assertTrue(os.path.exists(archive))
+        script = mock_exec_script_remote.call_args[0][2]
+        self.assertIn('--table=maasserver_bootresourcefile', script)
+        self.assertIn('maas-region-controller',
+                      mock_execc.call_args_list[0][0][0])
+        self.assertIn('ubuntu@192.168.122.2:%s' %
+                      (engine.BOOT_RESOURCES_REMOTE_ARCHIVE),
+                      mock_execc.call_args_list[1][0][0])
+
+        # A cached archive is restored and not exported again
+        mock_execc.reset_mock()
+        e = engine.DeploymentEngine({}, 'test-env')
+        e.ip_addr = '192.168.122.2'
+        self.assertTrue(e.restore_boot_resources(maas_config))
+        self.assertEqual(mock_execc.call_args_list[-1], call(e.get_scp_cmd(
+            'ubuntu', '192.168.122.2', archive,
+            engine.BOOT_RESOURCES_REMOTE_ARCHIVE)))
+        script = mock_exec_script_remote.call_args[0][2]
+        self.assertIn('pg_restore', script)
+        self.assertIn("setval(pg_get_serial_sequence('maasserver_largefile'",
+                      script)
+        self.assertIsNone(e.export_boot_resources(maas_config))
+
+        # Archives are kept per release and selections
+        other = dict(maas_config, release='trusty')
+        self.assertNotEqual(e._get_boot_resources_archive(other), archive)
+        self.assertIsNone(e._get_boot_resources_archive({}))
+
+        # and per MAAS version, boot source and minimal selections
+        e.maas_version = '2.0.0~beta3+bzr4941-0ubuntu1'
+        self.assertNotEqual(e._get_boot_resources_archive(maas_config),
+                            archive)
+        e.maas_version = None
+        e.boot_source_mirror_url = 'http://192.168.122.1:8124/mirror/'
+        self.assertNotEqual(e._get_boot_resources_archive(maas_config),
+                            archive)
+        e.boot_source_mirror_url = None
+        minimal = dict(maas_config, minimal_boot_images=True)
+        self.assertNotEqual(e._get_boot_resources_archive(minimal), archive)
+        minimal['nodes'] = [{'architecture': 'arm64/generic'}]
+        self.assertNotEqual(e._get_boot_resources_archive(minimal),
+                            e._get_boot_resources_archive(
+                                dict(minimal, nodes=[])))
+
+    def test_get_minimal_selections(self):
+        e = engine.DeploymentEngine({}, 'test-env')
+        self.assertIsNone(e.get_minimal_selections({}))
+        e.juju_series = 'xenial'
+        maas_config = {
+            'minimal_boot_images': True,
+            'nodes': [{'name': 'n1', 'architecture': 'arm64/xgene-uboot'}],
+            'boot_source': {'selections': {1: {
+                'release': 'xenial', 'os': 'ubuntu', 'arches': '*',
+                'subarches': '*', 'labels': 'daily'}}},
+        }
+        self.assertEqual(e.get_minimal_selections(maas_config), [
+            {'os': 'ubuntu', 'release': 'trusty',
+             'arches': ['amd64', 'arm64'],
+             'subarches': ['generic', 'xgene-uboot'],
+             'labels': ['release']},
+            {'os': 'ubuntu', 'release': 'xenial',
+             'arches': ['amd64', 'arm64'],
+             'subarches': ['generic', 'xgene-uboot'],
+             'labels': ['daily']},
+        ])
+
+        e.juju_series = None
+        maas_config = {'minimal_boot_images': True,
+                       'settings': {'commissioning_distro_series': 'xenial'}}
+        self.assertEqual(
+            [s['release'] for s in e.get_minimal_selections(maas_config)],
+            ['trusty', 'xenial'])
+
+    def test_configure_boot_source_minimal(self):
+        e = engine.DeploymentEngine({}, 'test-env')
+        client = MagicMock()
+        client.get_boot_sources.return_value = [{'id': 1, 'url': 'u'}]
+        client.get_boot_source_selections.return_value = [
+            {'id': 10, 'os': 'ubuntu', 'release': 'trusty',
+             'arches': ['amd64', 'i386'], 'subarches': ['*'],
+             'labels': ['release']},
+            {'id': 11, 'os': 'ubuntu', 'release': 'precise',
+             'arches': ['amd64'], 'subarches': ['*'], 'labels': ['release']},
+        ]
+        e.juju_series = 'xenial'
+        e.configure_boot_source(client, {'minimal_boot_images': True})
+        client.update_boot_source_selection.assert_called_once_with(
+            1, 10, arches=['amd64'], subarches=['generic'])
+        client.delete_boot_source_selection.assert_called_once_with(1, 11)
+        client.create_boot_source_selection.assert_called_once_with(
+            1, 'xenial', 'ubuntu', ['amd64'], ['generic'], ['release'])
+
+    def test_configure_boot_source_staged(self):
+        e = engine.DeploymentEngine({}, 'test-env')
+        maas_config = {'staged_boot_image_import': True,
+                       'settings': {'commissioning_distro_series': 'xenial'}}
+        staged = e.get_staged_selections(maas_config)
+        self.assertEqual(staged, [{'os': 'ubuntu', 'release': 'xenial',
+                                   'arches': ['amd64'],
+                                   'subarches': ['generic'],
+                                   'labels': ['release']}])
+        self.assertIsNone(e.get_staged_selections({}))
+
+        original = [{'id': 10, 'os': 'ubuntu', 'release': 'trusty',
+                     'arches': ['*'], 'subarches': ['*'],
+                     'labels': ['release']}]
+        client = MagicMock()
+        client.get_boot_sources.return_value = [{'id': 1, 'url': 'u'}]
+        client.get_boot_source_selections.return_value = original
+        e.configure_boot_source(client, maas_config, selections=staged)
+        client.delete_boot_source_selection.assert_called_once_with(1, 10)
+        client.create_boot_source_selection.assert_called_once_with(
+            1, 'xenial', 'ubuntu', ['amd64'], ['generic'], ['release'])
+        self.assertEqual(e.staged_selections, {1: original})
+
+        # The original selections are put back for the second stage
+        client.reset_mock()
+        client.get_boot_source_selections.return_value = [
+            dict(staged[0], id=11)]
+        e.configure_boot_source(client, maas_config)
+        client.delete_boot_source_selection.assert_called_once_with(1, 11)
+        client.create_boot_source_selection.assert_called_once_with(
+            1, 'trusty', 'ubuntu', ['*'], ['*'], ['release'])
+        self.assertEqual(e.staged_selections, {})
+
+    def test_configure_boot_source_staged_force(self):
+        e = engine.DeploymentEngine({}, 'test-env')
+        url = 'http://192.168.122.1:8124/mirror/'
+        e.boot_source_mirror_url = url
+        e.boot_source_mirror_staged_sync = MagicMock()
+        e.boot_source_mirror_sync = MagicMock()
+        maas_config = {'staged_boot_image_import': True,
+                       'settings': {'commissioning_distro_series': 'xenial'},
+                       'boot_source': {
+                           'url': 'http://images.example.com/releases/',
+                           'force': True, 'exclusive': True,
+                           'selections': {1: {
+                               'release': 'trusty', 'os': 'ubuntu',
+                               'arches': '*', 'subarches': '*',
+                               'labels': 'release'}}}}
+        staged = e.get_staged_selections(maas_config)
+        trusty = {'id': 20, 'os': 'ubuntu', 'release': 'trusty',
+                  'arches': ['*'], 'subarches': ['*'], 'labels': ['release']}
+        client = MagicMock()
+        client.get_boot_sources.side_effect = [
+            [{'id': 1, 'url': engine.mirror.DEFAULT_BOOT_SOURCE_URL}],
+            [{'id': 2, 'url': url}], [{'id': 2, 'url': url}]]
+        client.get_boot_source_selections.side_effect = [[], [trusty]]
+        e.configure_boot_source(client, maas_config, selections=staged)
+        # The first stage only waits for its own selections to be mirrored
+        e.boot_source_mirror_staged_sync.get.assert_called_once_with()
+        self.assertFalse(e.boot_source_mirror_sync.get.called)
+        client.create_boot_source.assert_called_once_with(
+            url, keyring_filename=engine.mirror.DEFAULT_KEYRING)
+        client.delete_boot_source.assert_called_once_with(1)
+        self.assertEqual(client.create_boot_source_selection.call_args_list,
+                         [call(2, 'trusty', 'ubuntu', '*', '*', 'release'),
+                          call(2, 'xenial', 'ubuntu', ['amd64'],
+                               ['generic'], ['release'])])
+        client.delete_boot_source_selection.assert_called_once_with(2, 20)
+        self.assertEqual(e.staged_selections, {2: [trusty]})
+
+        # The boot source is left alone for the second stage
+        client.reset_mock()
+        client.get_boot_source_selections.side_effect = None
+        client.get_boot_source_selections.return_value = [
+            dict(staged[0], id=21)]
+        e.configure_boot_source(client, maas_config)
+        e.boot_source_mirror_sync.get.assert_called_once_with()
+        self.assertFalse(client.create_boot_source.called)
+        self.assertFalse(client.delete_boot_source.called)
+        client.delete_boot_source_selection.assert_called_once_with(2, 21)
+        client.create_boot_source_selection.assert_called_once_with(
+            2, 'trusty', 'ubuntu', ['*'], ['*'], ['release'])
+        self.assertEqual(e.staged_selections, {})
+
+    @patch('sys.stdout', MagicMock())
+    @patch.object(engine.time, 'sleep')
+    def test_wait_for_import(self, mock_sleep):
+        client = MagicMock()
+        monitor = MagicMock()
+        monitor.started = engine.time.time()
+        monitor.size = 1 << 20
+        monitor.poll.side_effect = [False, False, True]
+        monitor.stalled = False
+        e = engine.DeploymentEngine({}, 'test-env')
+        e._wait_for_import(client, monitor, 60)
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertFalse(client.import_boot_images.called)
+
+        # Stalled imports are started again
+        monitor.poll.side_effect = [False, True]
+        monitor.stalled = True
+        monitor.pending = []
+        with patch.object(engine, 'log') as mock_log:
+            e._wait_for_import(client, monitor, 60)
+        client.import_boot_images.assert_called_once_with()
+        monitor.reset_stall.assert_called_once_with()
+        # The log message is kept free of terminal control characters
+        self.assertTrue(mock_log.warning.call_args[0][0].startswith(
+            'No progress importing boot images'))
+
+        # Until the import times out
+        monitor.poll.side_effect = None
+        monitor.poll.return_value = False
+        monitor.stalled = False
+        self.assertRaises(exception.MAASDeployerTimeout, e._wait_for_import,
+                          client, monitor, -1)
+
+    @patch.object(engine, 'MAASClient')
+    @patch.object(engine.time, 'sleep')
+    def test_background_import(self, mock_sleep, mock_client):
+        api_client = mock_client.return_value
+        api_client.get_boot_resources.return_value = [{'id': 1}]
+        api_client.get_boot_resource.return_value = {'sets': {'1': {
+            'size': 10, 'complete': True}}}
+        api_client.is_importing_boot_resources.side_effect = [True, False]
+        api_client.get_nodegroups.return_value = []
+        client = MagicMock()
+        e = engine.DeploymentEngine({}, 'test-env')
+        e.ip_addr = '192.168.122.2'
+        e.api_key = 'a:b:c'
+        e.start_background_import(client, {'user': 'ubuntu'}).get()
+        client.import_boot_images.assert_called_once_with()
+        mock_client.assert_called_once_with(
+            'http://192.168.122.2/MAAS/api/1.0', 'a:b:c')
+        self.assertEqual(api_client.is_importing_boot_resources.call_count, 2)
+        self.assertIn('background_import', e.timings)
@@ -0,0 +1,240 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+
+import BaseHTTPServer
+import hashlib
+import json
+import os
+import shutil
+import SimpleHTTPServer
+import tempfile
+import threading
+import unittest
+import urllib2
+
+from maas_deployer.vmaas import mirror
+from maas_deployer.vmaas.exception import (
+    MAASDeployerConfigError,
+    MAASDeployerDownloadError,
+)
+from mock import patch, MagicMock
+
+
+class CountingRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serves files from the server's directory, counting requests."""
+
+    def translate_path(self, path):
+        return os.path.join(self.server.directory, path.lstrip('/'))
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+
+def _serve(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+def _sign(content):
+    return ('-----BEGIN PGP SIGNED MESSAGE-----\nHash: SHA256\n\n%s\n'
+            '-----BEGIN PGP SIGNATURE-----\n\nsignature\n'
+            '-----END PGP SIGNATURE-----\n' % (content))
+
+
+@patch.object(mirror, 'log', MagicMock())
+@patch('maas_deployer.vmaas.download.log', MagicMock())
+@patch('sys.stdout', MagicMock())
+class TestSimpleStreamsMirror(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.origin_dir = os.path.join(self.tmpdir, 'origin')
+        self.mirror_dir = os.path.join(self.tmpdir, 'mirror')
+        self.origin = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                CountingRequestHandler)
+        self.origin.directory = self.origin_dir
+        self.origin.requests = []
+        _serve(self.origin)
+        self.url = 'http://127.0.0.1:%d/releases/' % \
+            (self.origin.server_address[1])
+        self.products = {}
+        for release in ('trusty', 'xenial'):
+            for arch in ('amd64', 'i386'):
+                self._add_product(release, arch)
+
+        self._publish()
+
+    def tearDown(self):
+        self.origin.shutdown()
+        self.origin.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, path, content):
+        path = os.path.join(self.origin_dir, 'releases', path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(path, 'wb') as fd:
+            fd.write(content)
+
+    def _add_product(self, release, arch, version='20160101'):
+        name = 'com.ubuntu.maas:v2:boot:%s:%s:generic' % (release, arch)
+        product = self.products.setdefault(name, {
+            'os': 'ubuntu', 'release': release, 'arch': arch,
+            'subarch': 'generic', 'label': 'release', 'versions': {}})
+        path = '%s/%s/%s/root-image.gz' % (release, arch, version)
+        content = 'root image of %s %s %s' % (release, arch, version)
+        self._write(path, content)
+        product['versions'][version] = {'items': {'root-image.gz': {
+            'path': path, 'size': len(content),
+            'sha256': hashlib.sha256(content).hexdigest()}}}
+
+    def _publish(self):
+        products_path = 'streams/v1/com.ubuntu.maas:v2:download.json'
+        products = json.dumps({'format': 'products:1.0',
+                               'products': self.products})
+        index = json.dumps({'format': 'index:1.0', 'index': {
+            'com.ubuntu.maas:v2:download': {'format': 'products:1.0',
+                                            'path': products_path}}})
+        self._write(products_path, products)
+        self._write(mirror.get_signed_path(products_path), _sign(products))
+        self._write('streams/v1/index.json', index)
+        self._write('streams/v1/index.sjson', _sign(index))
+
+    def _mirrored(self, path):
+        return os.path.join(self.mirror_dir, path)
+
+    def _mirror(self, **selection):
+        return mirror.SimpleStreamsMirror(self.url, self.mirror_dir,
+                                          [selection])
+
+    def test_sync(self):
+        m = self._mirror(os='ubuntu', release='trusty', arches='amd64',
+                         subarches='*', labels='release')
+        self.assertTrue(m.sync() > 0)
+        self.assertTrue(m.has_index())
+        for path in ('streams/v1/index.json', 'streams/v1/index.sjson',
+                     'streams/v1/com.ubuntu.maas:v2:download.json',
+                     'streams/v1/com.ubuntu.maas:v2:download.sjson'):
+            with open(self._mirrored(path)) as fd:
+                with open(os.path.join(self.origin_dir, 'releases',
+                                       path)) as origin:
+                    self.assertEqual(fd.read(), origin.read())
+
+        self.assertTrue(os.path.exists(self._mirrored(
+            'trusty/amd64/20160101/root-image.gz')))
+        self.assertFalse(os.path.exists(self._mirrored('trusty/i386')))
+        self.assertFalse(os.path.exists(self._mirrored('xenial')))
+
+        # Files already mirrored are not fetched again
+        self.origin.requests = []
+        self.assertEqual(m.sync(), 0)
+        self.assertFalse([p for p in self.origin.requests
+                          if p.endswith('.gz')])
+
+        # Only the latest version of a product is fetched
+        self._add_product('trusty', 'amd64', '20160201')
+        self._publish()
+        self.assertTrue(m.sync() > 0)
+        self.assertTrue(os.path.exists(self._mirrored(
+            'trusty/amd64/20160201/root-image.gz')))
+
+    def test_sync_bad_checksum(self):
+        m = self._mirror(release='xenial', arches=['amd64', 'i386'])
+        self._write('xenial/i386/20160101/root-image.gz',
+                    'root image of xenial i386 2016010X')
+        self.assertRaises(MAASDeployerDownloadError, m.sync)
+        # The metadata is not replaced unless all files were fetched
+        self.assertFalse(m.has_index())
+
+    def test_update(self):
+        m = self._mirror(release='trusty', arches='*')
+        self.assertRaises(MAASDeployerConfigError, m.update, offline=True)
+        m.update()
+        self.origin.requests = []
+        self.assertEqual(m.update(offline=True), 0)
+        self.assertEqual(self.origin.requests, [])
+
+        # The existing mirror is used if upstream cannot be reached
+        shutil.rmtree(self.origin_dir)
+        self.assertEqual(m.update(), 0)
+        m = self._mirror(release='xenial')
+        m.path = os.path.join(self.tmpdir, 'empty')
+        self.assertRaises(MAASDeployerDownloadError, m.update)
+
+    def test_serve(self):
+        m = self._mirror(release='trusty', arches='amd64')
+        m.sync()
+        server = mirror.MirrorServer(('127.0.0.1', 0), self.tmpdir)
+        _serve(server)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+        url = 'http://127.0.0.1:%d/mirror/' % (server.server_address[1])
+        resp = opener.open(url + 'trusty/amd64/20160101/root-image.gz')
+        self.assertEqual(resp.read(), 'root image of trusty amd64 20160101')
+        self.assertRaises(urllib2.HTTPError, opener.open,
+                          url + '../../etc/passwd')
+
+
+class TestMirrorHelpers(unittest.TestCase):
+
+    @patch.object(mirror, 'start_service')
+    @patch.object(mirror, 'is_port_open')
+    def test_ensure_running(self, mock_is_port_open, mock_start_service):
+        mock_is_port_open.return_value = False
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        mirror.ensure_running(8124, path, address='192.168.122.1')
+        mock_is_port_open.assert_called_once_with('192.168.122.1', 8124)
+        cmd = mock_start_service.call_args[0][1]
+        self.assertEqual(cmd[cmd.index('--address') + 1], '192.168.122.1')
+        self.assertEqual(mock_start_service.call_args[0][2:4],
+                         ('192.168.122.1', 8124))
+
+    def test_get_mirror_name(self):
+        self.assertEqual(
+            mirror.get_mirror_name(mirror.DEFAULT_BOOT_SOURCE_URL),
+            'maas.ubuntu.com_images_ephemeral-v2_releases')
+
+    def test_load_metadata(self):
+        content = '{\n"a": "- b"\n}'
+        self.assertEqual(mirror.load_metadata(content), {'a': '- b'})
+        self.assertEqual(mirror.load_metadata(_sign(content)), {'a': '- b'})
+        self.assertEqual(mirror.load_metadata(_sign('- {"a": 1}')),
+                         {'a': 1})
+
+    def test_matches_selection(self):
+        product = {'os': 'ubuntu', 'release': 'trusty', 'arch': 'amd64',
+                   'subarch': 'hwe-t', 'label': 'release'}
+        self.assertTrue(mirror.matches_selection(product, {
+            'os': 'ubuntu', 'release': 'trusty', 'arches': 'amd64, i386',
+            'subarches': '*', 'labels': ['release']}))
+        self.assertTrue(mirror.matches_selection(product,
+                                                 {'release': 'trusty'}))
+        self.assertFalse(mirror.matches_selection(product,
+                                                  {'release': 'xenial'}))
+        self.assertFalse(mirror.matches_selection(product,
+                                                  {'arches': 'arm64'}))
+
+    def test_get_selected_items(self):
+        products = {
+            'a': {'release': 'trusty', 'arch': 'amd64', 'versions': {
+                '1': {'items': {'x': {'path': 'a1'}}},
+                '2': {'items': {'x': {'path': 'a2'}}}}},
+            'b': {'release': 'xenial', 'arch': 'amd64', 'versions': {
+                '1': {'items': {'x': {'path': 'b1'}}}}},
+            'c': {'bootloader-type': 'pxe', 'arch': 'amd64', 'versions': {
+                '1': {'items': {'x': {'path': 'c1'}}}}},
+            'd': {'bootloader-type': 'uefi', 'arch': 'arm64', 'versions': {
+                '1': {'items': {'x': {'path': 'd1'}}}}},
+        }
+        items = mirror.get_selected_items(products, [{'release': 'trusty',
+                                                      'arches': 'amd64'}])
+        self.assertEqual([i['path'] for i in items], ['a2', 'c1'])
@@ -0,0 +1,185 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+
+import BaseHTTPServer
+import httplib
+import os
+import shutil
+import SimpleHTTPServer
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+
+from maas_deployer.vmaas import proxy
+from mock import patch, MagicMock
+
+
+class CountingRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serves files from the server's directory, counting requests."""
+
+    def translate_path(self, path):
+        return os.path.join(self.server.directory, path.lstrip('/'))
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+
+def _serve(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+@patch.object(proxy, 'log', MagicMock())
+class TestCachingProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.origin_dir = os.path.join(self.tmpdir, 'origin')
+        os.makedirs(os.path.join(self.origin_dir, 'ubuntu', 'dists'))
+        os.makedirs(os.path.join(self.origin_dir, 'ubuntu', 'pool'))
+        self.origin = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                CountingRequestHandler)
+        self.origin.directory = self.origin_dir
+        self.origin.requests = []
+        _serve(self.origin)
+
+    def tearDown(self):
+        self.origin.shutdown()
+        self.origin.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def _start_proxy(self, max_size):
+        cache = proxy.ProxyCache(os.path.join(self.tmpdir, 'cache'),
+                                 max_size)
+        server = proxy.CachingProxyServer(('127.0.0.1', 0), cache)
+        server.opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+        _serve(server)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def _write(self, path, content):
+        with open(os.path.join(self.origin_dir, path), 'wb') as fd:
+            fd.write(content)
+
+    def _get(self, server, path):
+        url = 'http://127.0.0.1:%d/%s' % (self.origin.server_address[1], path)
+        conn = httplib.HTTPConnection('127.0.0.1', server.server_address[1])
+        conn.request('GET', url)
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+        cache_status = response.getheader('X-Cache')
+        if (cache_status == 'MISS' and response.status == 200 and
+                proxy.is_cacheable(url)):
+            # The content is added to the cache once it has been sent.
+            key = proxy.ProxyCache.key(url)
+            deadline = time.time() + 5
+            while (key not in server.cache._entries and
+                   time.time() < deadline):
+                time.sleep(0.01)
+
+            # and any eviction is done before the lock is released.
+            with server.cache._lock:
+                pass
+
+        return (response.status, cache_status, body)
+
+    def test_is_cacheable(self):
+        self.assertTrue(proxy.is_cacheable(
+            'http://archive.ubuntu.com/ubuntu/pool/main/j/jq/jq_1.3.deb'))
+        self.assertTrue(proxy.is_cacheable(
+            'http://maas.ubuntu.com/images/ephemeral-v2/releases/trusty/'
+            'amd64/20160314/generic/boot-kernel'))
+        self.assertFalse(proxy.is_cacheable(
+            'http://archive.ubuntu.com/ubuntu/dists/trusty/main/binary-amd64/'
+            'Packages.gz'))
+        self.assertFalse(proxy.is_cacheable(
+            'http://maas.ubuntu.com/images/ephemeral-v2/releases/streams/v1/'
+            'index.sjson'))
+
+    def test_cache_hit(self):
+        server = self._start_proxy(1 << 20)
+        self._write('ubuntu/pool/jq.deb', 'deb' * 100)
+        self.assertEqual(self._get(server, 'ubuntu/pool/jq.deb'),
+                         (200, 'MISS', 'deb' * 100))
+        self.assertEqual(self._get(server, 'ubuntu/pool/jq.deb'),
+                         (200, 'HIT', 'deb' * 100))
+        self.assertEqual(self.origin.requests, ['/ubuntu/pool/jq.deb'])
+
+        # Indexes always go to the origin
+        self._write('ubuntu/dists/Release', 'v1')
+        self._get(server, 'ubuntu/dists/Release')
+        self._write('ubuntu/dists/Release', 'v2')
+        self.assertEqual(self._get(server, 'ubuntu/dists/Release'),
+                         (200, 'MISS', 'v2'))
+
+        # Errors are relayed and not cached
+        self.assertEqual(self._get(server, 'ubuntu/pool/missing.deb')[:2],
+                         (404, 'MISS'))
+        self.assertEqual(self._get(server, 'ubuntu/pool/missing.deb')[:2],
+                         (404, 'MISS'))
+
+    def test_lru_eviction(self):
+        server = self._start_proxy(250)
+        for name in ('a', 'b', 'c'):
+            self._write('ubuntu/pool/%s.deb' % name, name * 100)
+
+        self._get(server, 'ubuntu/pool/a.deb')
+        self._get(server, 'ubuntu/pool/b.deb')
+        # a is used more recently than b so b is evicted to make room for c
+        self._get(server, 'ubuntu/pool/a.deb')
+        self._get(server, 'ubuntu/pool/c.deb')
+        self.assertEqual(server.cache.size, 200)
+        self.assertEqual(self._get(server, 'ubuntu/pool/a.deb')[1], 'HIT')
+        self.assertEqual(self._get(server, 'ubuntu/pool/b.deb')[1], 'MISS')
+
+        # The cache is reloaded from disk
+        cache = proxy.ProxyCache(server.cache.path, 1000)
+        self.assertEqual(cache.size, server.cache.size)
+
+    def _connect(self, server, target):
+        conn = httplib.HTTPConnection('127.0.0.1', server.server_address[1])
+        conn.request('CONNECT', target)
+        status = conn.getresponse().status
+        conn.close()
+        return status
+
+    def test_connect(self):
+        server = self._start_proxy(1 << 20)
+        # Only https is tunnelled
+        self.assertEqual(self._connect(server, '127.0.0.1:%d' %
+                                       (self.origin.server_address[1])), 403)
+        self.assertEqual(self._connect(server, '127.0.0.1:22'), 403)
+        self.assertEqual(self._connect(server, '127.0.0.1:https'), 400)
+        with patch.object(proxy, 'CONNECT_PORTS',
+                          [self.origin.server_address[1]]):
+            self.assertEqual(self._connect(
+                server, '127.0.0.1:%d' % (self.origin.server_address[1])),
+                200)
+
+    @patch.object(proxy, 'start_service')
+    @patch.object(proxy, 'is_port_open')
+    def test_ensure_running(self, mock_is_port_open, mock_start_service):
+        mock_is_port_open.return_value = False
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        proxy.ensure_running(8123, cache_dir, '1G', address='192.168.122.1')
+        mock_is_port_open.assert_called_once_with('192.168.122.1', 8123)
+        cmd = mock_start_service.call_args[0][1]
+        self.assertEqual(cmd[cmd.index('--address') + 1], '192.168.122.1')
+        self.assertEqual(mock_start_service.call_args[0][2:4],
+                         ('192.168.122.1', 8123))
+
+        # Nothing is started if the proxy is already listening
+        mock_start_service.reset_mock()
+        mock_is_port_open.return_value = True
+        proxy.ensure_running(8123, cache_dir, '1G', address='192.168.122.1')
+        self.assertFalse(mock_start_service.called)
@@ -0,0 +1,88 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+
+import email
+import struct
+import unittest
+
+from maas_deployer.vmaas import seed
+
+
+def _read_root(image):
+    """Returns {name: content} of the files in the root of an ISO image."""
+    pvd = image[16 * seed.SECTOR_SIZE:17 * seed.SECTOR_SIZE]
+    root_extent = struct.unpack('<I', pvd[158:162])[0]
+    root = image[root_extent * seed.SECTOR_SIZE:
+                 (root_extent + 1) * seed.SECTOR_SIZE]
+    files = {}
+    offset = 0
+    while ord(root[offset]):
+        length = ord(root[offset])
+        record = root[offset:offset + length]
+        extent, size = struct.unpack('<I', record[2:6])[0], \
+            struct.unpack('<I', record[10:14])[0]
+        name = record[33:33 + ord(record[32])]
+        if not ord(record[25]) & 2:
+            start = extent * seed.SECTOR_SIZE
+            files[name] = image[start:start + size]
+
+        offset += length
+
+    return files
+
+
+class TestSeed(unittest.TestCase):
+
+    def test_get_content_type(self):
+        self.assertEqual(seed.get_content_type('#cloud-config\na: b'),
+                         'text/cloud-config')
+        self.assertEqual(seed.get_content_type('#cloud-config-archive\n'),
+                         'text/cloud-config-archive')
+        self.assertEqual(seed.get_content_type('#!/bin/sh\n'),
+                         'text/x-shellscript')
+        self.assertEqual(seed.get_content_type('hello'), 'text/plain')
+
+    def test_make_user_data(self):
+        user_data = seed.make_user_data([
+            ('cloud-init.cfg', u'#cloud-config\nuser: ubuntu\n'),
+            ('config-maas.sh', 'set -e\n', 'text/x-shellscript'),
+        ])
+        msg = email.message_from_string(user_data)
+        parts = [p for p in msg.walk() if not p.is_multipart()]
+        self.assertEqual([p.get_content_type() for p in parts],
+                         ['text/cloud-config', 'text/x-shellscript'])
+        self.assertEqual([p.get_filename() for p in parts],
+                         ['cloud-init.cfg', 'config-maas.sh'])
+        self.assertEqual(parts[0].get_payload(),
+                         '#cloud-config\nuser: ubuntu\n')
+
+    def test_make_seed_image(self):
+        user_data = 'x' * 5000
+        image = seed.make_seed_image(user_data, u'instance-id: maas\n',
+                                     digest='abc')
+        self.assertEqual(len(image) % seed.SECTOR_SIZE, 0)
+        pvd = image[16 * seed.SECTOR_SIZE:17 * seed.SECTOR_SIZE]
+        self.assertEqual(pvd[1:6], 'CD001')
+        self.assertEqual(pvd[40:72].rstrip(), 'cidata')
+        self.assertEqual(seed.read_digest(pvd), 'abc')
+        self.assertEqual(struct.unpack('<I', pvd[80:84])[0] *
+                         seed.SECTOR_SIZE, len(image))
+        self.assertEqual(_read_root(image),
+                         {'META-DATA.;1': 'instance-id: maas\n',
+                          'USER-DATA.;1': user_data})
+
+    def test_get_digest(self):
+        parts = [('cloud-init.cfg', '#cloud-config\n'),
+                 ('config-maas.sh', 'set -e\n', 'text/x-shellscript')]
+        digest = seed.get_digest(parts, 'instance-id: maas\n')
+        self.assertEqual(digest, seed.get_digest(list(parts),
+                                                 u'instance-id: maas\n'))
+        self.assertNotEqual(digest, seed.get_digest(parts[:1],
+                                                    'instance-id: maas\n'))
+        self.assertNotEqual(digest, seed.get_digest(parts,
+                                                    'instance-id: maas2\n'))
+        # The same content always gives the same user-data
+        self.assertEqual(seed.make_user_data(parts, boundary=digest),
+                         seed.make_user_data(parts, boundary=digest))
+        self.assertIsNone(seed.read_digest('\0' * seed.SECTOR_SIZE))
@@ -0,0 +1,140 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from maas_deployer.vmaas import storage
+from mock import patch, MagicMock
+
+
+class FakeStream(object):
+    """Reassembles the file sent on a sparse upload stream."""
+
+    def __init__(self):
+        self.content = ''
+        self.holes = 0
+
+    def send(self, data):
+        self.content += data
+
+    def sendHole(self, length, flags):
+        self.content += '\0' * length
+        self.holes += 1
+
+
+class TestStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_image_info(self):
+        path = os.path.join(self.tmpdir, 'disk.img')
+        with open(path, 'wb') as fd:
+            fd.write(storage.QCOW2_HEADER.pack(storage.QCOW2_MAGIC, 2, 0, 0,
+                                               16, 2252341248))
+
+        self.assertEqual(storage.get_image_info(path),
+                         ('qcow2', 2252341248))
+
+        with open(path, 'wb') as fd:
+            fd.write('\0' * 4096)
+
+        self.assertEqual(storage.get_image_info(path), ('raw', 4096))
+
+    @patch.object(storage, 'log', MagicMock())
+    @patch.object(storage, 'sys', MagicMock())
+    @patch.object(storage, 'UPLOAD_CHUNK_SIZE', 1000)
+    def test_upload_volume_sparse(self):
+        path = os.path.join(self.tmpdir, 'seed.img')
+        with open(path, 'wb') as fd:
+            fd.write('a' * 5000)
+            fd.seek(4 << 20)
+            fd.write('b' * 3000)
+            fd.truncate(8 << 20)
+
+        with open(path, 'rb') as fd:
+            expected = fd.read()
+
+        stream = FakeStream()
+        conn = MagicMock()
+        conn.newStream.return_value = stream
+        stream.finish = MagicMock()
+        vol = conn.storagePoolLookupByName.return_value.\
+            storageVolLookupByName.return_value
+
+        sent = storage.upload_volume(conn, 'default', 'seed.img', path)
+        self.assertEqual(stream.content, expected)
+        self.assertTrue(stream.finish.called)
+        self.assertEqual(vol.upload.call_args[0][2], 8 << 20)
+        # Holes are skipped where the filesystem reports them.
+        if stream.holes:
+            self.assertTrue(sent < len(expected))
+
+    @patch.object(storage, 'log', MagicMock())
+    def test_import_volume(self):
+        src = os.path.join(self.tmpdir, 'trusty-server-cloudimg-amd64.img')
+        with open(src, 'wb') as fd:
+            fd.write('x' * 8192)
+
+        pool_dir = os.path.join(self.tmpdir, 'pool')
+        os.mkdir(pool_dir)
+        conn = MagicMock()
+        conn.getURI.return_value = 'qemu:///system'
+        storage_pool = conn.storagePoolLookupByName.return_value
+        storage_pool.XMLDesc.return_value = (
+            "<pool type='dir'><name>default</name>"
+            "<target><path>%s</path></target></pool>" % (pool_dir))
+
+        self.assertTrue(storage.import_volume(conn, 'default', 'base', src))
+        with open(os.path.join(pool_dir, 'base'), 'rb') as fd:
+            self.assertEqual(fd.read(), 'x' * 8192)
+
+        self.assertTrue(storage_pool.refresh.called)
+        # An existing volume is not replaced
+        self.assertFalse(storage.import_volume(conn, 'default', 'base', src))
+
+        conn.getURI.return_value = 'qemu+ssh://ubuntu@10.0.0.1/system'
+        self.assertFalse(storage.import_volume(conn, 'default', 'base2',
+                                               src))
+
+    def _import_volume_by(self, method, mode):
+        src = os.path.join(self.tmpdir, 'image-%s.img' % (method))
+        with open(src, 'wb') as fd:
+            fd.write('x' * 8192)
+
+        os.chmod(src, mode)
+        pool_dir = os.path.join(self.tmpdir, 'pool-%s' % (method))
+        os.mkdir(pool_dir)
+        conn = MagicMock()
+        conn.getURI.return_value = 'qemu:///system'
+        conn.storagePoolLookupByName.return_value.XMLDesc.return_value = (
+            "<pool type='dir'><name>default</name>"
+            "<target><path>%s</path></target></pool>" % (pool_dir))
+        methods = [m for m in storage.ZERO_COPY_METHODS if m[0] == method]
+        with patch.object(storage, 'ZERO_COPY_METHODS', methods):
+            self.assertTrue(storage.import_volume(conn, 'default', 'base',
+                                                  src))
+
+        return src, os.path.join(pool_dir, 'base')
+
+    @patch.object(storage, 'log', MagicMock())
+    def test_import_volume_mode(self):
+        # A copy is given the volume mode, leaving the cached image alone
+        src, dst = self._import_volume_by('copy_file_range', 0600)
+        self.assertEqual(stat.S_IMODE(os.stat(src).st_mode), 0600)
+        self.assertEqual(stat.S_IMODE(os.stat(dst).st_mode),
+                         storage.VOLUME_MODE)
+
+        # A hardlink is the cached image, which is made readable as such
+        src, dst = self._import_volume_by('hardlink', 0600)
+        self.assertTrue(os.path.samefile(src, dst))
+        self.assertEqual(stat.S_IMODE(os.stat(src).st_mode),
+                         storage.VOLUME_MODE)
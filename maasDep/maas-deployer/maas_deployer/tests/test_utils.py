@@ -5,6 +5,7 @@
 
 import os
 import shutil
+import socket
 import subprocess
 import tempfile
 import unittest
@@ -52,6 +53,51 @@ class TestUtil(unittest.TestCase):
         self.assertRaises(UnitTestException, foo)
         self.assertEqual(count[0], 5)
 
+    def test_is_port_open(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.bind(('127.0.0.1', 0))
+            sock.listen(1)
+            port = sock.getsockname()[1]
+            self.assertTrue(util.is_port_open('127.0.0.1', port))
+        finally:
+            sock.close()
+
+        self.assertFalse(util.is_port_open('127.0.0.1', port))
+
+    def test_generate_mac(self):
+        mac = util.generate_mac('test-env', 'node1', 0)
+        self.assertTrue(mac.startswith('52:54:00:'))
+        self.assertEqual(len(mac), 17)
+        self.assertEqual(mac, util.generate_mac('test-env', 'node1', 0))
+        self.assertNotEqual(mac, util.generate_mac('test-env', 'node1', 1))
+        self.assertNotEqual(mac, util.generate_mac('test-env', 'node2', 0))
+
+    def test_stream_lines(self):
+        # Enough output on stderr to fill the pipe if it were not drained
+        cmd = ['sh', '-c', 'head -c 1000000 /dev/zero >&2; echo one; '
+                           'echo two']
+        self.assertEqual(list(util.stream_lines(cmd)), ['one\n', 'two\n'])
+
+        cmd = ['sh', '-c', 'echo one; echo failed >&2; exit 3']
+        lines = util.stream_lines(cmd)
+        self.assertEqual(next(lines), 'one\n')
+        try:
+            next(lines)
+        except subprocess.CalledProcessError as exc:
+            self.assertEqual(exc.returncode, 3)
+            self.assertEqual(exc.output, 'failed\n')
+        else:
+            raise UnitTestException("Exception not raised")
+
+    def test_stream_lines_idle(self):
+        cmd = ['sh', '-c', 'echo one; sleep 0.5; printf two']
+        lines = list(util.stream_lines(cmd, idle_timeout=0.1))
+        self.assertEqual([line for line in lines if line is not None],
+                         ['one\n', 'two'])
+        self.assertEqual(lines[0], 'one\n')
+        self.assertIn(None, lines)
+
     def test_execc_piped_stderr(self):
         tmpdir = tempfile.mkdtemp()
         try:
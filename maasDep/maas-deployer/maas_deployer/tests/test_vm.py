@@ -2,37 +2,722 @@
 # Copyright 2015 Canonical, Ltd.
 #
 
+import tempfile
 import unittest
-from maas_deployer.vmaas import vm
-from mock import patch, MagicMock
+import yaml
 
+from multiprocessing.pool import ThreadPool
+from maas_deployer.vmaas import (
+    addresses,
+    connection,
+    console,
+    events,
+    exception,
+    inventory,
+    vm,
+)
+from mock import call, patch, MagicMock
 
-VIRSH_LIST_ALL = """
-Id    Name                           State
-----------------------------------------------------
- 15    maas-boot-vm-dc1               running
- 17    maas                           running
- -     juju-boot-vm-dc1               shut off
- -     fooX                           shut off
+
+DOMAIN_XML = """
+<domain type='kvm'>
+  <name>node1</name>
+  <devices>
+    <interface type='bridge'>
+      <mac address='52:54:00:aa:bb:01'/>
+    </interface>
+    <interface type='bridge'>
+      <mac address='52:54:00:aa:bb:02'/>
+    </interface>
+  </devices>
+</domain>
 """
 
 
+def _fake_libvirt_objects(names):
+    objs = []
+    for name in names:
+        obj = MagicMock()
+        obj.name.return_value = name
+        objs.append(obj)
+
+    return objs
+
+
 class TestVM(unittest.TestCase):
 
     @patch.object(vm, 'log', MagicMock())
     @patch.object(vm.Instance, 'assert_pool_exists', lambda *args: None)
+    @patch.object(vm.events, 'start_event_loop', lambda: False)
     @patch.object(vm, 'cfg')
-    @patch.object(vm, 'virsh')
-    @patch.object(vm.libvirt, 'open', lambda *args: None)
-    def test_instance_domain_exists(self, mock_virsh, mock_cfg):
+    @patch.object(vm.libvirt, 'open')
+    def test_instance_domain_exists(self, mock_open, mock_cfg):
         mock_cfg.use_existing = False
-        mock_cfg.remote = None
-
-        def fake_virsh(cmd):
-            self.assertEqual(cmd, ['list', '--all'])
-            return (VIRSH_LIST_ALL, '')
+        mock_cfg.remote = 'test:///domain-exists'
+        conn = MagicMock()
+        conn.listAllDomains.return_value = _fake_libvirt_objects(
+            ['maas-boot-vm-dc1', 'maas', 'juju-boot-vm-dc1', 'fooX'])
+        mock_open.return_value = conn
 
-        mock_virsh.side_effect = fake_virsh
         inst = vm.Instance({})
         self.assertFalse(inst._domain_exists('foo'))
         self.assertTrue(inst._domain_exists('fooX'))
+        # Domains are only listed once per hypervisor
+        vm.Instance({})._domain_exists('maas')
+        self.assertEqual(conn.listAllDomains.call_count, 1)
+
+    @patch.object(vm, 'log', MagicMock())
+    @patch.object(vm.Instance, 'assert_pool_exists', lambda *args: None)
+    @patch.object(vm.events, 'start_event_loop', lambda: False)
+    @patch.object(vm, 'cfg')
+    @patch.object(vm, 'virsh')
+    @patch.object(vm, 'execc')
+    @patch.object(vm.libvirt, 'open')
+    def test_instance_define_mac_addresses(self, mock_open, mock_execc,
+                                           mock_virsh, mock_cfg):
+        mock_cfg.use_existing = False
+        mock_cfg.remote = 'test:///define-mac-addresses'
+        conn = MagicMock()
+        conn.listAllDomains.return_value = []
+        mock_open.return_value = conn
+        mock_execc.return_value = (DOMAIN_XML, '')
+
+        inst = vm.Instance({'name': 'node1', 'interfaces': []})
+        inst._get_disks = lambda: []
+        inst.define()
+        self.assertEqual(inst.mac_addresses, ['52:54:00:aa:bb:01',
+                                              '52:54:00:aa:bb:02'])
+        # MACs come from the generated XML without asking libvirt
+        self.assertFalse(conn.lookupByName.called)
+        self.assertTrue(inst._domain_exists('node1'))
+        inst.cleanup()
+
+    def test_get_interface_macs(self):
+        params = {'name': 'node1',
+                  'interfaces': ['bridge=virbr0,model=virtio',
+                                 'bridge=br1,mac=52:54:00:AA:BB:CC']}
+        macs = vm.get_interface_macs('test-env', params)
+        self.assertEqual(macs, [vm.generate_mac('test-env', 'node1', 0),
+                                '52:54:00:aa:bb:cc'])
+        self.assertEqual(vm.get_interface_macs('test-env', {'name': 'n'}),
+                         [])
+
+    @patch.object(vm, 'log', MagicMock())
+    @patch.object(vm, 'generate_mac')
+    def test_get_interface_macs_collision(self, mock_generate_mac):
+        mock_generate_mac.side_effect = lambda env, name, idx, attempt=0: \
+            '52:54:00:00:%02d:%02d' % (idx, attempt)
+        params = {'name': 'node1', 'interfaces': ['bridge=virbr0']}
+        used = {'52:54:00:00:00:00': 'maas'}
+        self.assertEqual(vm.get_interface_macs('test-env', params, used),
+                         ['52:54:00:00:00:01'])
+        self.assertEqual(used['52:54:00:00:00:01'], 'node1')
+        # The same domain keeps its addresses
+        self.assertEqual(vm.get_interface_macs('test-env', params, used),
+                         ['52:54:00:00:00:01'])
+
+        params = {'name': 'node2', 'interfaces': ['bridge=virbr0',
+                                                  'bridge=br1']}
+        self.assertEqual(vm.get_interface_macs('test-env', params, used),
+                         ['52:54:00:00:00:02', '52:54:00:00:01:00'])
+
+        # A configured MAC used by another domain is an error
+        params = {'name': 'node3',
+                  'interfaces': ['bridge=virbr0,mac=52:54:00:00:00:00']}
+        self.assertRaises(exception.MAASDeployerConfigError,
+                          vm.get_interface_macs, 'test-env', params, used)
+
+    @patch.object(vm, 'log', MagicMock())
+    @patch.object(vm.Instance, 'assert_pool_exists', lambda *args: None)
+    @patch.object(vm.events, 'start_event_loop', lambda: False)
+    @patch.object(vm, 'cfg')
+    @patch.object(vm.libvirt, 'open')
+    def test_instance_network_params(self, mock_open, mock_cfg):
+        mock_cfg.remote = 'test:///network-params'
+        inst = vm.Instance({'name': 'node1',
+                            'interfaces': ['bridge=virbr0,model=virtio',
+                                           'bridge=br1,mac=52:54:00:aa:bb:cc',
+                                           'bridge=br2'],
+                            'mac_addresses': ['52:54:00:00:00:01',
+                                              '52:54:00:aa:bb:cc']})
+        self.assertEqual(inst._get_network_params(),
+                         ['bridge=virbr0,model=virtio,mac=52:54:00:00:00:01',
+                          'bridge=br1,mac=52:54:00:aa:bb:cc',
+                          'bridge=br2'])
+        inst.cleanup()
+
+    @patch.object(vm, 'log', MagicMock())
+    @patch.object(vm.Instance, 'assert_pool_exists', lambda *args: None)
+    @patch.object(vm.events, 'start_event_loop', lambda: False)
+    @patch.object(vm.CloudInstance, '_get_ssh_key', lambda *args: 'key')
+    @patch.object(vm, 'virsh')
+    @patch.object(vm, 'storage')
+    @patch.object(vm, 'cfg')
+    @patch.object(vm.libvirt, 'open')
+    def test_create_seed_image(self, mock_open, mock_cfg, mock_storage,
+                               mock_virsh):
+        mock_cfg.remote = 'test:///create-seed-image'
+        mock_cfg.force = False
+        inst = vm.CloudInstance({'name': 'maas', 'interfaces': [],
+                                 'network_config': 'auto lo'})
+        inst.inventory = MagicMock()
+        inst.inventory.volumes.return_value = set(['maas-seed.img'])
+
+        # An existing seed without a digest is replaced
+        image = {}
+        mock_storage.upload_data.side_effect = \
+            lambda conn, pool, name, data: image.update(data=data)
+        mock_storage.download_data.return_value = '\0' * 2048
+        inst.create_seed_image()
+        self.assertTrue(mock_storage.upload_data.called)
+        pvd = image['data'][16 * 2048:17 * 2048]
+
+        # An existing seed made from the same content is used as is
+        mock_storage.reset_mock()
+        mock_virsh.reset_mock()
+        mock_storage.download_data.return_value = pvd
+        inst.create_seed_image()
+        self.assertFalse(mock_storage.upload_data.called)
+        self.assertFalse(mock_virsh.called)
+
+        # Changed content replaces the seed
+        inst.password = 'changed'
+        inst.create_seed_image()
+        self.assertTrue(mock_storage.upload_data.called)
+        mock_virsh.assert_called_once_with(['vol-delete', '--pool',
+                                            'default', 'maas-seed.img'])
+        inst.cleanup()
+
+    def test_get_packages(self):
+        self.assertIn('linux-image-extra-virtual', vm.get_packages('amd64'))
+        self.assertNotIn('linux-image-extra-virtual',
+                         vm.get_packages('ppc64'))
+        self.assertIn('maas', vm.get_packages('ppc64'))
+
+    @patch.object(vm, 'log', MagicMock())
+    @patch.object(vm.Instance, 'assert_pool_exists', lambda *args: None)
+    @patch.object(vm.events, 'start_event_loop', lambda: False)
+    @patch.object(vm.CloudInstance, '_get_ssh_key', lambda *args: 'key')
+    @patch.object(vm.CloudInstance, 'ensure_cloud_image', lambda *args: 'r')
+    @patch.object(vm.CloudInstance, 'ensure_seed_image', lambda *args: 's')
+    @patch.object(vm, 'virsh')
+    @patch.object(vm, 'cfg')
+    @patch.object(vm.libvirt, 'open')
+    def test_apt_cache(self, mock_open, mock_cfg, mock_virsh):
+        mock_cfg.remote = 'test:///apt-cache'
+        inst = vm.CloudInstance({'name': 'maas', 'interfaces': [],
+                                 'network_config': 'auto lo',
+                                 'apt_cache': True})
+        inst.inventory = MagicMock()
+        vols = set()
+        inst.inventory.volumes.return_value = vols
+        disk = ('vol=default/trusty-amd64-apt-archives.img,format=qcow2,'
+                'bus=virtio,io=native,serial=aptcache')
+        self.assertEqual(inst._get_disks(), ['r', 's', disk])
+        mock_virsh.assert_called_once_with(
+            ['vol-create-as', '--pool', 'default',
+             'trusty-amd64-apt-archives.img', '10G', '--format', 'qcow2'])
+        config = inst._generate_user_data_parts()[0][1]
+        self.assertIn('dev=/dev/disk/by-id/virtio-aptcache;', config)
+
+        # An existing cache is reused
+        mock_virsh.reset_mock()
+        vols.add('trusty-amd64-apt-archives.img')
+        path = '/var/lib/libvirt/images/trusty-amd64-apt-archives.img'
+        inst.conn.storagePoolLookupByName.return_value.\
+            storageVolLookupByName.return_value.path.return_value = path
+        inst.inventory.domains = set(['maas', 'other-maas'])
+        other_xml = vm.etree.fromstring(
+            "<domain><devices><disk><source file='/images/other.img'/>"
+            "</disk></devices></domain>")
+        inst.inventory.domain_xml.return_value = other_xml
+        self.assertEqual(inst._get_disks(), ['r', 's', disk])
+        self.assertFalse(mock_virsh.called)
+        inst.inventory.domain_xml.assert_called_once_with('other-maas')
+
+        # unless it is attached to another domain
+        other_xml[0][0][0].set('file', path)
+        self.assertEqual(inst._get_disks(), ['r', 's'])
+        self.assertFalse(mock_virsh.called)
+        inst.inventory.domains = set(['maas'])
+
+        # and not attached if the packages are already installed
+        vols.add('trusty-amd64-maas-base')
+        self.assertEqual(inst._get_disks(), ['r', 's'])
+        config = inst._generate_user_data_parts()[0][1]
+        self.assertNotIn('aptcache', config)
+        inst.cleanup()
+
+    @patch.object(vm, 'log', MagicMock())
+    @patch.object(vm.Instance, 'assert_pool_exists', lambda *args: None)
+    @patch.object(vm.events, 'start_event_loop', lambda: False)
+    @patch.object(vm.CloudInstance, '_get_ssh_key', lambda *args: 'key')
+    @patch.object(vm, 'cfg')
+    @patch.object(vm.libvirt, 'open')
+    def test_fast_provision(self, mock_open, mock_cfg):
+        mock_cfg.remote = 'test:///fast-provision'
+        params = {'name': 'maas', 'interfaces': [],
+                  'network_config': 'auto lo'}
+        inst = vm.CloudInstance(params)
+        inst.inventory = MagicMock()
+        inst.inventory.volumes.return_value = set()
+        config = inst._generate_user_data_parts()[0][1]
+        self.assertIn('  - linux-image-extra-virtual', config)
+        self.assertNotIn('force-unsafe-io', config)
+        key = inst.golden_image_key
+
+        inst.fast_provision = True
+        config = inst._generate_user_data_parts()[0][1]
+        self.assertNotIn('linux-image-extra-virtual', config)
+        self.assertIn('  - maas-dns', config)
+        self.assertIn('        force-unsafe-io\n'
+                      '    path: /etc/dpkg/dpkg.cfg.d/maas-deployer-fast',
+                      config)
+        self.assertIn('APT::Periodic::Enable "0";', config)
+        self.assertNotIn('runcmd:', config)
+        parts = inst._generate_user_data_parts()
+        self.assertEqual([p[0] for p in parts],
+                         ['cloud-init.cfg', '00-fast-provision.sh',
+                          'config-maas.sh'])
+        self.assertIn('rm -f /etc/dpkg/dpkg.cfg.d/maas-deployer-fast',
+                      parts[1][1])
+        # Releases without systemd get unattended-upgrades back too
+        self.assertIn('service unattended-upgrades restart', parts[1][1])
+        bootcmd = yaml.safe_load(parts[0][1])['bootcmd']
+        self.assertIn('command -v systemctl', bootcmd[0][-1])
+
+        # The settings are removed before a golden image is captured
+        inst.golden_image = True
+        parts = [p[0] for p in inst._generate_user_data_parts()]
+        self.assertEqual(sorted(parts[1:]), parts[1:])
+        self.assertTrue(parts.index('00-fast-provision.sh') <
+                        parts.index('00-golden-image.sh'))
+        self.assertNotEqual(inst.golden_image_key, key)
+        inst.cleanup()
+
+    @patch.object(vm, 'log', MagicMock())
+    @patch.object(vm.Instance, 'assert_pool_exists', lambda *args: None)
+    @patch.object(vm.events, 'start_event_loop', lambda: False)
+    @patch.object(vm.CloudInstance, '_get_ssh_key', lambda *args: 'key')
+    @patch.object(vm.CloudInstance, '_create_base_volume')
+    @patch.object(vm, 'cfg')
+    @patch.object(vm.libvirt, 'open')
+    def test_golden_image(self, mock_open, mock_cfg, mock_create_base):
+        mock_cfg.remote = 'test:///golden-image'
+        params = {'name': 'maas', 'interfaces': [], 'release': 'trusty',
+                  'network_config': 'auto lo', 'golden_image': True,
+                  'apt_sources': ['ppa:maas/stable']}
+        inst = vm.CloudInstance(params)
+        inst.inventory = MagicMock()
+        inst.inventory.volumes.return_value = set()
+        key = inst.golden_image_key
+        self.assertEqual(inst.golden_image_volume,
+                         'trusty-amd64-maas-golden-%s' % (key))
+        other = vm.CloudInstance(dict(params, apt_sources=['ppa:maas/next']))
+        self.assertNotEqual(other.golden_image_key, key)
+        other.cleanup()
+
+        # Without a golden image the packages are installed and the root
+        # disk captured before MAAS is configured.
+        parts = inst._generate_user_data_parts()
+        self.assertEqual([p[0] for p in parts],
+                         ['cloud-init.cfg', '00-golden-image.sh',
+                          'config-maas.sh'])
+        self.assertIn('  - maas-dns', parts[0][1])
+        self.assertNotIn(vm.cloudinit.CLONE_START_MESSAGE, parts[0][1])
+        self.assertEqual(inst._generate_meta_data(), 'instance-id: maas')
+        self.assertEqual(inst.ensure_base_volume(), 'trusty-amd64-base')
+
+        # With one it is cloned and the packages are not installed again.
+        inst._base_volume = None
+        inst.inventory.volumes.return_value = set([inst.golden_image_volume])
+        parts = inst._generate_user_data_parts()
+        self.assertEqual([p[0] for p in parts],
+                         ['cloud-init.cfg', '00-reset-maas.sh',
+                          'config-maas.sh'])
+        self.assertNotIn('packages:', parts[0][1])
+        # The output of the run the image was captured from is cleared
+        config = yaml.safe_load(parts[0][1])
+        self.assertEqual(config['bootcmd'][0][-1],
+                         ': > /var/log/cloud-init-output.log; echo "%s '
+                         '$INSTANCE_ID"' % (vm.cloudinit.CLONE_START_MESSAGE))
+        # The MAAS controller in the image is given its own address
+        self.assertIn('maas-region-admin local_config_set '
+                      '--maas-url="$maas_url"', parts[1][1])
+        self.assertIn('sudo -u postgres psql -q -d maasdb', parts[1][1])
+        self.assertEqual(inst._generate_meta_data(),
+                         'instance-id: maas-golden-%s' % (key))
+        self.assertEqual(inst.ensure_base_volume(), inst.golden_image_volume)
+        mock_create_base.assert_called_once_with('trusty-amd64-base', set())
+        inst.cleanup()
+
+    @patch.object(vm, 'log', MagicMock())
+    @patch.object(vm.Instance, 'assert_pool_exists', lambda *args: None)
+    @patch.object(vm.events, 'start_event_loop', lambda: False)
+    @patch.object(vm.CloudInstance, 'create_seed_image')
+    @patch.object(vm.CloudInstance, '_create_base_volume')
+    @patch.object(vm, 'cfg')
+    @patch.object(vm.libvirt, 'open')
+    def test_prefetch(self, mock_open, mock_cfg, mock_create_base,
+                      mock_create_seed):
+        mock_cfg.remote = 'test:///prefetch'
+        mock_create_seed.return_value = 'path=seed'
+        inst = vm.CloudInstance({'name': 'maas', 'release': 'trusty',
+                                 'arch': 'amd64', 'interfaces': []})
+        inst.inventory = MagicMock()
+        pool = ThreadPool(2)
+        results = inst.prefetch(pool)
+        pool.close()
+        self.assertEqual([r.get() for r in results],
+                         ['trusty-amd64-base', 'path=seed'])
+        pool.join()
+
+        # The volumes are only made once
+        self.assertEqual(inst.ensure_base_volume(), 'trusty-amd64-base')
+        self.assertEqual(inst.ensure_seed_image(), 'path=seed')
+        mock_create_base.assert_called_once_with('trusty-amd64-base',
+                                                 inst.inventory.volumes())
+        self.assertEqual(mock_create_seed.call_count, 1)
+        inst.cleanup()
+
+    @patch.object(vm, 'log', MagicMock())
+    @patch.object(vm.Instance, 'assert_pool_exists', lambda *args: None)
+    @patch.object(vm.events, 'start_event_loop', lambda: False)
+    @patch.object(vm.CloudInstance, '_get_ssh_key', lambda *args: 'key')
+    @patch.object(vm.CloudInstance, '_create_base_volume')
+    @patch.object(vm, 'cfg')
+    @patch.object(vm.libvirt, 'open')
+    def test_baked_image(self, mock_open, mock_cfg, mock_create_base):
+        mock_cfg.remote = 'test:///baked-image'
+        inst = vm.CloudInstance({'name': 'maas', 'interfaces': [],
+                                 'release': 'trusty',
+                                 'network_config': 'auto lo'})
+        inst.inventory = MagicMock()
+        inst.inventory.volumes.return_value = set(['trusty-amd64-maas-base'])
+        self.assertEqual(inst.ensure_base_volume(), 'trusty-amd64-maas-base')
+        self.assertFalse(mock_create_base.called)
+        parts = inst._generate_user_data_parts()
+        self.assertNotIn('packages:', parts[0][1])
+        # MAAS is given the address and identity of this controller, not
+        # those of the vm the image was baked on
+        self.assertEqual([p[0] for p in parts],
+                         ['cloud-init.cfg', '00-reset-maas.sh',
+                          'config-maas.sh'])
+        script = parts[1][1]
+        self.assertIn('maas_url="http://$address/MAAS"\n'
+                      'maas-region-admin local_config_set '
+                      '--maas-url="$maas_url"\n', script)
+        self.assertIn('sed -i "s|^MAAS_URL=.*|MAAS_URL=\\"$maas_url\\"|" '
+                      '$cluster_conf', script)
+        self.assertIn('uuid=$(uuidgen)\n    sed -i "s|^CLUSTER_UUID=.*|'
+                      'CLUSTER_UUID=\\"$uuid\\"|" $cluster_conf', script)
+        self.assertIn('service $service restart', script)
+        inst.cleanup()
+
+    @patch.object(vm, 'log', MagicMock())
+    @patch.object(vm.Instance, 'assert_pool_exists', lambda *args: None)
+    @patch.object(vm.events, 'start_event_loop', lambda: False)
+    @patch.object(vm.CloudInstance, '_get_ssh_key', lambda *args: 'key')
+    @patch.object(vm.CloudInstance, 'create')
+    @patch.object(vm.events, 'wait_for_domain_stopped')
+    @patch.object(vm, 'storage', MagicMock(FILE_POOL_TYPES=('dir',)))
+    @patch.object(vm, 'attach_console')
+    @patch.object(vm, 'execc')
+    @patch.object(vm, 'virsh')
+    @patch.object(vm, 'cfg')
+    @patch.object(vm.libvirt, 'open')
+    def test_bake(self, mock_open, mock_cfg, mock_virsh, mock_execc,
+                  mock_attach_console, mock_wait, mock_create):
+        mock_cfg.remote = 'test:///bake'
+        mock_cfg.use_existing = False
+        mock_cfg.force = False
+        conn = mock_open.return_value
+        conn.getURI.return_value = 'qemu:///system'
+        storage_pool = conn.storagePoolLookupByName.return_value
+        storage_pool.XMLDesc.return_value = "<pool type='dir'/>"
+        storage_pool.storageVolLookupByName.return_value.path.return_value = \
+            '/var/lib/libvirt/images/maas-bake-root.img'
+        monitor = mock_attach_console.return_value
+        monitor.seen = {vm.console.MARKER_BAKED: 1}
+        inst = vm.BakeInstance({'name': 'maas-bake', 'release': 'trusty',
+                                'interfaces': ['network=default'],
+                                'disk_size': '40G'})
+        self.assertEqual(inst.disk_size, vm.BAKE_DISK_SIZE)
+        inst.inventory = MagicMock()
+        vols = set(['trusty-amd64-maas-base'])
+        inst.inventory.volumes.return_value = vols
+        inst.inventory.has_domain.return_value = False
+        self.assertRaises(vm.MAASDeployerResourceAlreadyExists, inst.bake,
+                          60)
+
+        vols.clear()
+        vols.update(['maas-bake-root.img', 'maas-bake-seed.img'])
+        self.assertEqual(inst._get_installed_image(), None)
+        parts = inst._generate_user_data_parts()
+        self.assertEqual([p[0] for p in parts], ['bake.cfg', 'bake-clean.sh'])
+        self.assertIn('  - maas-dns', parts[0][1])
+        self.assertIn('power_state:', parts[0][1])
+        self.assertIn('for package in maas maas-dhcp maas-dns ', parts[1][1])
+        self.assertTrue(parts[1][1].endswith(
+            'echo "%s"' % (vm.cloudinit.BAKE_SUCCEEDED_MESSAGE)))
+
+        self.assertEqual(inst.bake(60), 'trusty-amd64-maas-base')
+        self.assertTrue(mock_create.called)
+        mock_wait.assert_called_once_with(inst.conn, 'maas-bake', 60)
+        # The root volume is converted so that its zeroed space is dropped
+        self.assertEqual(mock_execc.call_args[0][0], ['sh', '-s'])
+        self.assertIn('qemu-img convert -O qcow2 '
+                      '"/var/lib/libvirt/images/maas-bake-root.img" '
+                      '"/var/lib/libvirt/images/trusty-amd64-maas-base"',
+                      mock_execc.call_args[1]['stdin'])
+        inst.inventory.add_volume.assert_called_once_with(
+            'default', 'trusty-amd64-maas-base')
+        mock_virsh.assert_any_call(['vol-delete', '--pool', 'default',
+                                    'maas-bake-seed.img'])
+        monitor.stop.assert_called_once_with()
+
+        # It is cloned whole if qemu-img fails on a remote hypervisor
+        mock_execc.reset_mock()
+        mock_execc.side_effect = vm.CalledProcessError(1, 'ssh')
+        conn.getURI.return_value = 'qemu+ssh://ubuntu@10.0.0.1/system'
+        inst.inventory.add_volume.reset_mock()
+        vols.clear()
+        self.assertEqual(inst.bake(60), 'trusty-amd64-maas-base')
+        self.assertEqual(mock_execc.call_args[0][0],
+                         ['ssh', '-o', 'BatchMode=yes', 'ubuntu@10.0.0.1',
+                          'sh', '-s'])
+        mock_virsh.assert_any_call(['vol-clone', '--pool', 'default',
+                                    'maas-bake-root.img',
+                                    'trusty-amd64-maas-base'])
+
+        # Nothing is stored unless the packages were installed
+        inst.inventory.add_volume.reset_mock()
+        mock_virsh.reset_mock()
+        vols.clear()
+        vols.update(['maas-bake-root.img', 'maas-bake-seed.img'])
+        monitor.seen = {}
+        self.assertRaises(vm.MAASDeployerBakeError, inst.bake, 60)
+        self.assertFalse(inst.inventory.add_volume.called)
+        mock_virsh.assert_any_call(['vol-delete', '--pool', 'default',
+                                    'maas-bake-root.img'])
+        inst.cleanup()
+
+
+class TestEvents(unittest.TestCase):
+
+    @patch.object(events, 'events_available', lambda: False)
+    def test_wait_for_domain_stopped(self):
+        conn = MagicMock()
+        dom = conn.lookupByName.return_value
+        dom.isActive.side_effect = [1, 1, 0]
+        events.wait_for_domain_stopped(conn, 'maas-bake', 10,
+                                       poll_interval=0)
+        self.assertEqual(dom.isActive.call_count, 3)
+
+        dom.isActive.side_effect = None
+        dom.isActive.return_value = 1
+        self.assertRaises(exception.MAASDeployerTimeout,
+                          events.wait_for_domain_stopped, conn, 'maas-bake',
+                          0)
+
+
+class TestInventory(unittest.TestCase):
+
+    @patch.object(inventory, 'log', MagicMock())
+    def test_volumes(self):
+        conn = MagicMock()
+        pool = conn.storagePoolLookupByName.return_value
+        pool.listAllVolumes.return_value = _fake_libvirt_objects(['a', 'b'])
+        inv = inventory.Inventory(conn)
+        self.assertEqual(inv.volumes('default'), set(['a', 'b']))
+        inv.add_volume('default', 'c')
+        inv.remove_volume('default', 'a')
+        self.assertEqual(inv.volumes('default'), set(['b', 'c']))
+        self.assertEqual(pool.listAllVolumes.call_count, 1)
+
+        # A pool refresh event drops the cached volumes
+        pool.name.return_value = 'default'
+        inv._pool_refresh_event(conn, pool, None)
+        self.assertEqual(inv.volumes('default'), set(['a', 'b']))
+        self.assertEqual(pool.listAllVolumes.call_count, 2)
+
+    @patch.object(inventory, 'log', MagicMock())
+    def test_domain_events(self):
+        conn = MagicMock()
+        conn.listAllDomains.return_value = _fake_libvirt_objects(['maas'])
+        inv = inventory.Inventory(conn)
+        self.assertTrue(inv.has_domain('maas'))
+        dom = _fake_libvirt_objects(['node1'])[0]
+        defined = inventory.libvirt.VIR_DOMAIN_EVENT_DEFINED
+        inv._domain_event(conn, dom, defined, 0, None)
+        self.assertTrue(inv.has_domain('node1'))
+        inv.refresh()
+        self.assertFalse(inv.has_domain('node1'))
+        self.assertEqual(conn.listAllDomains.call_count, 2)
+
+    @patch.object(inventory, 'log', MagicMock())
+    @patch.object(inventory.events, 'events_available', lambda: True)
+    def test_close(self):
+        conn = MagicMock()
+        conn.domainEventRegisterAny.return_value = 1
+        conn.storagePoolEventRegisterAny.side_effect = [2, 3]
+        inv = inventory.Inventory(conn)
+        inv.close()
+        conn.domainEventDeregisterAny.assert_called_once_with(1)
+        self.assertEqual(conn.storagePoolEventDeregisterAny.call_args_list,
+                         [call(2), call(3)])
+
+        # Replacing the inventory of a uri closes the previous one
+        conn = MagicMock()
+        conn.domainEventRegisterAny.return_value = 4
+        inv = inventory.get_inventory(conn, 'qemu:///test')
+        self.assertIs(inventory.find_inventory(conn), inv)
+        self.assertIsNot(inventory.get_inventory(MagicMock(),
+                                                 'qemu:///test'), inv)
+        conn.domainEventDeregisterAny.assert_called_once_with(4)
+        inventory.discard_inventory('qemu:///test')
+        self.assertIsNone(inventory.find_inventory(conn))
+
+    @patch.object(inventory, 'log', MagicMock())
+    @patch.object(inventory.events, 'events_available', lambda: True)
+    def test_own_refresh(self):
+        conn = MagicMock()
+        pool = conn.storagePoolLookupByName.return_value
+        pool.name.return_value = 'default'
+        pool.listAllVolumes.return_value = _fake_libvirt_objects(['a'])
+        inv = inventory.Inventory(conn)
+        self.assertEqual(inv.volumes('default'), set(['a']))
+        inv.add_volume('default', 'b')
+
+        # The event of a refresh made by the deployer is ignored
+        with inv.own_refresh('default'):
+            pass
+
+        inv._pool_refresh_event(conn, pool, None)
+        self.assertEqual(inv.volumes('default'), set(['a', 'b']))
+
+        # as is a failed refresh, which sends none
+        try:
+            with inv.own_refresh('default'):
+                raise ValueError('busy')
+        except ValueError:
+            pass
+
+        inv._pool_refresh_event(conn, pool, None)
+        self.assertEqual(inv.volumes('default'), set(['a']))
+        self.assertEqual(pool.listAllVolumes.call_count, 2)
+
+    def test_domain_xml(self):
+        conn = MagicMock()
+        conn.lookupByName.return_value.XMLDesc.return_value = DOMAIN_XML
+        inv = inventory.Inventory(conn)
+        xml = inv.domain_xml('node1')
+        self.assertIs(inv.domain_xml('node1'), xml)
+        self.assertEqual(vm.MAC_ADDRESS_XPATH(xml),
+                         ['52:54:00:aa:bb:01', '52:54:00:aa:bb:02'])
+        # Re-defining the domain invalidates the cached XML
+        inv.add_domain('node1')
+        inv.domain_xml('node1')
+        self.assertEqual(conn.lookupByName.call_count, 2)
+
+
+class TestConsoleMonitor(unittest.TestCase):
+
+    @patch.object(console, 'log', MagicMock())
+    def test_feed(self):
+        monitor = console.ConsoleMonitor(MagicMock(), 'maas')
+        monitor.feed('[    0.000000] Linux ver')
+        self.assertEqual(monitor.seen.keys(), [])
+        monitor.feed('sion 3.13.0-85-generic (buildd@lgw01-10)\r\n')
+        self.assertIn(console.MARKER_KERNEL, monitor.seen)
+        monitor.feed("Cloud-init v. 0.7.5 running 'init' at Mon, 11 May\r\n")
+        self.assertIn(console.MARKER_CLOUDINIT, monitor.seen)
+        monitor.feed('\r\nmaas-boot-vm-dc1 login: ')
+        self.assertIn(console.MARKER_LOGIN, monitor.seen)
+        self.assertNotIn(console.MARKER_FINAL_MESSAGE, monitor.seen)
+        self.assertEqual(monitor.wait_for(console.MARKER_KERNEL, 0),
+                         monitor.seen[console.MARKER_KERNEL])
+        self.assertIsNone(monitor.wait_for(console.MARKER_FINAL_MESSAGE, 0))
+
+
+class TestAddresses(unittest.TestCase):
+
+    @patch.object(addresses, 'log', MagicMock())
+    def test_addresses_from_leases(self):
+        ipv4 = addresses.libvirt.VIR_IP_ADDR_TYPE_IPV4
+        network = MagicMock()
+        network.DHCPLeases.return_value = [
+            {'mac': '52:54:00:aa:bb:03', 'ipaddr': '192.168.122.3',
+             'type': ipv4},
+            {'mac': '52:54:00:AA:BB:01', 'ipaddr': '192.168.122.2',
+             'type': ipv4},
+        ]
+        conn = MagicMock()
+        conn.listAllNetworks.return_value = [network]
+        self.assertEqual(addresses.addresses_from_leases(
+            conn, ['52:54:00:aa:bb:01']), ['192.168.122.2'])
+
+    @patch.object(addresses, 'log', MagicMock())
+    def test_discover_falls_back_to_arp(self):
+        conn = MagicMock()
+        conn.listAllNetworks.return_value = []
+        conn.lookupByName.return_value.interfaceAddresses.return_value = {}
+        with tempfile.NamedTemporaryFile() as arp:
+            arp.write('IP address       HW type     Flags       HW address'
+                      '            Mask     Device\n'
+                      '192.168.122.9    0x1         0x0         '
+                      '52:54:00:aa:bb:01     *        virbr0\n'
+                      '192.168.122.2    0x1         0x2         '
+                      '52:54:00:aa:bb:01     *        virbr0\n')
+            arp.flush()
+            with patch.object(addresses, 'PROC_NET_ARP', arp.name):
+                found = addresses.discover(conn, 'maas',
+                                           ['52:54:00:aa:bb:01'])
+
+        self.assertEqual(found, ['192.168.122.2'])
+        self.assertEqual(addresses.discover(conn, 'maas', []), [])
+
+
+class TestConnectionManager(unittest.TestCase):
+
+    @patch.object(connection, 'log', MagicMock())
+    @patch.object(connection.events, 'events_available', lambda: True)
+    @patch.object(connection.events, 'start_event_loop', lambda: True)
+    @patch.object(connection.libvirt, 'open')
+    def test_get(self, mock_open):
+        conns = [MagicMock(), MagicMock()]
+        mock_open.side_effect = conns
+        manager = connection.ConnectionManager()
+        self.assertIs(manager.get('qemu:///system'), conns[0])
+        self.assertIs(manager.get('qemu:///system'), conns[0])
+        conns[0].setKeepAlive.assert_called_once_with(
+            connection.KEEPALIVE_INTERVAL, connection.KEEPALIVE_COUNT)
+
+        # A dead connection is replaced
+        conns[0].isAlive.return_value = False
+        self.assertIs(manager.get('qemu:///system'), conns[1])
+        self.assertTrue(conns[0].close.called)
+
+        manager.close_all()
+        self.assertTrue(conns[1].close.called)
+        self.assertEqual(mock_open.call_count, 2)
+
+    @patch.object(connection, 'log', MagicMock())
+    @patch.object(connection.events, 'events_available', lambda: True)
+    @patch.object(connection.events, 'start_event_loop', lambda: True)
+    @patch.object(connection.libvirt, 'open')
+    def test_closed(self, mock_open):
+        conns = [MagicMock(), MagicMock()]
+        mock_open.side_effect = conns
+        manager = connection.ConnectionManager()
+        conn = manager.get('qemu:///system')
+        conn.registerCloseCallback.assert_called_once_with(manager._closed,
+                                                           'qemu:///system')
+        manager._closed(conn, 0, 'qemu:///system')
+        self.assertTrue(conn.unregisterCloseCallback.called)
+        self.assertTrue(conn.close.called)
+        self.assertIs(manager.get('qemu:///system'), conns[1])
+
+        # A stale callback leaves the current connection alone
+        manager._closed(conn, 0, 'qemu:///system')
+        self.assertFalse(conns[1].close.called)
@@ -0,0 +1,155 @@
+#
+# Copyright 2015, Canonical Ltd
+#
+# Discovery of the IP addresses of domains from libvirt DHCP leases, the
+# guest agent and the ARP table of the host.
+#
+
+import libvirt
+import logging
+import time
+
+from maas_deployer.vmaas.exception import MAASDeployerTimeout
+
+log = logging.getLogger('vmaas.main')
+
+PROC_NET_ARP = '/proc/net/arp'
+# ARP table entries with this flag set have been resolved.
+ATF_COMPLETE = 0x2
+
+
+def _normalize(macs):
+    return set(mac.lower() for mac in macs)
+
+
+def addresses_from_leases(conn, macs):
+    """Returns the addresses leased to macs by libvirt managed networks."""
+    macs = _normalize(macs)
+    addresses = []
+    try:
+        networks = conn.listAllNetworks(
+            libvirt.VIR_CONNECT_LIST_NETWORKS_ACTIVE)
+    except libvirt.libvirtError as e:
+        log.debug("Unable to list networks: %s", e)
+        return addresses
+
+    for network in networks:
+        try:
+            leases = network.DHCPLeases()
+        except libvirt.libvirtError as e:
+            log.debug("Unable to read DHCP leases of network '%s': %s",
+                      network.name(), e)
+            continue
+
+        for lease in leases:
+            if (lease.get('mac', '').lower() in macs and
+                    lease.get('type') == libvirt.VIR_IP_ADDR_TYPE_IPV4):
+                addresses.append(lease['ipaddr'])
+
+    return addresses
+
+
+def addresses_from_domain(conn, name, macs, source):
+    """
+    Returns the addresses of the domain interfaces with the given macs as
+    reported by libvirt from the given source (one of the
+    VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_* constants).
+    """
+    macs = _normalize(macs)
+    addresses = []
+    try:
+        dom = conn.lookupByName(name)
+        ifaces = dom.interfaceAddresses(source)
+    except libvirt.libvirtError as e:
+        log.debug("Unable to get interface addresses of domain '%s' "
+                  "(source=%s): %s", name, source, e)
+        return addresses
+
+    for iface in (ifaces or {}).values():
+        if (iface.get('hwaddr') or '').lower() not in macs:
+            continue
+
+        for addr in iface.get('addrs') or []:
+            if (addr.get('type') == libvirt.VIR_IP_ADDR_TYPE_IPV4 and
+                    not addr['addr'].startswith('127.')):
+                addresses.append(addr['addr'])
+
+    return addresses
+
+
+def addresses_from_arp(macs):
+    """Returns the addresses of macs in the ARP table of this host."""
+    macs = _normalize(macs)
+    addresses = []
+    try:
+        with open(PROC_NET_ARP) as fd:
+            lines = fd.readlines()[1:]
+    except IOError as e:
+        log.debug("Unable to read ARP table: %s", e)
+        return addresses
+
+    # IP address, HW type, Flags, HW address, Mask, Device
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 4:
+            continue
+
+        if (fields[3].lower() in macs and
+                int(fields[2], 16) & ATF_COMPLETE):
+            addresses.append(fields[0])
+
+    return addresses
+
+
+def discover(conn, name, macs):
+    """
+    Returns the IPv4 addresses of the named domain.
+
+    The DHCP leases of libvirt networks are checked first, then the addresses
+    libvirt knows of for the domain itself (from leases and then the guest
+    agent) and finally the ARP table of this host, which is only of use when
+    the hypervisor is local and the domain has recently been in contact.
+    """
+    if not macs:
+        return []
+
+    sources = [
+        ('dhcp-leases', lambda: addresses_from_leases(conn, macs)),
+        ('domain-lease', lambda: addresses_from_domain(
+            conn, name, macs,
+            libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE)),
+        ('guest-agent', lambda: addresses_from_domain(
+            conn, name, macs,
+            libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT)),
+        ('arp', lambda: addresses_from_arp(macs)),
+    ]
+    for source, lookup in sources:
+        addresses = lookup()
+        if addresses:
+            log.debug("Domain '%s' has address(es) %s (from %s)", name,
+                      ','.join(addresses), source)
+            return addresses
+
+    return []
+
+
+def wait_for_address(conn, name, macs, timeout, poll_interval=2):
+    """
+    Waits for an IPv4 address of the named domain to become known.
+
+    :returns: the first address found
+    :raises: MAASDeployerTimeout if no address is found within timeout
+             seconds.
+    """
+    deadline = time.time() + timeout
+    while True:
+        addresses = discover(conn, name, macs)
+        if addresses:
+            return addresses[0]
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise MAASDeployerTimeout("No IP address found for domain '%s' "
+                                      "within %ss" % (name, timeout))
+
+        time.sleep(min(poll_interval, remaining))
@@ -0,0 +1,289 @@
+#
+# Copyright 2015, Canonical Ltd
+#
+# Incremental parsing of the cloud-init output log of the MAAS controller
+# used to report install progress and per-stage timing.
+#
+
+import collections
+import json
+import logging
+import os
+import re
+import time
+
+from maas_deployer.vmaas.util import CACHE_DIR
+
+log = logging.getLogger('vmaas.main')
+
+CLOUDINIT_OUTPUT_LOG = '/var/log/cloud-init-output.log'
+# Durations of the last cloud-init run of the MAAS controller by
+# provisioning profile, used to compare the profiles.
+TIMINGS_HISTORY = os.path.join(CACHE_DIR, 'cloud-init-timings.json')
+FINAL_MESSAGE = 'MAAS controller is now configured'
+# Written by the golden-image.sh script once the packages are installed.
+GOLDEN_IMAGE_READY_MESSAGE = 'maas-deployer: ready for golden image capture'
+# Written by the bake-clean.sh script once the packages of a baked image
+# have been found installed and the image cleaned.
+BAKE_SUCCEEDED_MESSAGE = 'maas-deployer: MAAS base image baked'
+# Written, followed by the instance id, on a MAAS controller cloned from a
+# golden or baked image once the output of the run the image was captured
+# from has been cleared (see the bootcmd of cloud-init.cfg).
+CLONE_START_MESSAGE = 'maas-deployer: cloud-init output of instance'
+
+# Stages of the MAAS controller install, in the order they normally occur.
+STAGE_BOOT = 'boot'
+STAGE_APT_UPDATE = 'apt-update'
+STAGE_DOWNLOAD = 'download'
+STAGE_UNPACK = 'unpack'
+STAGE_SETUP = 'setup'
+STAGE_CONFIG_MAAS = 'config-maas'
+
+# Package index fetches e.g.
+#   Get:1 http://archive.ubuntu.com trusty InRelease [65.9 kB]
+#   Hit http://ppa.launchpad.net trusty/main amd64 Packages
+RE_APT_INDEX = re.compile(r'^(Hit|Get|Ign|Err)(:\d+)? \S+ .*\b'
+                          r'(InRelease|Release(\.gpg)?|Packages|Sources|'
+                          r'Translation-\S+|Contents-\S+)\b')
+# Package downloads e.g.
+#   Get:12 http://archive.ubuntu.com/ubuntu/ trusty/main jq amd64 1.3-1 [82 kB]
+#   Get:3 http://archive.ubuntu.com/ubuntu xenial/main amd64 jq amd64 1.5 [..]
+RE_APT_GET = re.compile(r'^Get:\d+ \S+ \S+ (\S+ )?(?P<pkg>\S+) \S+ \S+ \[')
+RE_APT_FETCHED = re.compile(r'^Fetched .* in ')
+RE_UNPACK = re.compile(r'^Unpacking (?P<pkg>[^ :]+)')
+RE_SETUP = re.compile(r'^Setting up (?P<pkg>[^ :]+)')
+# config-maas.sh is run with 'bash -x' so each command it runs is traced.
+RE_TRACE = re.compile(r'^\+ (?P<cmd>.+)$')
+RE_APIKEY = re.compile(r'^\+ apikey=(?P<key>\S+)')
+RE_SCRIPT_FAILED = re.compile(r'(Failed running|failed to run) ')
+
+
+def _step_name(cmd):
+    """Returns a short name for a traced shell command."""
+    words = [w for w in cmd.split() if w != 'sudo']
+    return ' '.join(words[:2])
+
+
+class CloudInitProgress(object):
+    """
+    Tracks the progress of cloud-init on the MAAS controller by parsing its
+    output log line by line.
+
+    Each stage of the install (see STAGE_*) and each item within a stage
+    (a package being unpacked or set up, a step of config-maas.sh) is
+    timed from the first line that mentions it until the next one starts.
+
+    If start_message is given the lines before the first one containing it,
+    left from an earlier run, are ignored.
+    """
+
+    def __init__(self, final_message=FINAL_MESSAGE, clock=time.time,
+                 start_message=None):
+        self.final_message = final_message
+        self.start_message = start_message
+        self.clock = clock
+        self.started = clock()
+        self.finished = False
+        self.golden_image_ready = False
+        self.api_key = None
+        self.errors = []
+        self.stage = None
+        self.item = None
+        # Completed stages and items as lists of (name, seconds). Stages may
+        # occur more than once e.g. apt alternates between unpack and setup.
+        self.stages = []
+        self.items = []
+        self.downloaded = 0
+        self.unpacked = 0
+        self.setup = 0
+        self._stage_start = None
+        self._item_start = None
+
+    def _start_stage(self, stage, now):
+        if stage == self.stage:
+            return
+
+        self._end_item(now)
+        if self.stage:
+            duration = now - self._stage_start
+            self.stages.append((self.stage, duration))
+            log.debug("cloud-init stage '%s' took %.1fs", self.stage,
+                      duration)
+
+        self.stage = stage
+        self._stage_start = now
+
+    def _start_item(self, item, now):
+        if item == self.item:
+            return
+
+        self._end_item(now)
+        self.item = item
+        self._item_start = now
+
+    def _end_item(self, now):
+        if self.item:
+            self.items.append(((self.stage, self.item),
+                               now - self._item_start))
+        self.item = None
+
+    def feed(self, line):
+        """
+        Processes a single line of cloud-init output.
+
+        :returns: True once the final message has been seen.
+        """
+        now = self.clock()
+        line = line.strip()
+        if not line:
+            return self.finished
+
+        if self.start_message:
+            if self.start_message in line:
+                self.start_message = None
+                self.started = now
+
+            return self.finished
+
+        if self.stage is None:
+            self._start_stage(STAGE_BOOT, self.started)
+
+        if RE_APT_INDEX.match(line):
+            self._start_stage(STAGE_APT_UPDATE, now)
+            return self.finished
+
+        m = RE_APT_GET.match(line)
+        if m:
+            self._start_stage(STAGE_DOWNLOAD, now)
+            self._start_item(m.group('pkg'), now)
+            self.downloaded += 1
+            return self.finished
+
+        if RE_APT_FETCHED.match(line):
+            self._end_item(now)
+            return self.finished
+
+        m = RE_UNPACK.match(line)
+        if m:
+            self._start_stage(STAGE_UNPACK, now)
+            self._start_item(m.group('pkg'), now)
+            self.unpacked += 1
+            return self.finished
+
+        m = RE_SETUP.match(line)
+        if m:
+            self._start_stage(STAGE_SETUP, now)
+            self._start_item(m.group('pkg'), now)
+            self.setup += 1
+            return self.finished
+
+        m = RE_APIKEY.match(line)
+        if m:
+            self.api_key = m.group('key')
+
+        m = RE_TRACE.match(line)
+        if m:
+            self._start_stage(STAGE_CONFIG_MAAS, now)
+            self._start_item(_step_name(m.group('cmd')), now)
+            return self.finished
+
+        if RE_SCRIPT_FAILED.search(line):
+            log.warning("cloud-init: %s", line)
+            self.errors.append(line)
+
+        if GOLDEN_IMAGE_READY_MESSAGE in line:
+            self._end_item(now)
+            self.golden_image_ready = True
+            return self.finished
+
+        if self.final_message in line:
+            self._start_stage(None, now)
+            self.finished = True
+
+        return self.finished
+
+    @property
+    def status(self):
+        """Returns a one line description of the current progress."""
+        if self.finished:
+            return 'done'
+
+        elapsed = self.clock() - (self._stage_start or self.started)
+        if self.stage == STAGE_DOWNLOAD:
+            detail = '%d packages' % (self.downloaded)
+        elif self.stage == STAGE_UNPACK:
+            detail = '%s (%d/%d)' % (self.item, self.unpacked,
+                                     self.downloaded)
+        elif self.stage == STAGE_SETUP:
+            detail = '%s (%d/%d)' % (self.item, self.setup, self.unpacked)
+        elif self.item:
+            detail = self.item
+        else:
+            return '%s [%ds]' % (self.stage, elapsed)
+
+        return '%s %s [%ds]' % (self.stage, detail, elapsed)
+
+    def durations(self):
+        """Returns the total time spent in each stage."""
+        totals = collections.OrderedDict()
+        for stage, duration in self.stages:
+            totals[stage] = totals.get(stage, 0) + duration
+
+        return totals
+
+    def slowest(self, count=5):
+        """Returns the slowest items as a list of ((stage, item), seconds)."""
+        return sorted(self.items, key=lambda i: i[1], reverse=True)[:count]
+
+    def log_summary(self):
+        durations = self.durations()
+        log.info("cloud-init completed in %.1fs", sum(durations.values()))
+        for stage, duration in durations.iteritems():
+            log.info("  %-12s %7.1fs", stage, duration)
+
+        for (stage, item), duration in self.slowest():
+            log.info("  slowest %s: '%s' took %.1fs", stage, item, duration)
+
+
+def _load_timings(path):
+    try:
+        with open(path) as fd:
+            return json.load(fd)
+    except (IOError, ValueError) as e:
+        log.debug("Unable to read cloud-init timings from %s: %s", path, e)
+        return {}
+
+
+def record_timings(profile, durations, path=None):
+    """
+    Records the stage durations of a cloud-init run of the MAAS controller
+    with the provisioning profile and logs how long it took compared to the
+    last run with each other profile.
+
+    :returns: the total duration of the run in seconds
+    """
+    path = path or TIMINGS_HISTORY
+    total = sum(durations.values())
+    history = _load_timings(path)
+    log.info("cloud-init took %.1fs with the '%s' profile", total, profile)
+    for other in sorted(history):
+        if other == profile:
+            continue
+
+        previous = history[other]['total']
+        log.info("  last run with the '%s' profile took %.1fs (%+.1fs, "
+                 "%+.0f%%)", other, previous, total - previous,
+                 (total - previous) * 100 / max(previous, 1))
+
+    history[profile] = {'total': total, 'stages': dict(durations),
+                        'time': time.time()}
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(path, 'w') as fd:
+            json.dump(history, fd, indent=2)
+    except (IOError, OSError) as e:
+        log.warning("Unable to save cloud-init timings to %s: %s", path, e)
+
+    return total
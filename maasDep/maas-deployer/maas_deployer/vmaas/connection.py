@@ -0,0 +1,117 @@
+#
+# Copyright 2015, Canonical Ltd
+#
+# Manages the libvirt connections shared by the deployer.
+#
+
+import atexit
+import libvirt
+import logging
+import threading
+
+from maas_deployer.vmaas import events, inventory
+from maas_deployer.vmaas.util import retry_on_exception
+
+log = logging.getLogger('vmaas.main')
+
+# Send a keepalive every KEEPALIVE_INTERVAL seconds and consider the
+# connection dead after KEEPALIVE_COUNT of them go unanswered.
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 6
+
+
+class ConnectionManager(object):
+    """
+    Hands out a single shared libvirt connection per URI.
+
+    libvirt connections are thread-safe so the same connection can be used
+    from any number of worker threads. Connections are kept alive with
+    libvirt keepalives, re-opened if they are found to be dead and closed
+    by close_all().
+    """
+
+    def __init__(self, keepalive_interval=KEEPALIVE_INTERVAL,
+                 keepalive_count=KEEPALIVE_COUNT):
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self._conns = {}
+        self._lock = threading.RLock()
+
+    def get(self, uri):
+        """Returns an open connection to the hypervisor at uri."""
+        with self._lock:
+            conn = self._conns.get(uri)
+            if conn is not None:
+                try:
+                    if conn.isAlive():
+                        return conn
+                except libvirt.libvirtError:
+                    pass
+
+                log.info("Connection to '%s' lost - reconnecting", uri)
+                self._discard(uri)
+
+            conn = self._open(uri)
+            self._conns[uri] = conn
+            return conn
+
+    @retry_on_exception(max_retries=3, exc_tuple=[libvirt.libvirtError])
+    def _open(self, uri):
+        # The event loop needs to be running before the connection is opened
+        # for keepalives and events to work on it.
+        events.start_event_loop()
+        log.debug("Opening libvirt connection to '%s'", uri)
+        conn = libvirt.open(uri)
+        if events.events_available():
+            try:
+                conn.setKeepAlive(self.keepalive_interval,
+                                  self.keepalive_count)
+                conn.registerCloseCallback(self._closed, uri)
+            except libvirt.libvirtError as e:
+                log.debug("Unable to enable keepalive on '%s': %s", uri, e)
+
+        return conn
+
+    def _closed(self, conn, reason, uri):
+        # The connection still needs to be closed to release it along with
+        # the close callback, which holds a reference to it.
+        log.debug("Connection to '%s' closed (reason=%s)", uri, reason)
+        with self._lock:
+            if self._conns.get(uri) is conn:
+                self._discard(uri)
+
+    def _discard(self, uri):
+        conn = self._conns.pop(uri, None)
+        if conn is None:
+            return
+
+        inventory.discard_inventory(uri)
+        try:
+            conn.unregisterCloseCallback()
+        except libvirt.libvirtError:
+            pass
+
+        try:
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+
+    def close_all(self):
+        """Closes all connections."""
+        with self._lock:
+            for uri in self._conns.keys():
+                log.debug("Closing libvirt connection to '%s'", uri)
+                self._discard(uri)
+
+
+_manager = ConnectionManager()
+atexit.register(_manager.close_all)
+
+
+def get_connection(uri):
+    """Returns the shared connection to the hypervisor at uri."""
+    return _manager.get(uri)
+
+
+def close_all():
+    _manager.close_all()
@@ -0,0 +1,144 @@
+#
+# Copyright 2015, Canonical Ltd
+#
+# Monitors the serial console of a domain through the libvirt stream API.
+#
+
+import libvirt
+import logging
+import re
+import threading
+import time
+
+from maas_deployer.vmaas.cloudinit import (
+    BAKE_SUCCEEDED_MESSAGE,
+    FINAL_MESSAGE,
+)
+
+log = logging.getLogger('vmaas.main')
+
+MARKER_KERNEL = 'kernel'
+MARKER_CLOUDINIT_LOCAL = 'cloud-init-local'
+MARKER_CLOUDINIT = 'cloud-init'
+MARKER_CLOUDINIT_CONFIG = 'cloud-init-config'
+MARKER_CLOUDINIT_FINAL = 'cloud-init-final'
+MARKER_LOGIN = 'login'
+MARKER_FINAL_MESSAGE = 'final-message'
+MARKER_BAKED = 'baked'
+
+# Console output which marks the progress of the boot, in the order in which
+# it normally appears.
+MARKERS = [
+    (MARKER_KERNEL, re.compile(r'Linux version \d')),
+    (MARKER_CLOUDINIT_LOCAL, re.compile(r"Cloud-init v\. \S+ running "
+                                        r"'init-local'")),
+    (MARKER_CLOUDINIT, re.compile(r"Cloud-init v\. \S+ running 'init'")),
+    (MARKER_CLOUDINIT_CONFIG, re.compile(r"Cloud-init v\. \S+ running "
+                                         r"'modules:config'")),
+    (MARKER_CLOUDINIT_FINAL, re.compile(r"Cloud-init v\. \S+ running "
+                                        r"'modules:final'")),
+    (MARKER_LOGIN, re.compile(r'\S+ login: ')),
+    (MARKER_FINAL_MESSAGE, re.compile(re.escape(FINAL_MESSAGE))),
+    (MARKER_BAKED, re.compile(re.escape(BAKE_SUCCEEDED_MESSAGE))),
+]
+
+
+class ConsoleMonitor(object):
+    """
+    Attaches to the serial console of a domain, saves everything written to
+    it to a log file and records when each of the boot MARKERS is seen.
+    """
+
+    def __init__(self, conn, name, log_path=None):
+        self.conn = conn
+        self.name = name
+        self.log_path = log_path or '%s-console.log' % (name)
+        self.seen = {}
+        self._cond = threading.Condition()
+        self._stream = None
+        self._thread = None
+        self._buf = ''
+
+    def start(self):
+        """Opens the console stream and starts reading it in a thread."""
+        dom = self.conn.lookupByName(self.name)
+        self._stream = self.conn.newStream(0)
+        dom.openConsole(None, self._stream, libvirt.VIR_DOMAIN_CONSOLE_FORCE)
+        log.debug("Attached to console of domain '%s' - logging to %s",
+                  self.name, self.log_path)
+        self._thread = threading.Thread(target=self._read_console,
+                                        name='console-%s' % (self.name))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        stream = self._stream
+        self._stream = None
+        if stream:
+            try:
+                stream.abort()
+            except libvirt.libvirtError:
+                pass
+
+    def _read_console(self):
+        with open(self.log_path, 'a') as fd:
+            while self._stream:
+                try:
+                    data = self._stream.recv(4096)
+                except libvirt.libvirtError as e:
+                    if self._stream:
+                        log.debug("Console of domain '%s' closed: %s",
+                                  self.name, e)
+                    break
+
+                if not data:
+                    break
+
+                fd.write(data)
+                fd.flush()
+                self.feed(data)
+
+        with self._cond:
+            self._cond.notify_all()
+
+    def feed(self, data):
+        """Processes console output, recording any markers seen."""
+        lines = (self._buf + data).split('\n')
+        self._buf = lines.pop()
+        for line in lines:
+            self._check_markers(line.rstrip('\r'))
+
+        # Login prompts are not newline terminated.
+        self._check_markers(self._buf)
+
+    def _check_markers(self, line):
+        for marker, regex in MARKERS:
+            if marker not in self.seen and regex.search(line):
+                log.debug("Console marker '%s' seen on domain '%s'", marker,
+                          self.name)
+                with self._cond:
+                    self.seen[marker] = time.time()
+                    self._cond.notify_all()
+
+    @property
+    def attached(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def wait_for(self, marker, timeout):
+        """
+        Waits for a marker to appear on the console.
+
+        :returns: the time the marker was seen or None if it was not seen
+                  within timeout seconds or the console was closed.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while marker not in self.seen:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.attached:
+                    return None
+
+                self._cond.wait(min(remaining, 5))
+
+            return self.seen[marker]
@@ -0,0 +1,399 @@
+#
+# Copyright 2015, Canonical Ltd
+#
+# Fetching and verification of cloud images.
+#
+
+import hashlib
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import urllib2
+import urlparse
+
+from multiprocessing.pool import ThreadPool
+
+import maas_deployer.vmaas.template as template
+
+from maas_deployer.vmaas.exception import MAASDeployerDownloadError
+from maas_deployer.vmaas.util import execc, parse_size
+
+log = logging.getLogger('vmaas.main')
+
+# Name of the checksum file published alongside cloud images.
+SHA256SUMS = 'SHA256SUMS'
+
+# Number of parallel connections used to download a file.
+DOWNLOAD_CONNECTIONS = 4
+# Size of the ranges of a file fetched by each request.
+DOWNLOAD_CHUNK_SIZE = 8 << 20
+# Size of the blocks read from responses.
+DOWNLOAD_BLOCK_SIZE = 64 << 10
+DOWNLOAD_TIMEOUT = 30
+# Number of times each url is tried for a range before giving up.
+DOWNLOAD_RETRIES = 3
+
+# Errors on which a request is retried.
+DOWNLOAD_ERRORS = (urllib2.URLError, IOError, socket.timeout, ValueError)
+
+
+def get_checksum(url, timeout=30):
+    """
+    Returns the sha256 checksum of the file at url from the SHA256SUMS file
+    published in the same directory, or None if it cannot be found.
+    """
+    base, filename = url.rsplit('/', 1)
+    sums_url = '%s/%s' % (base, SHA256SUMS)
+    try:
+        sums = urllib2.urlopen(sums_url, timeout=timeout).read()
+    except DOWNLOAD_ERRORS as e:
+        log.warning("Unable to fetch checksums from %s: %s", sums_url, e)
+        return None
+
+    for line in sums.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[1].lstrip('*') == filename:
+            return fields[0]
+
+    log.warning("No checksum for %s found in %s", filename, sums_url)
+    return None
+
+
+def parse_rate(rate):
+    """
+    Returns a rate given as a number of bytes per second with an optional
+    K, M or G suffix e.g. '10M' as a number of bytes per second.
+    """
+    return parse_size(rate)
+
+
+def sha256sum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for block in iter(lambda: fd.read(1 << 20), ''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+class RateLimiter(object):
+    """
+    Token bucket limiting the combined rate at which a number of threads
+    consume bytes to rate bytes per second.
+    """
+
+    def __init__(self, rate, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = max(self.rate, DOWNLOAD_BLOCK_SIZE)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.capacity
+        self.last = clock()
+        self._lock = threading.Lock()
+
+    def consume(self, count):
+        """Takes count bytes from the bucket, waiting until they are due."""
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= count
+            wait = -self.tokens / self.rate
+
+        if wait > 0:
+            self.sleep(wait)
+
+
+class Downloader(object):
+    """
+    Downloads a file over HTTP using a number of parallel range requests.
+
+    The file is fetched into dest.part in chunks of chunk_size and the chunks
+    completed are recorded in dest.state so an interrupted download resumes
+    where it stopped. Chunks are spread over the urls, which should all be
+    mirrors of the same file, and a failed chunk is retried on the next
+    url. If the server does not support range requests the file is
+    fetched in a single stream instead.
+
+    Once complete the file is verified against sha256, if given, and moved
+    to dest.
+    """
+
+    def __init__(self, urls, dest, sha256=None,
+                 connections=DOWNLOAD_CONNECTIONS,
+                 chunk_size=DOWNLOAD_CHUNK_SIZE, max_rate=None,
+                 timeout=DOWNLOAD_TIMEOUT, retries=DOWNLOAD_RETRIES):
+        if isinstance(urls, basestring):
+            urls = [urls]
+
+        self.urls = list(urls)
+        self.dest = dest
+        self.part = '%s.part' % (dest)
+        self.state_file = '%s.state' % (dest)
+        self.sha256 = sha256
+        self.connections = max(int(connections), 1)
+        self.chunk_size = chunk_size
+        self.limiter = RateLimiter(max_rate) if max_rate else None
+        self.timeout = timeout
+        self.retries = retries
+        self.received = 0
+        self._lock = threading.Lock()
+        self._start = None
+
+    def _open(self, url, start=None, end=None):
+        req = urllib2.Request(url)
+        if start is not None:
+            req.add_header('Range', 'bytes=%d-%d' % (start, end))
+
+        return urllib2.urlopen(req, timeout=self.timeout)
+
+    def _probe(self):
+        """
+        Returns the url, size and whether range requests are supported for
+        the first of the urls which responds.
+        """
+        for url in self.urls:
+            try:
+                resp = self._open(url, 0, 0)
+            except DOWNLOAD_ERRORS as e:
+                log.warning("Unable to reach %s: %s", url, e)
+                continue
+
+            try:
+                content_range = resp.info().getheader('Content-Range')
+                if resp.getcode() == 206 and content_range:
+                    total = content_range.rsplit('/', 1)[-1]
+                    if total.isdigit():
+                        return (url, int(total), True)
+
+                length = resp.info().getheader('Content-Length')
+                size = int(length) if length and resp.getcode() == 200 \
+                    else None
+                return (url, size, False)
+            finally:
+                resp.close()
+
+        raise MAASDeployerDownloadError("Unable to download from any of %s" %
+                                        (', '.join(self.urls)))
+
+    def _load_state(self, size):
+        """Returns the set of chunks already downloaded."""
+        try:
+            with open(self.state_file) as fd:
+                state = json.load(fd)
+        except (IOError, ValueError):
+            return set()
+
+        if (state.get('size') != size or
+                state.get('chunk_size') != self.chunk_size or
+                not os.path.exists(self.part)):
+            return set()
+
+        return set(state.get('done', []))
+
+    def _save_state(self, size, done):
+        tmp = '%s.tmp' % (self.state_file)
+        with open(tmp, 'w') as fd:
+            json.dump({'size': size, 'chunk_size': self.chunk_size,
+                       'done': sorted(done)}, fd)
+
+        os.rename(tmp, self.state_file)
+
+    def _copy(self, resp, fd, length=None):
+        """Copies length bytes (or everything) from resp to fd."""
+        while length is None or length > 0:
+            count = DOWNLOAD_BLOCK_SIZE
+            if length is not None:
+                count = min(count, length)
+
+            data = resp.read(count)
+            if not data:
+                if length is not None:
+                    raise IOError("Connection closed with %d bytes to go" %
+                                  (length))
+
+                return
+
+            if self.limiter:
+                self.limiter.consume(len(data))
+
+            fd.write(data)
+            with self._lock:
+                self.received += len(data)
+
+            if length is not None:
+                length -= len(data)
+
+    def _fetch_range(self, url, start, end):
+        resp = self._open(url, start, end)
+        try:
+            if resp.getcode() != 206:
+                raise IOError("%s ignored the range request" % (url))
+
+            with open(self.part, 'r+b') as fd:
+                fd.seek(start)
+                self._copy(resp, fd, end - start + 1)
+        finally:
+            resp.close()
+
+    def _fetch_chunk(self, chunk):
+        index, size = chunk
+        start = index * self.chunk_size
+        end = min(start + self.chunk_size, size) - 1
+        attempts = self.retries * len(self.urls)
+        for attempt in xrange(attempts):
+            url = self.urls[(index + attempt) % len(self.urls)]
+            try:
+                self._fetch_range(url, start, end)
+                return index
+            except DOWNLOAD_ERRORS as e:
+                log.debug("Fetching bytes %d-%d from %s failed: %s", start,
+                          end, url, e)
+
+        raise MAASDeployerDownloadError("Unable to fetch bytes %d-%d of %s" %
+                                        (start, end, self.dest))
+
+    def _fetch_ranges(self, size):
+        done = self._load_state(size)
+        if done:
+            log.info("Resuming download of %s (%d%% done)", self.dest,
+                     min(len(done) * self.chunk_size, size) * 100 / size)
+        else:
+            with open(self.part, 'wb') as fd:
+                fd.truncate(size)
+
+        chunks = (size + self.chunk_size - 1) / self.chunk_size
+        pending = [(i, size) for i in xrange(chunks) if i not in done]
+        pool = ThreadPool(min(self.connections, max(len(pending), 1)))
+        try:
+            for index in pool.imap_unordered(self._fetch_chunk, pending):
+                done.add(index)
+                self._save_state(size, done)
+                self._report(min(len(done) * self.chunk_size, size), size)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _fetch_single(self, url):
+        for attempt in xrange(self.retries):
+            try:
+                resp = self._open(url)
+                try:
+                    with open(self.part, 'wb') as fd:
+                        self._copy(resp, fd)
+                finally:
+                    resp.close()
+
+                return
+            except DOWNLOAD_ERRORS as e:
+                log.debug("Downloading %s failed: %s", url, e)
+
+        raise MAASDeployerDownloadError("Unable to download %s" % (url))
+
+    def _report(self, done, size):
+        elapsed = max(time.time() - self._start, 0.001)
+        sys.stdout.write(" Downloading %s ... %3d%% (%.1f MiB/s)" %
+                         (os.path.basename(self.dest),
+                          done * 100 / max(size, 1),
+                          self.received / elapsed / (1 << 20)))
+        sys.stdout.flush()
+        sys.stdout.write('\r')
+
+    def _verify(self):
+        if not self.sha256:
+            return
+
+        digest = sha256sum(self.part)
+        if digest != self.sha256:
+            os.remove(self.part)
+            if os.path.exists(self.state_file):
+                os.remove(self.state_file)
+
+            raise MAASDeployerDownloadError("Checksum of %s is %s, expected "
+                                            "%s" % (self.dest, digest,
+                                                    self.sha256))
+
+    def run(self):
+        """Downloads the file and returns the path it was saved to."""
+        self._start = time.time()
+        url, size, ranges = self._probe()
+        if ranges:
+            self._fetch_ranges(size)
+        else:
+            log.info("%s does not support range requests - downloading in a "
+                     "single stream", url)
+            self._fetch_single(url)
+
+        sys.stdout.write('\r\n')
+        self._verify()
+        os.rename(self.part, self.dest)
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+
+        elapsed = max(time.time() - self._start, 0.001)
+        log.info("Downloaded %s: %.1f MiB in %.1fs (%.1f MiB/s)", self.dest,
+                 self.received / float(1 << 20), elapsed,
+                 self.received / elapsed / (1 << 20))
+        return self.dest
+
+
+def is_ssh_uri(uri):
+    """Returns True if the libvirt uri connects to its host over ssh."""
+    parsed = urlparse.urlparse(uri)
+    return parsed.scheme.endswith('+ssh') and bool(parsed.hostname)
+
+
+def get_hypervisor_ssh_cmd(uri):
+    """Returns the ssh command to log into the host of a qemu+ssh uri."""
+    parsed = urlparse.urlparse(uri)
+    cmd = ['ssh', '-o', 'BatchMode=yes']
+    if parsed.port:
+        cmd += ['-p', str(parsed.port)]
+
+    keyfile = urlparse.parse_qs(parsed.query).get('keyfile')
+    if keyfile:
+        cmd += ['-i', keyfile[0]]
+
+    if parsed.username:
+        cmd.append('%s@%s' % (parsed.username, parsed.hostname))
+    else:
+        cmd.append(parsed.hostname)
+
+    return cmd
+
+
+def get_hypervisor_local_uri(uri):
+    """Returns the uri used on the hypervisor host itself for a remote uri
+    e.g. qemu:///system for qemu+ssh://host/system."""
+    parsed = urlparse.urlparse(uri)
+    return '%s://%s' % (parsed.scheme.split('+')[0], parsed.path)
+
+
+def fetch_on_hypervisor(uri, url, pool, name, sha256=None):
+    """
+    Has the host of a qemu+ssh uri download the image at url itself, or use
+    a copy already cached on the host, verify its checksum and upload it into
+    the named volume of the storage pool.
+
+    Only the url and checksum are sent from here. If no checksum is given it
+    is looked up from the SHA256SUMS file alongside the image.
+    """
+    if sha256 is None:
+        sha256 = get_checksum(url)
+
+    host = urlparse.urlparse(uri).hostname
+    script = template.load('fetch-image.sh', {
+        'url': url,
+        'filename': url.rsplit('/', 1)[-1],
+        'sha256': sha256,
+        'uri': get_hypervisor_local_uri(uri),
+        'pool': pool,
+        'name': name,
+    })
+    log.info("Fetching %s on hypervisor %s", url, host)
+    execc(get_hypervisor_ssh_cmd(uri) + ['sh', '-s'], stdin=script)
@@ -6,6 +6,7 @@
 
 import base64
 import copy
+import hashlib
 import itertools
 import json
 import logging
@@ -15,9 +16,14 @@ import tempfile
 import time
 import uuid
 
+from multiprocessing.pool import ThreadPool
 from subprocess import CalledProcessError
 
 from maas_deployer.vmaas import (
+    cloudinit,
+    console,
+    mirror,
+    proxy,
     vm,
     util,
     template,
@@ -25,6 +31,7 @@ from maas_deployer.vmaas import (
 from maas_deployer.vmaas.exception import (
     MAASDeployerClientError,
     MAASDeployerConfigError,
+    MAASDeployerTimeout,
     MAASDeployerValueError,
 )
 from maas_deployer.vmaas.maasclient import (
@@ -37,6 +44,45 @@ from maas_deployer.vmaas.maasclient.driver import Response
 
 log = logging.getLogger('vmaas.main')
 JUJU_ENV_YAML = 'environments.yaml'
+# Default number of seconds to wait for the MAAS vm to accept ssh logins.
+VM_READY_TIMEOUT = 900
+# Number of seconds to wait for the kernel to show up on the MAAS vm serial
+# console before falling back to probing the network only.
+CONSOLE_KERNEL_TIMEOUT = 60
+# Number of seconds without cloud-init output after which the serial console
+# of the MAAS vm is checked for the final message.
+CONSOLE_CHECK_INTERVAL = 5
+# Number of virtual node domains defined at once.
+NODE_DEFINE_WORKERS = 4
+# Default number of seconds to wait for the address of the MAAS vm to be
+# discovered when maas.ip_address is not specified.
+IP_DISCOVERY_TIMEOUT = 300
+# Default number of seconds to wait for the packages to be installed when
+# baking a MAAS base image.
+BAKE_TIMEOUT = 3600
+# Default interfaces of the vm baking a MAAS base image, which needs to reach
+# the package archives.
+BAKE_INTERFACES = ['network=default,model=virtio']
+# Number of workers preparing the volumes of the MAAS vm in the background.
+PREFETCH_WORKERS = 2
+# Cache of the boot resources exported from MAAS controllers (see
+# export_boot_resources()).
+BOOT_RESOURCES_CACHE_DIR = os.path.join(util.CACHE_DIR, 'boot-resources')
+# Tables of the region database holding the boot resources.
+BOOT_RESOURCES_TABLES = ['maasserver_largefile', 'maasserver_bootresource',
+                         'maasserver_bootresourceset',
+                         'maasserver_bootresourcefile']
+BOOT_RESOURCES_REMOTE_ARCHIVE = '/tmp/maas-deployer-boot-resources.tar'
+# Package whose version the boot resources cache is keyed on.
+MAAS_REGION_PACKAGE = 'maas-region-controller'
+# Architecture of the virtual nodes defined by the deployer.
+VIRTUAL_NODE_ARCHITECTURE = 'amd64/generic'
+# Release MAAS commissions and deploys nodes with unless configured.
+DEFAULT_DISTRO_SERIES = 'trusty'
+# Default number of seconds to wait for the boot images to be imported.
+IMPORT_TIMEOUT = 7200
+# Number of seconds between polls of the progress of importing boot images.
+IMPORT_POLL_INTERVAL = 5
 
 
 class DeploymentEngine(object):
@@ -46,6 +92,39 @@ class DeploymentEngine(object):
         self.env_name = env_name
         self.ip_addr = None
         self.api_key = None
+        self.maas_vm_created = None
+        self.maas_console = None
+        # Progress of cloud-init on the MAAS vm and the number of lines of its
+        # output processed, kept so that streaming can resume after a retry.
+        self.cloudinit_progress = None
+        self.cloudinit_lines_seen = 0
+        # The MAAS vm instance and the results of preparing its volumes in
+        # the background (see prefetch_maas_node()).
+        self.maas_node = None
+        self.maas_prefetch = []
+        self.golden_image_captured = False
+        # URL of the caching proxy on this host, if one is used.
+        self.caching_proxy_url = None
+        self.boot_resources_restored = False
+        # Version of the MAAS region controller package on the MAAS vm, which
+        # is read on first use (see _get_maas_version()).
+        self.maas_version = None
+        # Series of the Juju environment, if configured.
+        self.juju_series = None
+        # Names of the domains by the MAC addresses assigned to them, which
+        # is loaded from the hypervisor on first use (see _get_macs()).
+        self.used_macs = None
+        # Selections of the boot sources replaced by those of the first stage
+        # of a staged boot image import, by boot source id.
+        self.staged_selections = {}
+        # URL of the boot source mirror on this host, if one is used, and the
+        # results of updating it in the background with the selections of
+        # the first stage of a staged import and with all of them.
+        self.boot_source_mirror_url = None
+        self.boot_source_mirror_staged_sync = None
+        self.boot_source_mirror_sync = None
+        # Durations (in seconds) of the deployment phases that are measured.
+        self.timings = {}
 
     def deploy(self, target):
         """
@@ -58,44 +137,112 @@ class DeploymentEngine(object):
             log.warning("No MAAS cluster nodes configured")
             maas_config['nodes'] = nodes
 
-        juju_node = self.deploy_juju_bootstrap(config.get('juju-bootstrap'),
-                                               maas_config)
+        juju_params = config.get('juju-bootstrap')
+        self.juju_series = juju_params.get('series')
+
+        self.start_caching_proxy(maas_config)
+        self.start_boot_source_mirror(maas_config)
+
+        # Start fetching the cloud image and building the seed of the MAAS
+        # vm while the other nodes are defined.
+        self.prefetch_maas_node(maas_config)
+
+        # The MAC addresses of the nodes are known up front so their MAAS
+        # node records can be computed before their domains are defined,
+        # which is done in the background while the MAAS vm is built.
+        juju_node = self._get_node_params(juju_params, maas_config,
+                                          tags='bootstrap')
         nodes.append(juju_node)
+        pending = [(self.deploy_juju_bootstrap, (juju_params, juju_node))]
 
         # create extra VMs
-        for node in config.get('virtual-nodes', {}):
-            n = self.deploy_virtual_node(node, maas_config)
-            nodes.append(n)
+        for params in config.get('virtual-nodes', {}):
+            node = self._get_node_params(params, maas_config)
+            nodes.append(node)
+            pending.append((self.deploy_virtual_node, (params, node)))
+
+        pool = ThreadPool(NODE_DEFINE_WORKERS)
+        results = [pool.apply_async(deploy, args)
+                   for deploy, args in pending]
+        pool.close()
+        try:
+            self.deploy_maas_node(maas_config)
+
+            self.wait_for_maas_installation(maas_config)
+            self.configure_maas_virsh_control(maas_config)
+            self.api_key = self._get_api_key(maas_config)
+
+            api_url = 'http://{}/MAAS/api/1.0'.format(self.ip_addr)
+            client = MAASClient(api_url, self.api_key,
+                                ssh_user=maas_config['user'])
+
+            self.apply_maas_settings(client, maas_config)
+            # Restored boot resources only need verifying, so there is
+            # nothing to gain from importing them in stages.
+            staged = None
+            if not self.restore_boot_resources(maas_config):
+                staged = self.get_staged_selections(maas_config)
+
+            self.configure_boot_source(client, maas_config,
+                                       selections=staged)
+            self.wait_for_import_boot_images(client, maas_config)
+            background_import = None
+            if staged:
+                self.configure_boot_source(client, maas_config)
+                background_import = self.start_background_import(
+                    client, maas_config)
+            else:
+                self.export_boot_resources(maas_config)
 
-        self.deploy_maas_node(maas_config)
+            # All domains must be defined before the nodes are registered.
+            for result in results:
+                result.get()
+        finally:
+            pool.join()
 
-        self.wait_for_maas_installation(maas_config)
-        self.configure_maas_virsh_control(maas_config)
-        self.api_key = self._get_api_key(maas_config)
+        self.configure_maas(client, maas_config)
+        if background_import:
+            background_import.get()
+            self.export_boot_resources(maas_config)
 
-        api_url = 'http://{}/MAAS/api/1.0'.format(self.ip_addr)
-        client = MAASClient(api_url, self.api_key,
-                            ssh_user=maas_config['user'])
+    def bake(self, target):
+        """
+        Bakes a MAAS base image with the MAAS controller packages installed
+        for the maas node of the target, from which MAAS vms are then
+        created.
+        """
+        maas_config = self.config.get(target).get('maas')
+        params = dict(maas_config,
+                      name='%s-bake' % (maas_config['name']),
+                      interfaces=maas_config.get('bake_interfaces',
+                                                 BAKE_INTERFACES))
+        params['mac_addresses'] = self._get_macs(params)
+        with vm.BakeInstance(params) as instance:
+            instance.bake(maas_config.get('bake_timeout', BAKE_TIMEOUT))
+
+    def _get_macs(self, params):
+        """
+        Returns the MAC addresses of the interfaces of the domain described by
+        params, which are unique across the domains of the deployment and
+        those already defined on the hypervisor.
+        """
+        if self.used_macs is None:
+            self.used_macs = vm.get_domain_macs()
 
-        self.apply_maas_settings(client, maas_config)
-        self.configure_boot_source(client, maas_config)
-        self.wait_for_import_boot_images(client, maas_config)
-        self.configure_maas(client, maas_config)
+        return vm.get_interface_macs(self.env_name, params, self.used_macs)
 
-    def _get_node_params(self, node_domain, node_config, maas_config,
-                         tags=None):
+    def _get_node_params(self, node_config, maas_config, tags=None):
         """
-        Determines the mac address of the node machine specified.
+        Returns the MAAS node record of a virtual node.
 
-        :param node_domain: the juju bootstrap image domain
-        :param include_power: a boolean value of whether to include
-                              power parameters or not for virsh power
-                              control.
+        :param node_config: the config dict of the node
+        :param maas_config: the config dict for maas parameters
+        :param tags: the tags to give the node instead of those configured
         """
         node = {
-            'name': node_domain.name,
-            'architecture': 'amd64/generic',
-            'mac_addresses': [x for x in node_domain.mac_addresses],
+            'name': node_config['name'],
+            'architecture': VIRTUAL_NODE_ARCHITECTURE,
+            'mac_addresses': self._get_macs(node_config),
             'tags': tags if tags else node_config['tags'],
         }
 
@@ -105,7 +252,7 @@ class DeploymentEngine(object):
             node.update({
                 'power_type': 'virsh',
                 'power_parameters_power_address': uri,
-                'power_parameters_power_id': node_domain.name,
+                'power_parameters_power_id': node_config['name'],
             })
 
         sticky_cfg = node_config.get('sticky_ip_address')
@@ -115,35 +262,203 @@ class DeploymentEngine(object):
 
         return node
 
-    def deploy_juju_bootstrap(self, params, maas_config):
-        """Deploy the juju bootstrap node.
+    def _define_node(self, params, node):
+        """
+        Defines the domain of a virtual node with the MAC addresses of its
+        node record.
 
-        Returns Juju node params from YAML config.
+        If an existing domain is used instead, the node record is updated with
+        the MAC addresses it actually has.
         """
+        params = dict(params, mac_addresses=node['mac_addresses'])
+        with vm.Instance(params) as instance:
+            instance.netboot = True
+            instance.define()
+            macs = instance.mac_addresses
+
+        if macs and macs != node['mac_addresses']:
+            log.info("Domain '%s' already exists with MAC address(es) %s",
+                     node['name'], ','.join(macs))
+            node['mac_addresses'] = macs
+            if 'sticky_ip_address' in node:
+                node['sticky_ip_address']['mac_address'] = macs[0]
+
+    def deploy_juju_bootstrap(self, params, node):
+        """Deploy the juju bootstrap node."""
         log.debug("Creating Juju bootstrap vm.")
-        with vm.Instance(params) as juju_node:
-            juju_node.netboot = True
-            juju_node.define()
-            # Insert juju node information into the maas nodes list.
-            # This allows us to define it in maas.
-            return self._get_node_params(juju_node, params, maas_config,
-                                         tags='bootstrap')
-
-    def deploy_virtual_node(self, params, maas_config):
+        self._define_node(params, node)
+
+    def deploy_virtual_node(self, params, node):
         log.debug('Creating VM: %s' % params['name'])
-        with vm.Instance(params) as node:
-            node.netboot = True
-            node.define()
+        self._define_node(params, node)
 
-            return self._get_node_params(node, params, maas_config)
+    def start_caching_proxy(self, maas_config):
+        """
+        Starts the caching proxy on this host if one is configured and makes
+        it the apt proxy of the MAAS vm. It is also made the http_proxy of
+        MAAS (see configure_boot_source()) unless one is set explicitly.
+
+        :returns: the URL of the proxy or None
+        """
+        proxy_config = maas_config.get('caching_proxy')
+        if not proxy_config:
+            return None
+
+        if not isinstance(proxy_config, dict):
+            proxy_config = {}
+
+        port = proxy_config.get('port', proxy.PROXY_PORT)
+        cache_dir = os.path.expanduser(proxy_config.get(
+            'cache_dir', proxy.PROXY_CACHE_DIR))
+        address = self._get_host_address(maas_config,
+                                         proxy_config.get('address'),
+                                         'caching_proxy')
+        # The proxy only listens on the address the MAAS vm reaches it on.
+        proxy.ensure_running(port, cache_dir,
+                             proxy_config.get('max_size',
+                                              proxy.PROXY_CACHE_SIZE),
+                             address=address)
+        self.caching_proxy_url = 'http://%s:%s/' % (address, port)
+        log.info("Using caching proxy %s", self.caching_proxy_url)
+        if not maas_config.get('apt_http_proxy'):
+            maas_config['apt_http_proxy'] = self.caching_proxy_url
+
+        return self.caching_proxy_url
+
+    def _get_host_address(self, maas_config, address, setting):
+        """
+        Returns address or, if not given, the address of this host on the
+        route to the MAAS vm, for the service configured by setting.
+        """
+        if address:
+            return address
+
+        maas_address = (maas_config.get('ip_address') or
+                        self._get_static_ip_address(maas_config))
+        if not maas_address:
+            raise MAASDeployerConfigError(
+                "%s needs an address which the MAAS vm can reach this host "
+                "on when the address of the MAAS vm is not configured" %
+                (setting))
+
+        return proxy.get_local_address(maas_address)
+
+    def start_boot_source_mirror(self, maas_config):
+        """
+        Starts serving a mirror of the boot source on this host, if one is
+        configured, and updating it with the images of the boot source
+        selections in the background. The mirror is then configured as the
+        boot source of MAAS (see configure_boot_source()).
+
+        :returns: the URL of the mirror or None
+        """
+        mirror_config = maas_config.get('boot_source_mirror')
+        if not mirror_config:
+            return None
+
+        if not isinstance(mirror_config, dict):
+            mirror_config = {}
+
+        boot_source = maas_config.get('boot_source') or {}
+        selections = (self.get_minimal_selections(maas_config) or
+                      (boot_source.get('selections') or {}).values())
+        if not selections:
+            raise MAASDeployerConfigError("boot_source_mirror needs the "
+                                          "boot_source selections to mirror")
+
+        upstream = boot_source.get('url', mirror.DEFAULT_BOOT_SOURCE_URL)
+        port = mirror_config.get('port', mirror.MIRROR_PORT)
+        path = os.path.expanduser(mirror_config.get('path',
+                                                    mirror.MIRROR_DIR))
+        address = self._get_host_address(maas_config,
+                                         mirror_config.get('address'),
+                                         'boot_source_mirror')
+        mirror.ensure_running(port, path, address=address)
+
+        name = mirror.get_mirror_name(upstream)
+        offline = mirror_config.get('offline', False)
+        pool = ThreadPool(1)
+        staged = self.get_staged_selections(maas_config)
+        if staged:
+            # Mirrored first so the first stage does not wait for the rest.
+            staged_mirror = mirror.SimpleStreamsMirror(
+                upstream, os.path.join(path, name), staged)
+            self.boot_source_mirror_staged_sync = pool.apply_async(
+                staged_mirror.update, (offline,))
+
+        source_mirror = mirror.SimpleStreamsMirror(
+            upstream, os.path.join(path, name), selections)
+        self.boot_source_mirror_sync = pool.apply_async(source_mirror.update,
+                                                        (offline,))
+        pool.close()
+        self.boot_source_mirror_url = 'http://%s:%s/%s/' % (address, port,
+                                                            name)
+        log.info("Using boot source mirror %s of %s",
+                 self.boot_source_mirror_url, upstream)
+        return self.boot_source_mirror_url
+
+    def _wait_for_boot_source_mirror(self, staged=False):
+        """
+        Waits for the boot source mirror to be updated with all the
+        selections or, if staged, with those of the first stage of a staged
+        import.
+        """
+        result = self.boot_source_mirror_sync
+        timing = 'boot_source_mirror'
+        if staged and self.boot_source_mirror_staged_sync:
+            result = self.boot_source_mirror_staged_sync
+            timing = 'boot_source_mirror_staged'
+
+        start = time.time()
+        result.get()
+        self.timings[timing] = time.time() - start
+        log.debug("Waited %.1fs for the boot source mirror",
+                  self.timings[timing])
+
+    def _get_mirror_boot_source(self, boot_source, staged=False):
+        """
+        Waits for the boot source mirror to be updated and returns the boot
+        source settings with the mirror in place of the upstream url. The
+        mirrored metadata is signed by the upstream keyring.
+        """
+        self._wait_for_boot_source_mirror(staged)
+        boot_source = dict(boot_source, url=self.boot_source_mirror_url)
+        if not (boot_source.get('keyring_data') or
+                boot_source.get('keyring_filename')):
+            boot_source['keyring_filename'] = mirror.DEFAULT_KEYRING
+
+        return boot_source
+
+    def prefetch_maas_node(self, params):
+        """
+        Starts downloading the cloud image and building the seed image of
+        the virtual maas node in the background.
+        """
+        params = dict(params, mac_addresses=self._get_macs(params))
+        self.maas_node = vm.CloudInstance(params, autostart=True)
+        pool = ThreadPool(PREFETCH_WORKERS)
+        self.maas_prefetch = self.maas_node.prefetch(pool)
+        pool.close()
 
     def deploy_maas_node(self, params):
         """
         Deploys the virtual maas node.
         """
+        if not self.maas_node:
+            self.prefetch_maas_node(params)
+
         log.debug("Creating MAAS virtual machine.")
-        with vm.CloudInstance(params, autostart=True) as maas_node:
+        with self.maas_node as maas_node:
+            # Errors preparing the volumes are raised here.
+            start = time.time()
+            for result in self.maas_prefetch:
+                result.get()
+
+            log.debug("Waited %.1fs for the volumes of the MAAS vm",
+                      time.time() - start)
             maas_node.create()
+            self.maas_vm_created = time.time()
+            self.maas_console = vm.attach_console(maas_node.name)
 
     def get_ssh_cmd(self, user, host, ssh_opts=None, remote_cmd=None):
         cmd = ['ssh', '-i', os.path.expanduser('~/.ssh/id_maas'),
@@ -160,7 +475,12 @@ class DeploymentEngine(object):
 
         return cmd
 
-    def get_scp_cmd(self, user, host, src, dst=None, scp_opts=None):
+    def get_scp_cmd(self, user, host, src, dst=None, scp_opts=None,
+                    download=False):
+        """
+        Returns the command copying src to dst on host or, if download is
+        set, src on host to dst.
+        """
         if not dst:
             dst = ''
 
@@ -171,20 +491,99 @@ class DeploymentEngine(object):
         if scp_opts:
             cmd += scp_opts
 
-        cmd += [src, ('%s@%s:%s' % (user, host, dst))]
+        if download:
+            cmd += [('%s@%s:%s' % (user, host, src)), dst]
+        else:
+            cmd += [src, ('%s@%s:%s' % (user, host, dst))]
+
         return cmd
 
-    def wait_for_vm_ready(self, user, host):
-        cmd = self.get_ssh_cmd(user, host, remote_cmd=['true'])
+    def _wait_for_console_boot(self, start, timeout):
+        """
+        Waits for the MAAS vm to boot as far as cloud-init bringing up the
+        network by watching its serial console.
+
+        :returns: False if the console is not available or does not show the
+                  boot, True otherwise.
+        """
+        if not self.maas_console:
+            return False
+
+        deadline = time.time() + timeout
+        seen = self.maas_console.wait_for(console.MARKER_KERNEL,
+                                          min(timeout, CONSOLE_KERNEL_TIMEOUT))
+        if not seen:
+            log.debug("Kernel not seen on MAAS vm console - falling back to "
+                      "probing ssh")
+            return False
+
+        self.timings['time_to_kernel'] = seen - start
+        log.info("MAAS vm kernel booting after %.1fs",
+                 self.timings['time_to_kernel'])
+
+        seen = self.maas_console.wait_for(console.MARKER_CLOUDINIT,
+                                          deadline - time.time())
+        if not seen:
+            return False
+
+        self.timings['time_to_cloudinit'] = seen - start
+        log.info("MAAS vm running cloud-init after %.1fs",
+                 self.timings['time_to_cloudinit'])
+        return True
+
+    def wait_for_vm_ready(self, user, host, domain=None, timeout=None):
+        """
+        Waits for the MAAS vm to boot and accept ssh logins.
+
+        If a domain name is provided, the domain is first waited on using
+        libvirt lifecycle events, which gives the time to boot whether or not
+        there is a console, and then, if its serial console is being
+        monitored, until cloud-init starts. Port 22 is then probed with a
+        plain TCP connect and an ssh login is only attempted once it is open.
+
+        :param domain: the name of the MAAS vm domain
+        :param timeout: overall number of seconds to wait before giving up
+        """
+        if timeout is None:
+            timeout = VM_READY_TIMEOUT
+
+        start = self.maas_vm_created or time.time()
+        deadline = time.time() + timeout
+
+        if domain:
+            vm.wait_for_domain_running(domain, max(deadline - time.time(), 0))
+            self.timings['time_to_boot'] = time.time() - start
+            log.debug("MAAS vm running after %.1fs",
+                      self.timings['time_to_boot'])
+            self._wait_for_console_boot(start, deadline - time.time())
+
+        cmd = self.get_ssh_cmd(user, host,
+                               ssh_opts=['-o', 'ConnectTimeout=10',
+                                         '-o', 'BatchMode=yes'],
+                               remote_cmd=['true'])
+        delay = 0.5
         while True:
-            try:
-                util.execc(cmd, suppress_stderr=True)
-                log.debug("MAAS vm started.")
-                break
-            except CalledProcessError:
-                log.debug("Waiting for MAAS vm to start.")
-                time.sleep(1)
-                continue
+            if util.is_port_open(host, 22):
+                try:
+                    util.execc(cmd, suppress_stderr=True)
+                    break
+                except CalledProcessError:
+                    log.debug("sshd is listening but login failed.")
+            else:
+                log.debug("Waiting for MAAS vm sshd to start.")
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise MAASDeployerTimeout("MAAS vm '%s' did not accept ssh "
+                                          "logins within %ss" %
+                                          (host, timeout))
+
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 5)
+
+        self.timings['time_to_sshd'] = time.time() - start
+        log.info("MAAS vm accepting ssh logins after %.1fs",
+                 self.timings['time_to_sshd'])
 
     def _get_api_key_from_cloudinit(self, user, addr):
         # Now get the api key
@@ -199,28 +598,101 @@ class DeploymentEngine(object):
 
     @util.retry_on_exception(exc_tuple=[CalledProcessError])
     def wait_for_cloudinit_finished(self, maas_config, maas_ip):
+        """
+        Streams the cloud-init output log of the MAAS vm over a single ssh
+        session, reporting progress and stage timings until cloud-init has
+        finished.
+        """
         log.debug("Logging into maas host '%s'", (maas_ip))
-        # Now get the api key
-        msg = "MAAS controller is now configured"
-        cloudinitlog = '/var/log/cloud-init-output.log'
-        rcmd = ['grep "%s" %s' %
-                (msg, cloudinitlog)]
-        cmd = self.get_ssh_cmd(maas_config['user'], maas_ip,
-                               remote_cmd=rcmd)
-        out, err = util.execc(cmd=cmd, fatal=False)
-        if out and not err:
-            self._get_api_key_from_cloudinit(maas_config['user'], maas_ip)
-            return
-
         log.info("Waiting for cloud-init to complete - this usually takes "
                  "several minutes")
-        rcmd = ['grep -m 1 "%s" <(sudo tail -n 1 -F %s)' %
-                (msg, cloudinitlog)]
+        if self.cloudinit_progress is None:
+            start_message = None
+            if self.maas_node and self.maas_node.installed_image:
+                # The log starts with the output of the run the image was
+                # captured from.
+                start_message = '%s %s' % (cloudinit.CLONE_START_MESSAGE,
+                                           self.maas_node.instance_id)
+            self.cloudinit_progress = cloudinit.CloudInitProgress(
+                start_message=start_message)
+
+        progress = self.cloudinit_progress
+        # If this is a retry, resume after the last line already processed so
+        # that it is not fed to progress twice.
+        rcmd = ['sudo', 'tail', '-n', '+%d' % (self.cloudinit_lines_seen + 1),
+                '-F', cloudinit.CLOUDINIT_OUTPUT_LOG]
         cmd = self.get_ssh_cmd(maas_config['user'], maas_ip,
+                               ssh_opts=['-o', 'LogLevel=quiet'],
                                remote_cmd=rcmd)
-        util.execc(cmd=cmd)
+        # The final message may also be seen on the serial console.
+        console_seen = self.maas_console.seen if self.maas_console else {}
+        # Lines are None when there has been no output for a while, so the
+        # console is still checked if the log stops before the final message.
+        lines = util.stream_lines(cmd, idle_timeout=CONSOLE_CHECK_INTERVAL)
+        try:
+            for line in lines:
+                if line is not None:
+                    self.cloudinit_lines_seen += 1
+                    progress.feed(line)
+
+                if (progress.golden_image_ready and
+                        not self.golden_image_captured):
+                    self.capture_golden_image(maas_config, maas_ip)
+
+                if console.MARKER_FINAL_MESSAGE in console_seen:
+                    progress.finished = True
+
+                sys.stdout.write(' Installing MAAS ... %-60s' %
+                                 (progress.status[:60]))
+                sys.stdout.flush()
+                sys.stdout.write('\r')
+                if progress.finished:
+                    break
+        finally:
+            lines.close()
+
+        if not progress.finished:
+            raise CalledProcessError(1, ' '.join(cmd),
+                                     output="cloud-init output ended before "
+                                            "cloud-init finished")
+
+        sys.stdout.write('\r\n')
         log.info("done.")
-        self._get_api_key_from_cloudinit(maas_config['user'], maas_ip)
+        progress.log_summary()
+        self.timings['cloudinit'] = progress.durations()
+        cloudinit.record_timings(self._get_provisioning_profile(maas_config),
+                                 self.timings['cloudinit'])
+
+        if progress.api_key:
+            self.api_key = progress.api_key
+        else:
+            self._get_api_key_from_cloudinit(maas_config['user'], maas_ip)
+
+    def _get_provisioning_profile(self, maas_config):
+        """
+        Returns the name of the way the MAAS controller was provisioned,
+        under which cloud-init timings are recorded.
+        """
+        profile = 'fast' if maas_config.get('fast_provision') else 'default'
+        if self.maas_node and self.maas_node.installed_image:
+            profile += '-preinstalled'
+
+        return profile
+
+    def capture_golden_image(self, maas_config, maas_ip):
+        """
+        Captures the root volume of the MAAS vm as a golden image and lets
+        cloud-init on it continue with configuring MAAS.
+        """
+        sys.stdout.write('\r\n')
+        start = time.time()
+        self.maas_node.capture_golden_image()
+        cmd = self.get_ssh_cmd(maas_config['user'], maas_ip,
+                               remote_cmd=['sudo', 'touch',
+                                           vm.GOLDEN_IMAGE_RESUME_FILE])
+        util.execc(cmd)
+        self.golden_image_captured = True
+        self.timings['golden_image_capture'] = time.time() - start
 
     def wait_for_maas_installation(self, maas_config):
         """
@@ -231,15 +703,23 @@ class DeploymentEngine(object):
         maas_ip = self._get_maas_ip_address(maas_config)
 
         self.ip_addr = maas_ip
-        self.wait_for_vm_ready(maas_config['user'], maas_ip)
-        self.wait_for_cloudinit_finished(maas_config, maas_ip)
+        try:
+            self.wait_for_vm_ready(maas_config['user'], maas_ip,
+                                   domain=maas_config.get('name'),
+                                   timeout=maas_config.get('vm_ready_timeout'))
+            self.wait_for_cloudinit_finished(maas_config, maas_ip)
+        finally:
+            if self.maas_console:
+                self.maas_console.stop()
+                log.debug("MAAS vm console output saved to %s",
+                          self.maas_console.log_path)
 
     def _get_maas_ip_address(self, maas_config):
         """Attempts to get the IP address from the maas_config dict.
 
         If an IP address for contacting the node isn't specified, this will
         try and look in the network_config to get the address. If that cannot
-        be found, then the user will be prompted for the IP address.
+        be found, the address is discovered from libvirt.
 
         :param maas_config: the config dict for maas parameters.
         """
@@ -250,12 +730,51 @@ class DeploymentEngine(object):
 
         log.info("ip_address was not specified in maas section of deployment"
                  " yaml file.")
+        ip_address = self._get_static_ip_address(maas_config)
+        if not ip_address:
+            ip_address = self._discover_maas_ip_address(maas_config)
+
+        maas_config['ip_address'] = ip_address
+        return ip_address
+
+    def _get_static_ip_address(self, maas_config):
+        """Returns the first static address in the maas network_config."""
+        for line in (maas_config.get('network_config') or '').splitlines():
+            words = line.split()
+            if len(words) > 1 and words[0] == 'address':
+                ip_address = words[1].split('/')[0]
+                log.debug("Using ip address from network_config: %s",
+                          ip_address)
+                return ip_address
+
+        return None
+
+    def _discover_maas_ip_address(self, maas_config):
+        """
+        Discovers the address of the MAAS vm from libvirt, prompting the user
+        for it only if discovery fails and the deployer is run interactively.
+        """
+        name = maas_config['name']
+        timeout = maas_config.get('ip_discovery_timeout',
+                                  IP_DISCOVERY_TIMEOUT)
+        try:
+            ip_address = vm.wait_for_ip_address(name, timeout)
+            log.info("Discovered MAAS vm ip address: %s", ip_address)
+            return ip_address
+        except MAASDeployerTimeout as e:
+            if not sys.stdin.isatty():
+                log.error("Unable to discover the MAAS vm ip address - "
+                          "please set ip_address in the maas section")
+                raise
+
+            log.warning(str(e))
+
+        ip_address = None
         while not ip_address:
             ip_address = raw_input("Enter the IP address for "
                                    "the MAAS controller: ")
         log.debug("User entered IP address: %s", ip_address)
-        maas_config['ip_address'] = ip_address
-        return ip_address
+        return ip_address.strip()
 
     @util.retry_on_exception(exc_tuple=[CalledProcessError])
     def _get_api_key(self, maas_config):
@@ -366,14 +885,199 @@ class DeploymentEngine(object):
             log.error(msg)
             raise MAASDeployerClientError(msg)
 
-    def configure_boot_source(self, client, maas_config):
+    def get_minimal_selections(self, maas_config):
+        """
+        Returns the boot source selections of just the releases and
+        architectures the nodes need, if minimal_boot_images is set, or None.
+
+        The releases are those MAAS commissions and deploys with and the
+        series of the Juju environment, the architectures those of the nodes
+        and the deployer's virtual nodes. A selection covers every
+        combination of its arches and subarches, so one selection of all of
+        them is made per release. Labels are taken from the configured
+        selection of the release, if any.
+        """
+        if not maas_config.get('minimal_boot_images'):
+            return None
+
+        settings = maas_config.get('settings') or {}
+        releases = set([
+            settings.get('commissioning_distro_series',
+                         DEFAULT_DISTRO_SERIES),
+            settings.get('default_distro_series', DEFAULT_DISTRO_SERIES),
+        ])
+        if self.juju_series:
+            releases.add(self.juju_series)
+
+        return self._get_release_selections(maas_config, releases)
+
+    def get_staged_selections(self, maas_config):
+        """
+        Returns the boot source selections imported first in a staged boot
+        image import, if staged_boot_image_import is set, or None: just the
+        release MAAS commissions with for the architectures of the nodes.
+        The rest are imported in the background once the nodes can be
+        commissioned (see start_background_import()).
+        """
+        if not maas_config.get('staged_boot_image_import'):
+            return None
+
+        settings = maas_config.get('settings') or {}
+        release = settings.get('commissioning_distro_series',
+                               DEFAULT_DISTRO_SERIES)
+        return self._get_release_selections(maas_config, [release])
+
+    def _get_release_selections(self, maas_config, releases):
+        """
+        Returns a selection of each release for the architectures of the
+        nodes.
+        """
+        architectures = set([VIRTUAL_NODE_ARCHITECTURE])
+        for node in maas_config.get('nodes') or []:
+            architectures.add(node.get('architecture',
+                                       VIRTUAL_NODE_ARCHITECTURE))
+
+        arches = sorted(set(a.split('/')[0] for a in architectures))
+        subarches = sorted(set(a.split('/', 1)[1] if '/' in a else 'generic'
+                               for a in architectures))
+
+        boot_source = maas_config.get('boot_source') or {}
+        labels = {}
+        for selection in (boot_source.get('selections') or {}).values():
+            if selection.get('os', 'ubuntu') == 'ubuntu':
+                labels[selection['release']] = selection.get('labels')
+
+        selections = []
+        for release in sorted(releases):
+            release_labels = labels.get(release) or 'release'
+            if not isinstance(release_labels, list):
+                release_labels = [release_labels]
+
+            selections.append({
+                'os': 'ubuntu',
+                'release': release,
+                'arches': arches,
+                'subarches': subarches,
+                'labels': release_labels,
+            })
+
+        return selections
+
+    def _sync_boot_source_selections(self, client, source_id, selections,
+                                     staged=False):
+        """
+        Updates, deletes and creates the selections of the boot source so
+        that they are exactly selections.
+
+        :param staged: keep the selections replaced to be put back after the
+                       first stage of a staged import.
+        """
+        current = client.get_boot_source_selections(source_id) or []
+        if staged:
+            self.staged_selections[source_id] = current
+
+        wanted = dict(((s['os'], s['release']), s) for s in selections)
+        for existing in current:
+            selection = wanted.pop((existing['os'], existing['release']),
+                                   None)
+            if selection is None:
+                log.info("Deleting boot source selection of %s %s",
+                         existing['os'], existing['release'])
+                if not client.delete_boot_source_selection(source_id,
+                                                           existing['id']):
+                    msg = ("Failed to delete boot source selection %s" %
+                           (existing['id']))
+                    log.error(msg)
+                    raise MAASDeployerClientError(msg)
+
+                continue
+
+            changes = dict((field, selection[field])
+                           for field in ('arches', 'subarches', 'labels')
+                           if sorted(existing.get(field) or []) !=
+                           sorted(selection[field]))
+            if changes:
+                log.info("Updating boot source selection of %s %s: %s",
+                         existing['os'], existing['release'], changes)
+                if not client.update_boot_source_selection(source_id,
+                                                           existing['id'],
+                                                           **changes):
+                    msg = ("Failed to update boot source selection %s" %
+                           (existing['id']))
+                    log.error(msg)
+                    raise MAASDeployerClientError(msg)
+
+        for key in sorted(wanted):
+            selection = wanted[key]
+            log.info("Creating boot source selection of %s %s", *key)
+            if not client.create_boot_source_selection(
+                    source_id, selection['release'], selection['os'],
+                    selection['arches'], selection['subarches'],
+                    selection['labels']):
+                msg = ("Failed to create boot source selection of %s %s" %
+                       key)
+                log.error(msg)
+                raise MAASDeployerClientError(msg)
+
+    def configure_boot_source(self, client, maas_config, selections=None):
         """Create a new boot source if one has been provided and setup boot
         source selections as provided.
 
+        If minimal_boot_images is set the selections of the boot source, or
+        of all boot sources if none is provided, are replaced by those the
+        nodes need (see get_minimal_selections()).
+
+        If selections are given, for the first stage of a staged import, the
+        boot sources are configured as above and their selections then
+        replaced by selections. The next time this is called only the
+        selections they replaced are put back.
+
         NOTE: see bug 1556085 and bug 1391254 for known caveats when
               configuring boot sources.
         """
+        if (self.caching_proxy_url and
+                'http_proxy' not in (maas_config.get('settings') or {})):
+            # MAAS downloads boot images through its http_proxy.
+            log.debug("Setting MAAS http_proxy to caching proxy %s",
+                      self.caching_proxy_url)
+            client.set_config('http_proxy', self.caching_proxy_url)
+
+        if self.staged_selections and not selections:
+            # Back from the first stage of a staged import: the boot sources
+            # are already in place.
+            if self.boot_source_mirror_url:
+                self._wait_for_boot_source_mirror()
+
+            for source_id, original in sorted(self.staged_selections.items()):
+                self._sync_boot_source_selections(client, source_id,
+                                                  original)
+
+            self.staged_selections = {}
+            return
+
         newsource = maas_config.get('boot_source')
+        if self.boot_source_mirror_url:
+            newsource = self._get_mirror_boot_source(newsource or {},
+                                                     staged=bool(selections))
+
+        self._configure_boot_sources(client, maas_config, newsource)
+        if selections:
+            # The selections replaced are only known once the boot sources
+            # are configured.
+            for source in client.get_boot_sources():
+                if newsource and source['url'] != newsource['url']:
+                    continue
+
+                self._sync_boot_source_selections(client, source['id'],
+                                                  selections, staged=True)
+
+    def _configure_boot_sources(self, client, maas_config, newsource):
+        minimal = self.get_minimal_selections(maas_config)
+        if not newsource and minimal:
+            for source in client.get_boot_sources():
+                self._sync_boot_source_selections(client, source['id'],
+                                                  minimal)
+
         if newsource:
             log.debug("Configuring boot source '%s'",  (newsource['url']))
             sources = client.get_boot_sources()
@@ -404,8 +1108,15 @@ class DeploymentEngine(object):
                 if newsource.get('exclusive'):
                     self._delete_existing_bootsources(client, sources)
 
-            selections = newsource.get('selections')
             sources = client.get_boot_sources()
+            if minimal:
+                for source in sources:
+                    if source['url'] == url:
+                        self._sync_boot_source_selections(
+                            client, source['id'], minimal)
+                return
+
+            selections = newsource.get('selections')
             if not selections:
                 log.info("No boot source selections requested")
                 return
@@ -447,38 +1158,214 @@ class DeploymentEngine(object):
                     log.error(msg)
                     raise MAASDeployerClientError(msg)
 
-    def wait_for_import_boot_images(self, client, maas_config):
-        """Polls the import boot image status."""
-        log.debug("Starting the import of boot resources")
-        client.import_boot_images()
+    @util.retry_on_exception(exc_tuple=[CalledProcessError])
+    def _get_maas_version(self, maas_config):
+        """
+        Returns the version of the MAAS region controller package installed
+        on the MAAS vm.
+        """
+        if not self.maas_version:
+            remote_cmd = ['dpkg-query', '-W', "-f='${Version}'",
+                          MAAS_REGION_PACKAGE]
+            cmd = self.get_ssh_cmd(maas_config['user'], self.ip_addr,
+                                   remote_cmd=remote_cmd)
+            out, _ = util.execc(cmd)
+            self.maas_version = out.strip()
 
-        ip_addr = self.ip_addr or self._get_maas_ip_address(maas_config)
+        return self.maas_version
+
+    def _get_boot_resources_archive(self, maas_config):
+        """
+        Returns the path of the archive of boot resources for the MAAS
+        controller if they are to be cached, otherwise None. Archives are
+        keyed on the version of MAAS, whose schema the rows are dumped in,
+        and on what determines the images imported: the selections in
+        effect and the boot source they are imported from.
+        """
+        cache_config = maas_config.get('boot_resources_cache')
+        if not cache_config:
+            return None
+
+        if not isinstance(cache_config, dict):
+            cache_config = {}
+
+        boot_source = maas_config.get('boot_source') or {}
+        selections = (self.get_minimal_selections(maas_config) or
+                      boot_source.get('selections'))
+        key = json.dumps([self._get_maas_version(maas_config),
+                          maas_config.get('release', 'trusty'),
+                          maas_config.get('arch', 'amd64'),
+                          maas_config.get('apt_sources') or [],
+                          self.boot_source_mirror_url or
+                          boot_source.get('url'),
+                          selections], sort_keys=True)
+        path = os.path.expanduser(cache_config.get('path',
+                                                   BOOT_RESOURCES_CACHE_DIR))
+        return os.path.join(path, 'boot-resources-%s.tar' %
+                            (hashlib.sha256(key).hexdigest()[:12]))
+
+    def _get_boot_resources_params(self):
+        return {
+            'archive': BOOT_RESOURCES_REMOTE_ARCHIVE,
+            'database': vm.MAAS_DATABASE,
+            'tables': BOOT_RESOURCES_TABLES,
+        }
+
+    def restore_boot_resources(self, maas_config):
+        """
+        Restores the boot resources exported from an earlier MAAS controller
+        with the same configuration, if cached, so that importing the boot
+        images only has to verify them.
+
+        :returns: True if boot resources were restored
+        """
+        archive = self._get_boot_resources_archive(maas_config)
+        if not archive or not os.path.exists(archive):
+            return False
+
+        log.info("Restoring boot resources from %s", archive)
+        start = time.time()
         user = maas_config['user']
-        password = maas_config['password']
-        checker = bootimages.ImageImportChecker(host=ip_addr,
-                                                username=user,
-                                                password=password)
-        log.debug("Logging into %s", (ip_addr))
-        checker.do_login()
-
-        while not checker.did_downloads_start():
-            log.debug("Waiting for downloads of boot images to start...")
-            time.sleep(2)
-
-        complete, status = checker.are_images_complete()
-        while not complete:
-            # Make sure to verify there are resources in the status query.
-            # Its possible that the check comes in before MAAS determines
-            # which resources it needs, etc
-            if status.resources:
-                status_str = status.resources[0].status
-                sys.stdout.write(' Importing images ... %s ' % status_str)
+        util.execc(self.get_scp_cmd(user, self.ip_addr, archive,
+                                    BOOT_RESOURCES_REMOTE_ARCHIVE))
+        script = template.load('restore-boot-resources.sh',
+                               self._get_boot_resources_params())
+        util.exec_script_remote(user, self.ip_addr, script)
+        self.boot_resources_restored = True
+        self.timings['boot_resources_restore'] = time.time() - start
+        log.info("Restored boot resources in %.1fs",
+                 self.timings['boot_resources_restore'])
+        return True
+
+    def export_boot_resources(self, maas_config):
+        """
+        Exports the imported boot resources of the MAAS controller, the
+        files under /var/lib/maas/boot-resources and their rows in the
+        region database, to the cache unless they were restored from it.
+
+        :returns: the path of the archive or None
+        """
+        archive = self._get_boot_resources_archive(maas_config)
+        if (not archive or self.boot_resources_restored or
+                os.path.exists(archive)):
+            return None
+
+        if not os.path.isdir(os.path.dirname(archive)):
+            os.makedirs(os.path.dirname(archive))
+
+        log.info("Exporting boot resources to %s", archive)
+        user = maas_config['user']
+        script = template.load('export-boot-resources.sh',
+                               self._get_boot_resources_params())
+        util.exec_script_remote(user, self.ip_addr, script)
+        part = '%s.part' % (archive)
+        try:
+            util.execc(self.get_scp_cmd(user, self.ip_addr,
+                                        BOOT_RESOURCES_REMOTE_ARCHIVE, part,
+                                        download=True))
+            os.rename(part, archive)
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+
+            cmd = ['rm', '-f', BOOT_RESOURCES_REMOTE_ARCHIVE]
+            util.execc(self.get_ssh_cmd(user, self.ip_addr, remote_cmd=cmd),
+                       fatal=False)
+
+        return archive
+
+    def _get_import_monitor(self, maas_config):
+        """
+        Returns a monitor of the import of boot images, which reads the
+        boot-resources API with the OAuth credentials of the MAAS user.
+        """
+        ip_addr = self.ip_addr or self._get_maas_ip_address(maas_config)
+        api_client = MAASClient('http://%s/MAAS/api/1.0' % (ip_addr),
+                                self.api_key)
+        stall_timeout = maas_config.get('boot_image_stall_timeout',
+                                        bootimages.IMPORT_STALL_TIMEOUT)
+        return bootimages.BootResourceMonitor(api_client,
+                                              stall_timeout=stall_timeout)
+
+    def _wait_for_import(self, client, monitor, timeout, report=True):
+        """
+        Polls the import of boot images until it is complete, triggering it
+        again if it stalls.
+
+        :param report: show the progress of the import on stdout.
+        """
+        deadline = time.time() + timeout
+        while not monitor.poll():
+            if report:
+                sys.stdout.write(' Importing boot images ... %s ' %
+                                 (monitor.format_status()))
                 sys.stdout.flush()
                 sys.stdout.write('\r')
-            time.sleep(5)
-            complete, status = checker.are_images_complete()
 
-        log.debug("\r\nBoot image importing has completed.")
+            if monitor.stalled:
+                if report:
+                    sys.stdout.write('\r\n')
+
+                log.warning("No progress importing boot images for "
+                            "%ss (%s) - starting the import again",
+                            monitor.stall_timeout,
+                            ', '.join(sorted(str(r)
+                                             for r in monitor.pending)))
+                client.import_boot_images()
+                monitor.reset_stall()
+
+            if time.time() > deadline:
+                raise MAASDeployerTimeout("Boot images were not imported "
+                                          "within %ss (%s)" %
+                                          (timeout, monitor.format_status()))
+
+            time.sleep(IMPORT_POLL_INTERVAL)
+
+        elapsed = max(time.time() - monitor.started, 0.001)
+        if report:
+            sys.stdout.write('\r\n')
+
+        log.info("Imported %.1f MiB of boot images in %.1fs",
+                 monitor.size / float(1 << 20), elapsed)
+        return elapsed
+
+    def start_background_import(self, client, maas_config):
+        """
+        Starts importing the boot images selected after the first stage of a
+        staged import and waits for it to finish in the background, so that
+        the nodes are commissioned meanwhile.
+
+        :returns: the result of waiting for the import
+        """
+        log.info("Importing the remaining boot images in the background")
+        client.import_boot_images()
+        monitor = self._get_import_monitor(maas_config)
+        timeout = maas_config.get('boot_image_import_timeout',
+                                  IMPORT_TIMEOUT)
+        pool = ThreadPool(1)
+        result = pool.apply_async(self._wait_for_background_import,
+                                  (client, monitor, timeout))
+        pool.close()
+        return result
+
+    def _wait_for_background_import(self, client, monitor, timeout):
+        self.timings['background_import'] = self._wait_for_import(
+            client, monitor, timeout, report=False)
+        log.info("Background import of boot images completed in %.1fs",
+                 self.timings['background_import'])
+
+    def wait_for_import_boot_images(self, client, maas_config):
+        """
+        Starts the import of boot images and waits for it to complete,
+        showing its progress, rate and estimated time to completion.
+        """
+        log.debug("Starting the import of boot resources")
+        client.import_boot_images()
+
+        monitor = self._get_import_monitor(maas_config)
+        self.timings['boot_image_import'] = self._wait_for_import(
+            client, monitor, maas_config.get('boot_image_import_timeout',
+                                             IMPORT_TIMEOUT))
 
     @staticmethod
     def _get_node_tags(node):
@@ -711,6 +1598,7 @@ class DeploymentEngine(object):
             'ip_addr': self.ip_addr,
             'api_key': self.api_key,
             'env_name': self.env_name,
+            'default_series': self.juju_series,
         }
         content = template.load(JUJU_ENV_YAML, params)
         with open(JUJU_ENV_YAML, 'w+') as f:
@@ -0,0 +1,136 @@
+#
+# Copyright 2015, Canonical Ltd
+#
+# Provides the libvirt event loop and helpers for waiting on domain
+# lifecycle events.
+#
+
+import libvirt
+import logging
+import threading
+import time
+
+from maas_deployer.vmaas.exception import MAASDeployerTimeout
+
+log = logging.getLogger('vmaas.main')
+
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+
+def _run_event_loop():
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+
+def start_event_loop():
+    """Registers the default libvirt event implementation and runs it in a
+    daemon thread.
+
+    This needs to be called before opening any connection that events are
+    to be registered on. Calling it more than once is harmless.
+
+    :returns: True if libvirt events are available, False otherwise.
+    """
+    global _event_loop
+
+    with _event_loop_lock:
+        if _event_loop:
+            return True
+
+        try:
+            libvirt.virEventRegisterDefaultImpl()
+        except (AttributeError, libvirt.libvirtError) as e:
+            log.debug("libvirt events not available - %s", e)
+            return False
+
+        _event_loop = threading.Thread(target=_run_event_loop,
+                                       name='libvirt-events')
+        _event_loop.daemon = True
+        _event_loop.start()
+        return True
+
+
+def events_available():
+    return _event_loop is not None
+
+
+def _wait_for_domain(conn, name, timeout, active, poll_interval):
+    """Waits for the named domain to become active or inactive.
+
+    If the libvirt event loop is running the wait is driven by domain
+    lifecycle events, otherwise the domain state is polled.
+
+    :returns: the number of seconds spent waiting
+    """
+    start = time.time()
+    deadline = start + timeout
+    dom = conn.lookupByName(name)
+    changed = threading.Event()
+    if active:
+        wanted = (libvirt.VIR_DOMAIN_EVENT_STARTED,
+                  libvirt.VIR_DOMAIN_EVENT_RESUMED)
+    else:
+        wanted = (libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                  libvirt.VIR_DOMAIN_EVENT_SHUTDOWN)
+
+    def _lifecycle_cb(conn, dom, event, detail, opaque):
+        if event in wanted:
+            changed.set()
+
+    cb_id = None
+    if events_available():
+        try:
+            cb_id = conn.domainEventRegisterAny(
+                dom, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, _lifecycle_cb,
+                None)
+        except libvirt.libvirtError as e:
+            log.debug("Unable to register lifecycle event for domain '%s' "
+                      "- polling instead: %s", name, e)
+
+    try:
+        while bool(dom.isActive()) != active:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise MAASDeployerTimeout("Domain '%s' did not %s within "
+                                          "%ss" % (name,
+                                                   'start' if active
+                                                   else 'stop', timeout))
+
+            # Re-check the state now and again even when events are in use
+            # in case one was missed while registering.
+            if cb_id is not None:
+                changed.wait(min(remaining, 10))
+                changed.clear()
+            else:
+                time.sleep(min(remaining, poll_interval))
+    finally:
+        if cb_id is not None:
+            try:
+                conn.domainEventDeregisterAny(cb_id)
+            except libvirt.libvirtError:
+                pass
+
+    return time.time() - start
+
+
+def wait_for_domain_running(conn, name, timeout, poll_interval=1):
+    """Waits for the named domain to be running.
+
+    :param conn: libvirt connection the domain belongs to
+    :param name: name of the domain
+    :param timeout: maximum number of seconds to wait
+    :returns: the number of seconds spent waiting
+    """
+    return _wait_for_domain(conn, name, timeout, True, poll_interval)
+
+
+def wait_for_domain_stopped(conn, name, timeout, poll_interval=5):
+    """Waits for the named domain to have shut down.
+
+    :param conn: libvirt connection the domain belongs to
+    :param name: name of the domain
+    :param timeout: maximum number of seconds to wait
+    :returns: the number of seconds spent waiting
+    """
+    return _wait_for_domain(conn, name, timeout, False, poll_interval)
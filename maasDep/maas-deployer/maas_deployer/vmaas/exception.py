@@ -45,3 +45,18 @@ class MAASDeployerConfigError(MAASDeployerBaseException):
 class MAASDeployerValueError(MAASDeployerBaseException):
     def __init__(self, msg):
         super(MAASDeployerValueError, self).__init__(msg)
+
+
+class MAASDeployerTimeout(MAASDeployerBaseException):
+    def __init__(self, msg):
+        super(MAASDeployerTimeout, self).__init__(msg)
+
+
+class MAASDeployerDownloadError(MAASDeployerBaseException):
+    def __init__(self, msg):
+        super(MAASDeployerDownloadError, self).__init__(msg)
+
+
+class MAASDeployerBakeError(MAASDeployerBaseException):
+    def __init__(self, msg):
+        super(MAASDeployerBakeError, self).__init__(msg)
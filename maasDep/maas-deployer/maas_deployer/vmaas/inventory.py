@@ -0,0 +1,255 @@
+#
+# Copyright 2015, Canonical Ltd
+#
+# Caches the domains, storage pools and volumes known to a hypervisor so
+# that they only need to be queried once per deployment.
+#
+
+import contextlib
+import libvirt
+import logging
+import threading
+
+from lxml import etree
+
+from maas_deployer.vmaas import events
+
+log = logging.getLogger('vmaas.main')
+
+_inventories = {}
+_inventories_lock = threading.Lock()
+
+
+def get_inventory(conn, uri):
+    """Returns the Inventory for the connection to the hypervisor at uri.
+
+    A new Inventory is started whenever the connection to uri is re-opened.
+    """
+    with _inventories_lock:
+        inv = _inventories.get(uri)
+        if inv is None or inv.conn is not conn:
+            if inv is not None:
+                inv.close()
+
+            inv = Inventory(conn)
+            _inventories[uri] = inv
+
+        return inv
+
+
+def find_inventory(conn):
+    """Returns the Inventory of the connection, if one has been started."""
+    with _inventories_lock:
+        for inv in _inventories.values():
+            if inv.conn is conn:
+                return inv
+
+    return None
+
+
+def discard_inventory(uri):
+    """Closes the Inventory of the connection to uri, if there is one."""
+    with _inventories_lock:
+        inv = _inventories.pop(uri, None)
+
+    if inv is not None:
+        inv.close()
+
+
+class Inventory(object):
+    """
+    Cache of the domains, storage pools and volumes of a libvirt connection
+    along with the parsed XML of domains.
+
+    Everything is loaded lazily on first use. Changes made by the deployer
+    are applied to the cache directly. If the libvirt event loop is running,
+    domain and storage pool events keep the cache in step with changes made
+    by others, otherwise refresh() can be used to drop everything cached.
+    The event callbacks are deregistered by close().
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._lock = threading.RLock()
+        self._domains = None
+        self._domain_xml = {}
+        self._pools = None
+        self._volumes = {}
+        self._callback_ids = []
+        self._pool_callback_ids = []
+        # Number of refreshes of each pool made by the deployer whose events
+        # are still to come (see own_refresh()).
+        self._own_refreshes = {}
+        self._register_events()
+
+    def _register_events(self):
+        if not events.events_available():
+            return
+
+        try:
+            self._callback_ids.append(self.conn.domainEventRegisterAny(
+                None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                self._domain_event, None))
+        except libvirt.libvirtError as e:
+            log.debug("Unable to register for domain events: %s", e)
+
+        # Storage pool events are only available with libvirt >= 2.0
+        if not hasattr(self.conn, 'storagePoolEventRegisterAny'):
+            return
+
+        try:
+            self._pool_callback_ids.append(
+                self.conn.storagePoolEventRegisterAny(
+                    None, libvirt.VIR_STORAGE_POOL_EVENT_ID_LIFECYCLE,
+                    self._pool_event, None))
+            self._pool_callback_ids.append(
+                self.conn.storagePoolEventRegisterAny(
+                    None, libvirt.VIR_STORAGE_POOL_EVENT_ID_REFRESH,
+                    self._pool_refresh_event, None))
+        except libvirt.libvirtError as e:
+            log.debug("Unable to register for storage pool events: %s", e)
+
+    def close(self):
+        """Deregisters the event callbacks of the inventory."""
+        callbacks = [(self.conn.domainEventDeregisterAny, cb_id)
+                     for cb_id in self._callback_ids]
+        callbacks += [(self.conn.storagePoolEventDeregisterAny, cb_id)
+                      for cb_id in self._pool_callback_ids]
+        self._callback_ids = []
+        self._pool_callback_ids = []
+        for deregister, cb_id in callbacks:
+            try:
+                deregister(cb_id)
+            except libvirt.libvirtError as e:
+                log.debug("Unable to deregister event callback %s: %s",
+                          cb_id, e)
+
+    def _domain_event(self, conn, dom, event, detail, opaque):
+        if event == libvirt.VIR_DOMAIN_EVENT_DEFINED:
+            self.add_domain(dom.name())
+        elif event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+            self.remove_domain(dom.name())
+
+    def _pool_event(self, conn, pool, event, detail, opaque):
+        with self._lock:
+            self._pools = None
+            self._volumes.pop(pool.name(), None)
+
+    def _pool_refresh_event(self, conn, pool, opaque):
+        name = pool.name()
+        with self._lock:
+            if self._own_refreshes.get(name):
+                self._own_refreshes[name] -= 1
+                return
+
+            self._volumes.pop(name, None)
+
+    @contextlib.contextmanager
+    def own_refresh(self, pool):
+        """
+        Context in which the deployer refreshes a storage pool whose changes
+        it has already applied to the cache, so that the refresh event which
+        follows does not drop the cached volumes.
+        """
+        if not self._pool_callback_ids:
+            yield
+            return
+
+        with self._lock:
+            self._own_refreshes[pool] = self._own_refreshes.get(pool, 0) + 1
+
+        try:
+            yield
+        except Exception:
+            # No event is sent for a refresh which failed.
+            with self._lock:
+                self._own_refreshes[pool] -= 1
+
+            raise
+
+    def refresh(self):
+        """Drops everything cached so that it is re-read on next use."""
+        with self._lock:
+            self._domains = None
+            self._domain_xml = {}
+            self._pools = None
+            self._volumes = {}
+
+    @property
+    def domains(self):
+        """Returns the set of names of all defined domains."""
+        with self._lock:
+            if self._domains is None:
+                log.debug("Loading domain inventory")
+                self._domains = set(d.name() for d in
+                                    self.conn.listAllDomains())
+
+            return self._domains
+
+    def has_domain(self, name):
+        return name in self.domains
+
+    def add_domain(self, name, xml=None):
+        """Records a newly defined domain.
+
+        :param xml: the parsed XML the domain was defined with, if known.
+        """
+        with self._lock:
+            if self._domains is not None:
+                self._domains.add(name)
+
+            if xml is not None:
+                self._domain_xml[name] = xml
+            else:
+                self._domain_xml.pop(name, None)
+
+    def remove_domain(self, name):
+        with self._lock:
+            if self._domains is not None:
+                self._domains.discard(name)
+
+            self._domain_xml.pop(name, None)
+
+    def domain_xml(self, name):
+        """Returns the parsed XML description of the named domain."""
+        with self._lock:
+            xml = self._domain_xml.get(name)
+            if xml is None:
+                dom = self.conn.lookupByName(name)
+                xml = etree.fromstring(dom.XMLDesc(0))
+                self._domain_xml[name] = xml
+
+            return xml
+
+    @property
+    def pools(self):
+        """Returns the set of names of all storage pools."""
+        with self._lock:
+            if self._pools is None:
+                log.debug("Loading storage pool inventory")
+                self._pools = set(p.name() for p in
+                                  self.conn.listAllStoragePools())
+
+            return self._pools
+
+    def volumes(self, pool):
+        """Returns the set of names of the volumes in the storage pool."""
+        with self._lock:
+            vols = self._volumes.get(pool)
+            if vols is None:
+                log.debug("Loading volume inventory of pool '%s'", pool)
+                storage_pool = self.conn.storagePoolLookupByName(pool)
+                vols = set(v.name() for v in storage_pool.listAllVolumes())
+                self._volumes[pool] = vols
+
+            return vols
+
+    def add_volume(self, pool, name):
+        with self._lock:
+            if pool in self._volumes:
+                self._volumes[pool].add(name)
+
+    def remove_volume(self, pool, name):
+        with self._lock:
+            if pool in self._volumes:
+                self._volumes[pool].discard(name)
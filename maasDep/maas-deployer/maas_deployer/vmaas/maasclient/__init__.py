@@ -143,6 +143,35 @@ class MAASClient(object):
             return resp.data
         return False
 
+    def update_boot_source_selection(self, source_id, selection_id,
+                                     **settings):
+        """
+        Update a boot source selection.
+
+        :param source_id: numeric id
+        :param selection_id: numeric id of the selection
+        :param settings: e.g. arches=['amd64'], subarches=['generic']
+        """
+        resp = self.driver.update_boot_source_selection(source_id,
+                                                        selection_id,
+                                                        **settings)
+        if resp.ok:
+            return resp.data
+        return False
+
+    def delete_boot_source_selection(self, source_id, selection_id):
+        """
+        Delete a boot source selection.
+
+        :param source_id: numeric id
+        :param selection_id: numeric id of the selection
+        """
+        resp = self.driver.delete_boot_source_selection(source_id,
+                                                        selection_id)
+        if resp.ok:
+            return True
+        return False
+
     ###########################################################################
     # Boot Images API - http://maas.ubuntu.com/docs/api.html#boot-images
     ###########################################################################
@@ -166,6 +195,39 @@ class MAASClient(object):
         """
         return self.driver.import_boot_images()
 
+    ###########################################################################
+    # Boot Resources API - http://maas.ubuntu.com/docs/api.html#boot-resources
+    ###########################################################################
+    def get_boot_resources(self):
+        """
+        Returns the boot resources of the region.
+        """
+        resp = self.driver.get_boot_resources()
+        if resp.ok:
+            return resp.data
+        return []
+
+    def get_boot_resource(self, id):
+        """
+        Returns the boot resource with its sets of files and their progress.
+
+        :param id: numeric id of the boot resource
+        """
+        resp = self.driver.get_boot_resource(id)
+        if resp.ok:
+            return resp.data
+        return None
+
+    def is_importing_boot_resources(self):
+        """
+        Returns whether the region is importing boot resources or None if
+        that cannot be told e.g. because MAAS is too old.
+        """
+        resp = self.driver.is_importing_boot_resources()
+        if resp.ok and isinstance(resp.data, bool):
+            return resp.data
+        return None
+
     ###########################################################################
     # Nodegroup API - http://maas.ubuntu.com/docs/api.html#nodegroups
     ###########################################################################
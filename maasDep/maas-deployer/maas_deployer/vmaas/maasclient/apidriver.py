@@ -176,6 +176,29 @@ class APIDriver(MAASDriver):
         """
         return self.client.post(u'/nodegroups/', op='import_boot_images')
 
+    ###########################################################################
+    # Boot Resources API - http://maas.ubuntu.com/docs/api.html#boot-resources
+    ###########################################################################
+    def get_boot_resources(self):
+        """
+        Returns the boot resources of the region.
+        """
+        return self._get(u'/boot-resources/')
+
+    def get_boot_resource(self, id):
+        """
+        Returns the boot resource with its sets of files and their progress.
+
+        :param id: numeric id of the boot resource
+        """
+        return self._get(u'/boot-resources/{id}/'.format(id=id))
+
+    def is_importing_boot_resources(self):
+        """
+        Returns whether the region is importing boot resources.
+        """
+        return self._get(u'/boot-resources/', op='is_importing')
+
     ###########################################################################
     # Nodegroup API - http://maas.ubuntu.com/docs/api.html#nodegroups
     ###########################################################################
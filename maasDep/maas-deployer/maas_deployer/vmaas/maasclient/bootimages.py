@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 #
 # Provides a polling infrastructure for querying the MAAS
-# Web-API to provide boot image import status information.
+# boot-resources API to provide boot image import status information.
 #
 
-import urllib
-import httplib2
-import json
+import collections
+import time
+
+# Number of seconds of progress over which the import rate is measured.
+IMPORT_RATE_WINDOW = 60
+# Number of seconds without progress after which an import is stalled.
+IMPORT_STALL_TIMEOUT = 600
+# Number of seconds to wait for an import to start before taking the
+# resources already imported to be all there is.
+IMPORT_START_TIMEOUT = 60
 
 
 def sequence_no(num):
@@ -15,133 +22,196 @@ def sequence_no(num):
         num = num + 1
 
 
-class ImageImportChecker(object):
+class BootResourceProgress(object):
     """
-    An object which can check the status of importing boot-images.
+    The progress of importing the latest set of files of a boot resource, as
+    read from the boot-resources API.
     """
-    def __init__(self, host, username, password):
-        self.host = host
-        self.username = username
-        self.password = password
-        self.headers = {}
-        self.http = httplib2.Http()
-        self.sequence = sequence_no(1)
 
-    @property
-    def is_logged_in(self):
-        return 'Cookie' in self.headers
-
-    def do_login(self):
-        # First, we have to get the login page in order to get
-        # the csrf tokens.
-        url = 'http://%(host)s/MAAS' % {'host': self.host}
-        response, _ = self.http.request(url, 'GET')
-        self.headers['Content-type'] = 'application/x-www-form-urlencoded'
-        self.headers['Cookie'] = response['set-cookie']
-
-        csrf_token = self.headers['Cookie'].split(';')[0].split('=')[1]
-        body = {
-            'username': self.username,
-            'password': self.password,
-            'next': '/MAAS/images',
-            'csrfmiddlewaretoken': csrf_token
-        }
-
-        url = 'http://%(host)s/MAAS/accounts/login/' % {'host': self.host}
-        response, _ = self.http.request(url, 'POST', headers=self.headers,
-                                        body=urllib.urlencode(body))
-
-        # Expect a 302 redirect
-        if '302' == response['status']:
-            self.headers['Cookie'] = response['set-cookie']
-            del self.headers['Content-type']
-        else:
-            raise Exception("Unexpected response: %s" % response)
-
-    def get_status(self):
-        if not self.is_logged_in:
-            self.do_login()
-
-        url = ('http://%(host)s/MAAS/images/?sequence=%(sequence)d' %
-               {'host': self.host, 'sequence': self.sequence.next()})
-        self.headers['X-Requested-With'] = 'XMLHttpRequest'
-        response, content = self.http.request(url, 'GET', headers=self.headers)
-
-        if 'set-cookie' in response:
-            self.headers['Cookie'] = response['set-cookie']
-
-        if not response['status'] == '200':
-            raise Exception("Unexpected response received: %s" % response)
-
-        data = json.loads(content)
-        return ImportStatus(data)
-
-    def did_downloads_start(self):
-        status = self.get_status()
-        if status.cluster_import_running or status.region_import_running:
-            return True
-
-        completed = 0
-        for resource in status.resources:
-            if resource.downloading:
-                return True
-            if resource.complete:
-                completed = completed + 1
-
-        # If everything is complete...
-        if completed == len(status.resources):
-            return True
-
-        # What other ways can we tell?
-        return False
-
-    def are_images_complete(self):
-        status = self.get_status()
-        cluster_import_running = status.cluster_import_running
-        region_import_running = status.region_import_running
-
-        if cluster_import_running is False and region_import_running is False:
-            if len(status.resources) == 0:
-                return (False, status)
-            return (True, status)
+    def __init__(self, resource):
+        self.name = resource.get('name')
+        self.architecture = resource.get('architecture')
+        self.size = 0
+        self.done = 0
+        self.complete = False
+        sets = resource.get('sets') or {}
+        if not sets:
+            return
+
+        latest = sets[max(sets)]
+        files = (latest.get('files') or {}).values()
+        self.size = latest.get('size') or sum(f.get('size', 0) for f in files)
+        self.complete = bool(latest.get('complete'))
+        if self.complete:
+            self.done = self.size
+        elif files:
+            self.done = sum(f.get('size', 0) if f.get('complete') else
+                            f.get('size', 0) * f.get('progress', 0) / 100.0
+                            for f in files)
         else:
-            return (False, status)
+            self.done = self.size * latest.get('progress', 0) / 100.0
+
+    def __str__(self):
+        return '%s/%s' % (self.name, self.architecture)
+
+
+class BootResourceMonitor(object):
+    """
+    Monitors the import of boot resources through the boot-resources API,
+    tracking the progress of each resource to work out the rate of the
+    import, when it should finish and whether it has stalled.
+    """
 
+    def __init__(self, client, stall_timeout=IMPORT_STALL_TIMEOUT,
+                 start_timeout=IMPORT_START_TIMEOUT, clock=time.time):
+        self.client = client
+        self.stall_timeout = stall_timeout
+        self.start_timeout = start_timeout
+        self.clock = clock
+        self.started = clock()
+        self.last_progress = self.started
+        # id -> BootResourceProgress
+        self.resources = {}
+        self.importing = None
+        self.import_seen = False
+        self.clusters_synced = False
+        self._last_done = 0
+        # (time, bytes done) over the last IMPORT_RATE_WINDOW seconds
+        self._samples = collections.deque()
 
-class ImportStatus(dict):
+    @property
+    def size(self):
+        return sum(r.size for r in self.resources.values())
 
     @property
-    def cluster_import_running(self):
-        return self['cluster_import_running']
+    def done(self):
+        return sum(r.done for r in self.resources.values())
 
     @property
-    def region_import_running(self):
-        return self['region_import_running']
+    def pending(self):
+        return [r for r in self.resources.values() if not r.complete]
 
     @property
-    def resources(self):
-        resource_data = self['resources']
-        return [BootResourceStatus(data) for data in resource_data]
+    def rate(self):
+        """Returns the import rate in bytes per second, or None."""
+        if len(self._samples) < 2:
+            return None
 
+        (start, start_done), (end, end_done) = \
+            self._samples[0], self._samples[-1]
+        if end <= start:
+            return None
 
-class BootResourceStatus(dict):
+        return (end_done - start_done) / float(end - start)
 
     @property
-    def status(self):
-        return self['status']
+    def eta(self):
+        """Returns the number of seconds the import should take to finish,
+        or None if that is not known."""
+        rate = self.rate
+        if not rate or rate <= 0:
+            return None
 
-    @property
-    def last_update(self):
-        return self['lastUpdate']
+        return (self.size - self.done) / rate
 
     @property
-    def downloading(self):
-        return self.get('downloading', False)
+    def stalled(self):
+        return (not self.complete and
+                self.clock() - self.last_progress > self.stall_timeout)
 
     @property
     def complete(self):
-        return self.get('complete', False)
-
-    @property
-    def title(self):
-        return self['title']
+        if not self.resources or self.pending or self.importing:
+            return False
+
+        # Resources imported before may show as complete before an import
+        # that was just started gets going.
+        if (not self.import_seen and
+                self.clock() - self.started < self.start_timeout):
+            return False
+
+        return self.clusters_synced
+
+    def reset_stall(self):
+        """Restarts the stall timer e.g. when the import is triggered
+        again."""
+        self.last_progress = self.clock()
+
+    def _update_resources(self):
+        for resource in self.client.get_boot_resources() or []:
+            if resource.get('type', 'Synced') != 'Synced':
+                continue
+
+            current = self.resources.get(resource['id'])
+            if current and current.complete:
+                continue
+
+            detail = self.client.get_boot_resource(resource['id'])
+            if detail:
+                self.resources[resource['id']] = BootResourceProgress(detail)
+
+    def _are_clusters_synced(self):
+        """
+        Returns True once every cluster has the boot images of all the
+        resources of the region. Clusters may still only have the images of
+        an earlier import e.g. the first stage of a staged import.
+        """
+        wanted = set((r.name, r.architecture)
+                     for r in self.resources.values())
+        for nodegroup in self.client.get_nodegroups() or []:
+            images = set(('%s/%s' % (i.get('osystem'), i.get('release')),
+                          '%s/%s' % (i.get('architecture'),
+                                     i.get('subarchitecture')))
+                         for i in self.client.get_boot_images(nodegroup) or [])
+            if not images or not wanted.issubset(images):
+                return False
+
+        return True
+
+    def poll(self):
+        """
+        Reads the state of the import.
+
+        :returns: True if the import is complete
+        """
+        self._update_resources()
+        self.importing = self.client.is_importing_boot_resources()
+        if self.importing or self.pending:
+            self.import_seen = True
+
+        now = self.clock()
+        done = self.done
+        if done > self._last_done:
+            self._last_done = done
+            self.last_progress = now
+
+        self._samples.append((now, done))
+        while (len(self._samples) > 2 and
+               now - self._samples[0][0] > IMPORT_RATE_WINDOW):
+            self._samples.popleft()
+
+        self.clusters_synced = False
+        if self.resources and not self.pending and not self.importing:
+            self.clusters_synced = self._are_clusters_synced()
+
+        return self.complete
+
+    def format_status(self):
+        """Returns a one line summary of the progress of the import."""
+        mib = float(1 << 20)
+        status = ('%d%% of %.1f MiB, %d of %d resources' %
+                  (self.done * 100 / max(self.size, 1), self.size / mib,
+                   len(self.resources) - len(self.pending),
+                   len(self.resources)))
+        rate = self.rate
+        if rate is not None:
+            status += ', %.1f MiB/s' % (rate / mib)
+
+        eta = self.eta
+        if eta is not None:
+            status += ', ETA %dm%02ds' % divmod(int(eta), 60)
+
+        if not self.pending and self.resources:
+            status += ', syncing clusters'
+
+        return status
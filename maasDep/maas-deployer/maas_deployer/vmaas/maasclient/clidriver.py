@@ -170,6 +170,29 @@ class CLIDriver(MAASDriver):
         """
         return self._maas_execute('boot-resources', 'import')
 
+    ###########################################################################
+    # Boot Resources API - http://maas.ubuntu.com/docs/api.html#boot-resources
+    ###########################################################################
+    def get_boot_resources(self):
+        """
+        Returns the boot resources of the region.
+        """
+        return self._maas_execute('boot-resources', 'read')
+
+    def get_boot_resource(self, id):
+        """
+        Returns the boot resource with its sets of files and their progress.
+
+        :param id: numeric id of the boot resource
+        """
+        return self._maas_execute('boot-resource', 'read', id)
+
+    def is_importing_boot_resources(self):
+        """
+        Returns whether the region is importing boot resources.
+        """
+        return self._maas_execute('boot-resources', 'is-importing')
+
     ###########################################################################
     # Boot Source Selections API - m.u.c/docs/api.html#boot-source-selections
     ###########################################################################
@@ -198,6 +221,28 @@ class CLIDriver(MAASDriver):
         """
         return self._maas_execute('boot-source-selections', 'read', source_id)
 
+    def update_boot_source_selection(self, source_id, selection_id,
+                                     **settings):
+        """
+        Update a boot source selection.
+
+        :param source_id: numeric id
+        :param selection_id: numeric id of the selection
+        :param settings: e.g. arches, subarches, labels
+        """
+        return self._maas_execute('boot-source-selection', 'update',
+                                  source_id, selection_id, **settings)
+
+    def delete_boot_source_selection(self, source_id, selection_id):
+        """
+        Delete a boot source selection.
+
+        :param source_id: numeric id
+        :param selection_id: numeric id of the selection
+        """
+        return self._maas_execute('boot-source-selection', 'delete',
+                                  source_id, selection_id)
+
     ###########################################################################
     # Nodegroup API - http://maas.ubuntu.com/docs/api.html#nodegroups
     ###########################################################################
@@ -99,6 +99,29 @@ class MAASDriver(object):
         """
         raise NotImplementedError()
 
+    ###########################################################################
+    # Boot Resources API - http://maas.ubuntu.com/docs/api.html#boot-resources
+    ###########################################################################
+    def get_boot_resources(self):
+        """
+        Returns the boot resources of the region.
+        """
+        raise NotImplementedError()
+
+    def get_boot_resource(self, id):
+        """
+        Returns the boot resource with its sets of files and their progress.
+
+        :param id: numeric id of the boot resource
+        """
+        raise NotImplementedError()
+
+    def is_importing_boot_resources(self):
+        """
+        Returns whether the region is importing boot resources.
+        """
+        raise NotImplementedError()
+
     ###########################################################################
     # Nodegroup API - http://maas.ubuntu.com/docs/api.html#nodegroups
     ###########################################################################
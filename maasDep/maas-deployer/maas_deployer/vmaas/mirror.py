@@ -0,0 +1,345 @@
+#
+# Copyright 2015, Canonical Ltd
+#
+# A partial mirror of a simplestreams boot image source kept on the deployer
+# host and served over HTTP, so that MAAS imports its boot images from the
+# local network rather than from maas.ubuntu.com.
+#
+
+import argparse
+import BaseHTTPServer
+import json
+import logging
+import os
+import posixpath
+import re
+import SimpleHTTPServer
+import SocketServer
+import sys
+import urllib
+import urllib2
+import urlparse
+
+from maas_deployer.vmaas.download import DOWNLOAD_ERRORS, Downloader
+from maas_deployer.vmaas.exception import (
+    MAASDeployerConfigError,
+    MAASDeployerDownloadError,
+)
+from maas_deployer.vmaas.proxy import (
+    PROXY_ADDRESS,
+    PROXY_START_TIMEOUT,
+    start_service,
+)
+from maas_deployer.vmaas.util import CACHE_DIR, is_port_open
+
+log = logging.getLogger('vmaas.main')
+
+MIRROR_PORT = 8124
+MIRROR_DIR = os.path.join(CACHE_DIR, 'simplestreams')
+MIRROR_TIMEOUT = 60
+# The boot source MAAS uses unless another is configured.
+DEFAULT_BOOT_SOURCE_URL = \
+    'http://maas.ubuntu.com/images/ephemeral-v2/releases/'
+# Keyring the metadata of the default boot source is signed with. The
+# metadata is mirrored unmodified so it still verifies against it.
+DEFAULT_KEYRING = '/usr/share/keyrings/ubuntu-cloudimage-keyring.gpg'
+INDEX_PATH = 'streams/v1/index.json'
+
+# Fields of boot source selections and the fields of the products they are
+# matched against.
+SELECTION_FIELDS = [
+    ('os', 'os'),
+    ('release', 'release'),
+    ('arches', 'arch'),
+    ('subarches', 'subarch'),
+    ('labels', 'label'),
+]
+
+PGP_SIGNED_HEADER = '-----BEGIN PGP SIGNED MESSAGE-----'
+PGP_SIGNATURE_HEADER = '-----BEGIN PGP SIGNATURE-----'
+
+
+def get_mirror_name(url):
+    """Returns the name of the directory the mirror of url is kept in."""
+    parsed = urlparse.urlparse(url)
+    return re.sub(r'[^A-Za-z0-9.-]+', '_',
+                  parsed.netloc + parsed.path).strip('_')
+
+
+def get_signed_path(path):
+    """
+    Returns the path of the signed (.sjson) counterpart of a metadata file or
+    the unsigned (.json) counterpart of a signed one.
+    """
+    root, ext = os.path.splitext(path)
+    return root + ('.json' if ext == '.sjson' else '.sjson')
+
+
+def load_metadata(content):
+    """Returns the JSON content of a metadata file, which may be signed."""
+    if content.startswith(PGP_SIGNED_HEADER):
+        # The signed text follows the armor headers, which end at the first
+        # blank line, and lines starting with '-' are escaped with '- '.
+        content = content.split('\n\n', 1)[1]
+        content = content.split('\n' + PGP_SIGNATURE_HEADER, 1)[0]
+        content = '\n'.join(line[2:] if line.startswith('- ') else line
+                            for line in content.split('\n'))
+
+    return json.loads(content)
+
+
+def _as_list(value):
+    if isinstance(value, basestring):
+        return [v.strip() for v in value.split(',')]
+
+    return list(value)
+
+
+def matches_selection(product, selection):
+    """
+    Returns True if the product is one the boot source selection imports.
+    Fields the product does not have and '*' in the selection match
+    anything.
+    """
+    for key, field in SELECTION_FIELDS:
+        wanted = selection.get(key, '*')
+        if wanted is None or field not in product:
+            continue
+
+        wanted = _as_list(wanted)
+        if '*' not in wanted and product[field] not in wanted:
+            return False
+
+    return True
+
+
+def get_selected_items(products, selections):
+    """
+    Yields the items of the latest version of each product matched by one of
+    the selections, which is what MAAS imports. Bootloaders are imported
+    whatever the selections so they only need to match an arch.
+    """
+    for name in sorted(products):
+        product = products[name]
+        if 'bootloader-type' in product:
+            selected = any(matches_selection({'arch': product.get('arch')},
+                                             {'arches': s.get('arches', '*')})
+                           for s in selections)
+        else:
+            selected = any(matches_selection(product, s) for s in selections)
+
+        versions = product.get('versions')
+        if not selected or not versions:
+            continue
+
+        latest = versions[max(versions)]
+        for item in latest.get('items', {}).values():
+            yield item
+
+
+class SimpleStreamsMirror(object):
+    """
+    A partial mirror of the simplestreams tree at url in path, holding the
+    boot images matched by the boot source selections.
+
+    The metadata (indexes and product files) is mirrored whole and
+    unmodified so that its signatures remain valid, but only the files of
+    the selected products are fetched, the same way MAAS fetches them.
+    """
+
+    def __init__(self, url, path, selections):
+        if not url.endswith('/'):
+            url += '/'
+
+        self.url = url
+        self.path = path
+        self.selections = [s for s in selections if s]
+
+    def has_index(self):
+        return os.path.exists(os.path.join(self.path, INDEX_PATH))
+
+    def _read(self, relpath, optional=False):
+        url = urlparse.urljoin(self.url, relpath)
+        try:
+            resp = urllib2.urlopen(url, timeout=MIRROR_TIMEOUT)
+            try:
+                return resp.read()
+            finally:
+                resp.close()
+        except urllib2.HTTPError as e:
+            if optional and e.code == 404:
+                return None
+
+            raise MAASDeployerDownloadError("Unable to fetch %s: %s" %
+                                            (url, e))
+        except DOWNLOAD_ERRORS as e:
+            raise MAASDeployerDownloadError("Unable to fetch %s: %s" %
+                                            (url, e))
+
+    def _local_path(self, relpath):
+        path = os.path.normpath(os.path.join(self.path, relpath))
+        if not path.startswith(os.path.join(self.path, '')):
+            raise MAASDeployerDownloadError("Refusing to mirror %s outside "
+                                            "of %s" % (relpath, self.path))
+
+        return path
+
+    def _write(self, relpath, content):
+        path = self._local_path(relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        tmp = '%s.tmp' % (path)
+        with open(tmp, 'wb') as fd:
+            fd.write(content)
+
+        os.rename(tmp, path)
+
+    def _fetch_item(self, item):
+        """
+        Fetches the file of an item unless it is already mirrored.
+
+        :returns: the number of bytes fetched
+        """
+        path = self._local_path(item['path'])
+        size = item.get('size')
+        if os.path.exists(path) and (size is None or
+                                     os.path.getsize(path) == int(size)):
+            return 0
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        Downloader(urlparse.urljoin(self.url, item['path']), path,
+                   sha256=item.get('sha256')).run()
+        return os.path.getsize(path)
+
+    def _read_metadata(self, metadata, relpath):
+        """
+        Reads the metadata file at relpath and its signed or unsigned
+        counterpart into metadata, returning its content.
+        """
+        content = self._read(relpath)
+        metadata[relpath] = content
+        counterpart = get_signed_path(relpath)
+        if counterpart not in metadata:
+            signed = self._read(counterpart, optional=True)
+            if signed is not None:
+                metadata[counterpart] = signed
+
+        return load_metadata(content)
+
+    def sync(self):
+        """
+        Brings the mirror up to date with the upstream tree.
+
+        The metadata is only replaced once all the selected files have been
+        fetched so the tree served stays consistent if this fails part way.
+
+        :returns: the number of bytes of files fetched
+        """
+        log.info("Updating mirror of %s in %s", self.url, self.path)
+        metadata = {}
+        index = self._read_metadata(metadata, INDEX_PATH)
+        fetched = 0
+        for name, stream in sorted(index.get('index', {}).items()):
+            if stream.get('format') != 'products:1.0':
+                continue
+
+            products = self._read_metadata(metadata, stream['path'])
+            for item in get_selected_items(products.get('products', {}),
+                                           self.selections):
+                fetched += self._fetch_item(item)
+
+        # Indexes last, since they reference the product files.
+        for relpath in sorted(metadata, key=lambda p: '/index.' in p):
+            self._write(relpath, metadata[relpath])
+
+        log.info("Mirror of %s is up to date (%.1f MiB fetched)", self.url,
+                 fetched / float(1 << 20))
+        return fetched
+
+    def update(self, offline=False):
+        """
+        Syncs the mirror, falling back to the tree already mirrored if the
+        upstream source cannot be reached e.g. in an air-gapped lab.
+        """
+        if not offline:
+            try:
+                return self.sync()
+            except MAASDeployerDownloadError as e:
+                if not self.has_index():
+                    raise
+
+                log.warning("Unable to update mirror of %s - serving the "
+                            "existing mirror: %s", self.url, e)
+                return 0
+
+        if not self.has_index():
+            raise MAASDeployerConfigError("No mirror of %s found in %s to use "
+                                          "offline" % (self.url, self.path))
+
+        return 0
+
+
+class MirrorRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serves the files under the directory of the server."""
+
+    def log_message(self, fmt, *args):
+        log.debug("%s %s", self.client_address[0], fmt % args)
+
+    def translate_path(self, path):
+        path = posixpath.normpath(urllib.unquote(
+            path.split('?', 1)[0].split('#', 1)[0]))
+        words = [w for w in path.split('/')
+                 if w and w not in (os.curdir, os.pardir)]
+        return os.path.join(self.server.directory, *words)
+
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, directory):
+        BaseHTTPServer.HTTPServer.__init__(self, address,
+                                           MirrorRequestHandler)
+        self.directory = directory
+
+
+def ensure_running(port=MIRROR_PORT, path=MIRROR_DIR,
+                   timeout=PROXY_START_TIMEOUT, address=PROXY_ADDRESS):
+    """
+    Starts serving the mirrors in path over HTTP on address as a process of
+    its own, which keeps running after the deployer exits since MAAS goes on
+    importing from it, unless something is already listening there.
+    """
+    if is_port_open(address, port):
+        log.debug("Mirror server already listening on %s:%s", address, port)
+        return
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    cmd = [sys.executable, '-m', 'maas_deployer.vmaas.mirror',
+           '--address', address, '--port', str(port), '--path', path]
+    start_service("mirror server (%s)" % (path), cmd, address, port,
+                  os.path.join(path, 'mirror.log'), timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simplestreams mirror "
+                                                 "server")
+    parser.add_argument('--address', default=PROXY_ADDRESS)
+    parser.add_argument('--port', type=int, default=MIRROR_PORT)
+    parser.add_argument('--path', default=MIRROR_DIR)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    server = MirrorServer((args.address, args.port), args.path)
+    log.info("Serving %s on %s:%s", args.path, args.address, args.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
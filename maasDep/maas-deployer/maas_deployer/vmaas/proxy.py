@@ -0,0 +1,411 @@
+#
+# Copyright 2015, Canonical Ltd
+#
+# A caching HTTP forward proxy run on the deployer host, so that the packages
+# and boot images downloaded for one environment are served from local disk
+# to the next.
+#
+
+import argparse
+import BaseHTTPServer
+import collections
+import errno
+import hashlib
+import json
+import logging
+import os
+import re
+import select
+import socket
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+from maas_deployer.vmaas.exception import MAASDeployerTimeout
+from maas_deployer.vmaas.util import CACHE_DIR, is_port_open, parse_size
+
+log = logging.getLogger('vmaas.main')
+
+PROXY_PORT = 8123
+# Address the proxy listens on unless another is given.
+PROXY_ADDRESS = '127.0.0.1'
+PROXY_CACHE_DIR = os.path.join(CACHE_DIR, 'proxy')
+PROXY_CACHE_SIZE = '20G'
+# Number of seconds to wait for a newly started proxy to listen.
+PROXY_START_TIMEOUT = 10
+PROXY_TIMEOUT = 60
+COPY_BLOCK_SIZE = 64 * 1024
+# Ports which CONNECT can tunnel to, so that the proxy does not relay
+# arbitrary connections.
+CONNECT_PORTS = [443]
+
+# Only files which never change once published are cached: packages and the
+# files of boot image versions. Package indexes and simplestreams indexes
+# (under dists/ and streams/) always go to the origin.
+CACHEABLE_PATH = re.compile(r'(\.(deb|udeb|gz|xz|bz2|tgz|img|squashfs)|'
+                            r'/(boot|di)-(kernel|initrd|dtb)|'
+                            r'/root-(tgz|tar\.xz)|/squashfs)$')
+UNCACHEABLE_PATH = re.compile(r'/(dists|streams)/')
+# Names of the files holding cached content (see ProxyCache.key()).
+CACHE_KEY = re.compile(r'^[0-9a-f]{64}$')
+
+# Headers which apply to a single connection and are not forwarded.
+HOP_BY_HOP_HEADERS = set(['connection', 'keep-alive', 'proxy-authenticate',
+                          'proxy-authorization', 'proxy-connection', 'te',
+                          'trailers', 'transfer-encoding', 'upgrade'])
+
+
+def is_cacheable(url):
+    path = url.split('?', 1)[0]
+    return (CACHEABLE_PATH.search(path) is not None and
+            UNCACHEABLE_PATH.search(path) is None)
+
+
+class ProxyCache(object):
+    """
+    A cache of the content of urls on disk, limited to max_size bytes by
+    evicting the least recently used entries.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.size = 0
+        self._lock = threading.Lock()
+        # key -> size, least recently used first
+        self._entries = collections.OrderedDict()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self._load()
+
+    def _load(self):
+        entries = []
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if name.endswith('.part'):
+                os.remove(path)
+            elif CACHE_KEY.match(name):
+                st = os.stat(path)
+                entries.append((st.st_mtime, name, st.st_size))
+
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self.size += size
+
+        self._evict()
+        log.debug("Proxy cache %s holds %d files (%d bytes)", self.path,
+                  len(self._entries), self.size)
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha256(url).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, url):
+        """
+        Returns (fd, meta) with the cached content of url open for reading,
+        or None.
+        """
+        key = self.key(url)
+        with self._lock:
+            if key not in self._entries:
+                return None
+
+            self._entries[key] = self._entries.pop(key)
+            path = self._path(key)
+            try:
+                os.utime(path, None)
+                with open(path + '.meta') as meta_fd:
+                    meta = json.load(meta_fd)
+
+                # Opened while locked so that it is not evicted before then.
+                fd = open(path, 'rb')
+            except (IOError, OSError, ValueError) as e:
+                log.debug("Dropping bad proxy cache entry %s: %s", key, e)
+                self._remove(key)
+                return None
+
+        return (fd, meta)
+
+    def new_file(self):
+        """Returns an open file to write content to be put in the cache."""
+        fd, path = tempfile.mkstemp(dir=self.path, suffix='.part')
+        os.close(fd)
+        return open(path, 'wb')
+
+    def put(self, url, fd, meta):
+        """Adds the content written to fd (from new_file()) for url."""
+        key = self.key(url)
+        path = self._path(key)
+        fd.close()
+        size = os.path.getsize(fd.name)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            with open(path + '.meta', 'w') as meta_fd:
+                json.dump(meta, meta_fd)
+
+            os.rename(fd.name, path)
+            self._entries[key] = size
+            self.size += size
+            self._evict()
+
+    def discard(self, fd):
+        fd.close()
+        if os.path.exists(fd.name):
+            os.remove(fd.name)
+
+    def _remove(self, key):
+        self.size -= self._entries.pop(key, 0)
+        for path in (self._path(key), self._path(key) + '.meta'):
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _evict(self):
+        while self.size > self.max_size and self._entries:
+            key = next(iter(self._entries))
+            log.debug("Evicting %s from proxy cache", key)
+            self._remove(key)
+
+
+class ProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.0'
+
+    def log_message(self, fmt, *args):
+        log.debug("%s %s", self.client_address[0], fmt % args)
+
+    def do_GET(self):
+        self._proxy(send_body=True)
+
+    def do_HEAD(self):
+        self._proxy(send_body=False)
+
+    def do_CONNECT(self):
+        """Tunnels https connections without caching them."""
+        host, _, port = self.path.rpartition(':')
+        try:
+            port = int(port)
+        except ValueError:
+            self.send_error(400, "Bad CONNECT target %s" % (self.path))
+            return
+
+        if port not in CONNECT_PORTS:
+            self.send_error(403, "CONNECT to port %s is not allowed" % (port))
+            return
+
+        try:
+            upstream = socket.create_connection((host, port), PROXY_TIMEOUT)
+        except socket.error as e:
+            self.send_error(502, str(e))
+            return
+
+        self.send_response(200, 'Connection established')
+        self.end_headers()
+        socks = [self.connection, upstream]
+        try:
+            while True:
+                readable, _, _ = select.select(socks, [], [], PROXY_TIMEOUT)
+                if not readable:
+                    break
+
+                for sock in readable:
+                    data = sock.recv(COPY_BLOCK_SIZE)
+                    if not data:
+                        return
+
+                    other = upstream if sock is self.connection else \
+                        self.connection
+                    other.sendall(data)
+        except socket.error:
+            pass
+        finally:
+            upstream.close()
+
+    def _send_cached(self, fd, meta, send_body):
+        self.server.hits += 1
+        with fd:
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             meta.get('content_type',
+                                      'application/octet-stream'))
+            self.send_header('Content-Length',
+                             str(os.fstat(fd.fileno()).st_size))
+            self.send_header('X-Cache', 'HIT')
+            self.end_headers()
+            if send_body:
+                for block in iter(lambda: fd.read(COPY_BLOCK_SIZE), ''):
+                    self.wfile.write(block)
+
+    def _proxy(self, send_body):
+        url = self.path
+        if not url.startswith('http://'):
+            self.send_error(400, "Only absolute http urls can be proxied")
+            return
+
+        cache = self.server.cache
+        cacheable = is_cacheable(url) and 'range' not in self.headers
+        if cacheable:
+            hit = cache.get(url)
+            if hit:
+                self._send_cached(hit[0], hit[1], send_body)
+                return
+
+        headers = dict((k, v) for k, v in self.headers.items()
+                       if k.lower() not in HOP_BY_HOP_HEADERS)
+        request = urllib2.Request(url, headers=headers)
+        request.get_method = lambda: self.command
+        try:
+            response = self.server.opener.open(request,
+                                               timeout=PROXY_TIMEOUT)
+        except urllib2.HTTPError as e:
+            response = e
+        except (urllib2.URLError, socket.error) as e:
+            self.send_error(502, str(e))
+            return
+
+        try:
+            self._relay(url, response, send_body,
+                        cacheable and response.getcode() == 200 and
+                        self.command == 'GET')
+        finally:
+            response.close()
+
+    def _relay(self, url, response, send_body, store):
+        self.server.misses += 1
+        self.send_response(response.getcode())
+        info = response.info()
+        for header in info.keys():
+            if header.lower() not in HOP_BY_HOP_HEADERS:
+                self.send_header(header, info.getheader(header))
+
+        self.send_header('X-Cache', 'MISS')
+        self.end_headers()
+        if not send_body:
+            return
+
+        cache = self.server.cache
+        fd = cache.new_file() if store else None
+        length = 0
+        try:
+            for block in iter(lambda: response.read(COPY_BLOCK_SIZE), ''):
+                self.wfile.write(block)
+                if fd:
+                    fd.write(block)
+
+                length += len(block)
+        except (IOError, socket.error) as e:
+            log.debug("Transfer of %s failed: %s", url, e)
+            if fd:
+                cache.discard(fd)
+            return
+
+        if fd:
+            expected = info.getheader('Content-Length')
+            if expected is not None and int(expected) != length:
+                cache.discard(fd)
+            else:
+                cache.put(url, fd, {'url': url,
+                                    'content_type': info.gettype()})
+
+
+class CachingProxyServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, cache):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ProxyRequestHandler)
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+        # Redirects are followed here rather than by the client so that the
+        # content is cached under the url the client asked for.
+        self.opener = urllib2.build_opener()
+
+
+def get_local_address(remote):
+    """Returns the address of this host on the route to remote."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect((remote, 9))
+        return sock.getsockname()[0]
+    finally:
+        sock.close()
+
+
+def start_service(description, cmd, address, port, log_path,
+                  timeout=PROXY_START_TIMEOUT):
+    """
+    Runs cmd as a process of its own, detached from the deployer so that it
+    keeps running after the deployer exits, with its output going to
+    log_path, and waits for it to listen on address and port.
+    """
+    log.info("Starting %s on %s:%s (log %s)", description, address, port,
+             log_path)
+    with open(os.devnull) as null, open(log_path, 'a') as log_fd:
+        subprocess.Popen(cmd, stdin=null, stdout=log_fd,
+                         stderr=subprocess.STDOUT, close_fds=True,
+                         preexec_fn=os.setsid)
+
+    deadline = time.time() + timeout
+    while not is_port_open(address, port):
+        if time.time() > deadline:
+            raise MAASDeployerTimeout("Timed out after %ss waiting for %s to "
+                                      "listen on %s:%s - see %s" %
+                                      (timeout, description, address, port,
+                                       log_path))
+        time.sleep(0.2)
+
+
+def ensure_running(port=PROXY_PORT, cache_dir=PROXY_CACHE_DIR,
+                   max_size=PROXY_CACHE_SIZE, timeout=PROXY_START_TIMEOUT,
+                   address=PROXY_ADDRESS):
+    """
+    Starts the caching proxy listening on address as a process of its own,
+    which keeps running after the deployer exits since MAAS goes on using
+    it, unless something is already listening there.
+    """
+    if is_port_open(address, port):
+        log.debug("Caching proxy already listening on %s:%s", address, port)
+        return
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    cmd = [sys.executable, '-m', 'maas_deployer.vmaas.proxy',
+           '--address', address, '--port', str(port),
+           '--cache-dir', cache_dir, '--max-size', str(max_size)]
+    start_service("caching proxy (cache %s)" % (cache_dir), cmd, address,
+                  port, os.path.join(cache_dir, 'proxy.log'), timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Caching HTTP proxy")
+    parser.add_argument('--address', default=PROXY_ADDRESS)
+    parser.add_argument('--port', type=int, default=PROXY_PORT)
+    parser.add_argument('--cache-dir', default=PROXY_CACHE_DIR)
+    parser.add_argument('--max-size', default=PROXY_CACHE_SIZE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    cache = ProxyCache(args.cache_dir, parse_size(args.max_size))
+    server = CachingProxyServer((args.address, args.port), cache)
+    log.info("Caching proxy listening on %s:%s", args.address, args.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+#
+# Copyright 2015, Canonical Ltd
+#
+# In memory construction of cloud-init NoCloud seed images: the MIME
+# multipart user-data and the ISO9660 'cidata' filesystem holding it.
+#
+
+import hashlib
+import struct
+import time
+
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+SECTOR_SIZE = 2048
+# Label cloud-init looks for to find a NoCloud seed filesystem.
+VOLUME_ID = 'cidata'
+# Offset of the application identifier, used to hold the digest of the seed
+# content, within the primary volume descriptor.
+APPLICATION_ID_OFFSET = 574
+DIGEST_PREFIX = 'MAAS-DEPLOYER SEED SHA256:'
+
+# Content types of user-data parts by their first line, as used by cloud-init
+# (and write-mime-multipart). Longer prefixes come first.
+CONTENT_TYPES = [
+    ('#include-once', 'text/x-include-once-url'),
+    ('#include', 'text/x-include-url'),
+    ('#cloud-config-archive', 'text/cloud-config-archive'),
+    ('#cloud-config', 'text/cloud-config'),
+    ('#cloud-boothook', 'text/cloud-boothook'),
+    ('#upstart-job', 'text/upstart-job'),
+    ('#part-handler', 'text/part-handler'),
+    ('#!', 'text/x-shellscript'),
+]
+
+
+def _to_bytes(content):
+    if isinstance(content, unicode):
+        return content.encode('utf-8')
+
+    return content
+
+
+def get_content_type(content):
+    """Returns the cloud-init content type of a user-data part."""
+    for prefix, content_type in CONTENT_TYPES:
+        if content.startswith(prefix):
+            return content_type
+
+    return 'text/plain'
+
+
+def _normalize_parts(parts):
+    """Returns parts as a list of (filename, content, content_type)."""
+    normalized = []
+    for part in parts:
+        filename, content = part[0], _to_bytes(part[1])
+        content_type = part[2] if len(part) > 2 else None
+        if not content_type:
+            content_type = get_content_type(content)
+
+        normalized.append((filename, content, content_type))
+
+    return normalized
+
+
+def get_digest(parts, meta_data):
+    """
+    Returns the sha256 hex digest of the content of a seed image made from
+    the user-data parts and meta-data.
+    """
+    digest = hashlib.sha256()
+    for filename, content, content_type in _normalize_parts(parts):
+        for field in (filename, content_type, content):
+            field = _to_bytes(field)
+            digest.update('%d:%s' % (len(field), field))
+
+    meta_data = _to_bytes(meta_data)
+    digest.update('%d:%s' % (len(meta_data), meta_data))
+    return digest.hexdigest()
+
+
+def make_user_data(parts, boundary=None):
+    """
+    Returns MIME multipart user-data combining the parts.
+
+    :param parts: list of (filename, content) or (filename, content,
+                  content_type) tuples. If not given, the content type is
+                  determined from the first line of the content.
+    :param boundary: the MIME boundary to use, random if not given. A fixed
+                     boundary gives the same user-data for the same parts.
+    """
+    msg = MIMEMultipart(boundary=boundary)
+    for filename, content, content_type in _normalize_parts(parts):
+        sub_type = content_type.split('/', 1)[1]
+        mime = MIMEText(content, sub_type, 'utf-8' if _is_unicode(content)
+                        else 'us-ascii')
+        mime.add_header('Content-Disposition', 'attachment',
+                        filename=filename)
+        msg.attach(mime)
+
+    return msg.as_string()
+
+
+def _is_unicode(content):
+    try:
+        content.decode('ascii')
+    except (UnicodeDecodeError, UnicodeEncodeError):
+        return True
+
+    return False
+
+
+def _both16(value):
+    return struct.pack('<H', value) + struct.pack('>H', value)
+
+
+def _both32(value):
+    return struct.pack('<I', value) + struct.pack('>I', value)
+
+
+def _dir_date(t):
+    tm = time.gmtime(t)
+    return struct.pack('7B', tm.tm_year - 1900, tm.tm_mon, tm.tm_mday,
+                       tm.tm_hour, tm.tm_min, tm.tm_sec, 0)
+
+
+def _volume_date(t):
+    return time.strftime('%Y%m%d%H%M%S00', time.gmtime(t)) + '\0'
+
+
+def _pad(data, length, fill=' '):
+    return data[:length].ljust(length, fill)
+
+
+def _dir_record(name, extent, size, t, directory=False):
+    length = 33 + len(name) + (1 - len(name) % 2)
+    record = (struct.pack('BB', length, 0) + _both32(extent) +
+              _both32(size) + _dir_date(t) +
+              struct.pack('BBB', 2 if directory else 0, 0, 0) +
+              _both16(1) + struct.pack('B', len(name)) + name)
+    return _pad(record, length, '\0')
+
+
+def _iso_name(filename):
+    # Linux maps these back to e.g. 'user-data' when mounting.
+    return '%s.;1' % (filename.upper())
+
+
+def make_iso(files, volume_id=VOLUME_ID, application_id='', t=None):
+    """
+    Returns an ISO9660 filesystem image containing files in its root
+    directory.
+
+    :param files: dict of filename to content
+    :param application_id: up to 128 characters recorded in the primary
+                           volume descriptor.
+    """
+    if t is None:
+        t = time.time()
+
+    files = dict((str(name), _to_bytes(data))
+                 for name, data in files.items())
+    names = sorted(files)
+    # Layout: system area (16 sectors), primary volume descriptor,
+    # terminator, L and M path tables, root directory then file data.
+    root_extent = 20
+    extent = root_extent + 1
+    entries = []
+    for name in names:
+        data = files[name]
+        entries.append((_iso_name(name), extent, data))
+        extent += max((len(data) + SECTOR_SIZE - 1) / SECTOR_SIZE, 1)
+
+    total_sectors = extent
+
+    root = (_dir_record('\0', root_extent, SECTOR_SIZE, t, directory=True) +
+            _dir_record('\1', root_extent, SECTOR_SIZE, t, directory=True))
+    for iso_name, file_extent, data in entries:
+        root += _dir_record(iso_name, file_extent, len(data), t)
+
+    if len(root) > SECTOR_SIZE:
+        raise ValueError("Too many files for a seed image")
+
+    path_table_l = struct.pack('<BBIH', 1, 0, root_extent, 1) + '\0\0'
+    path_table_m = struct.pack('>BBIH', 1, 0, root_extent, 1) + '\0\0'
+    date = _volume_date(t)
+
+    pvd = ('\1CD001\1\0' +
+           _pad('LINUX', 32) +
+           _pad(str(volume_id), 32) +
+           '\0' * 8 +
+           _both32(total_sectors) +
+           '\0' * 32 +
+           _both16(1) +
+           _both16(1) +
+           _both16(SECTOR_SIZE) +
+           _both32(10) +
+           struct.pack('<I', 18) + '\0' * 4 +
+           struct.pack('>I', 19) + '\0' * 4 +
+           _dir_record('\0', root_extent, SECTOR_SIZE, t, directory=True) +
+           _pad('', 128) +
+           _pad('', 128) +
+           _pad('', 128) +
+           _pad(str(application_id), 128) +
+           _pad('', 37) * 3 +
+           date + date + '0' * 16 + '\0' + date +
+           '\1\0')
+    terminator = '\xffCD001\1'
+
+    sectors = [
+        '\0' * (16 * SECTOR_SIZE),
+        _pad(pvd, SECTOR_SIZE, '\0'),
+        _pad(terminator, SECTOR_SIZE, '\0'),
+        _pad(path_table_l, SECTOR_SIZE, '\0'),
+        _pad(path_table_m, SECTOR_SIZE, '\0'),
+        _pad(root, SECTOR_SIZE, '\0'),
+    ]
+    for _, file_extent, data in entries:
+        size = max((len(data) + SECTOR_SIZE - 1) / SECTOR_SIZE, 1)
+        sectors.append(_pad(data, size * SECTOR_SIZE, '\0'))
+
+    return ''.join(sectors)
+
+
+def make_seed_image(user_data, meta_data, digest=None):
+    """
+    Returns a NoCloud seed image with the user-data and meta-data.
+
+    :param digest: digest of the content (see get_digest()) to record in the
+                   image.
+    """
+    application_id = '%s%s' % (DIGEST_PREFIX, digest) if digest else ''
+    return make_iso({'user-data': user_data, 'meta-data': meta_data},
+                    application_id=application_id)
+
+
+def read_digest(pvd):
+    """
+    Returns the digest recorded in a seed image given its primary volume
+    descriptor (the 17th sector of the image), or None.
+    """
+    application_id = pvd[APPLICATION_ID_OFFSET:
+                         APPLICATION_ID_OFFSET + 128].rstrip(' \0')
+    if application_id.startswith(DIGEST_PREFIX):
+        return application_id[len(DIGEST_PREFIX):]
+
+    return None
@@ -0,0 +1,383 @@
+#
+# Copyright 2015, Canonical Ltd
+#
+# Creation of storage volumes and upload of images into them through the
+# libvirt stream API.
+#
+
+import ctypes
+import errno
+import fcntl
+import libvirt
+import logging
+import os
+import stat
+import struct
+import sys
+import time
+import urlparse
+
+from lxml import etree
+
+from maas_deployer.vmaas import inventory
+from maas_deployer.vmaas.util import retry_on_exception
+
+log = logging.getLogger('vmaas.main')
+
+# Size of the chunks read from images and sent on upload streams. This is
+# the largest payload libvirt accepts in a single stream message.
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+# lseek() whence values for finding the data and holes of sparse files.
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+# ioctl to share the extents of one file with another (reflink) on
+# filesystems which support it e.g. btrfs and XFS.
+FICLONE = 0x40049409
+
+# Storage pool types whose volumes are plain files in the target directory.
+FILE_POOL_TYPES = ('dir', 'fs', 'netfs')
+# Mode of imported volumes, which the hypervisor needs to be able to read.
+VOLUME_MODE = 0644
+
+QCOW2_MAGIC = 'QFI\xfb'
+# magic, version, backing_file_offset, backing_file_size, cluster_bits, size
+QCOW2_HEADER = struct.Struct('>4sIQIIQ')
+
+VOLUME_XML = """<volume>
+  <name>{name}</name>
+  <capacity unit='bytes'>{capacity}</capacity>
+  <allocation unit='bytes'>0</allocation>
+  <target>
+    <format type='{format}'/>
+  </target>
+</volume>
+"""
+
+
+def get_image_info(path):
+    """
+    Returns the format ('qcow2' or 'raw') and virtual size in bytes of the
+    disk image at path.
+    """
+    with open(path, 'rb') as fd:
+        header = fd.read(QCOW2_HEADER.size)
+
+    if len(header) == QCOW2_HEADER.size:
+        fields = QCOW2_HEADER.unpack(header)
+        if fields[0] == QCOW2_MAGIC:
+            return ('qcow2', fields[5])
+
+    return ('raw', os.path.getsize(path))
+
+
+def create_volume(conn, pool, name, capacity, fmt='raw'):
+    """Creates an empty volume in the storage pool and returns it."""
+    log.debug("Creating %s volume '%s' of %d bytes in pool '%s'", fmt, name,
+              capacity, pool)
+    storage_pool = conn.storagePoolLookupByName(pool)
+    xml = VOLUME_XML.format(name=name, capacity=capacity, format=fmt)
+    return storage_pool.createXML(xml, 0)
+
+
+@retry_on_exception(exc_tuple=[libvirt.libvirtError])
+def refresh_pool(conn, pool):
+    """
+    Refreshes the storage pool, retrying if it is busy e.g. because a volume
+    is being created in it by another thread. The caller is expected to have
+    recorded its changes to the pool in the inventory already.
+    """
+    inv = inventory.find_inventory(conn)
+    if inv is None:
+        conn.storagePoolLookupByName(pool).refresh(0)
+        return
+
+    with inv.own_refresh(pool):
+        conn.storagePoolLookupByName(pool).refresh(0)
+
+
+def get_local_pool_path(conn, pool):
+    """
+    Returns the target directory of the storage pool if the hypervisor is
+    local and the volumes of the pool are plain files, otherwise None.
+    """
+    if urlparse.urlparse(conn.getURI()).netloc:
+        return None
+
+    xml = etree.fromstring(conn.storagePoolLookupByName(pool).XMLDesc(0))
+    if xml.get('type') not in FILE_POOL_TYPES:
+        return None
+
+    path = xml.findtext('target/path')
+    if path and os.path.isdir(path):
+        return path
+
+    return None
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as src_fd:
+        with open(dst, 'wb') as dst_fd:
+            fcntl.ioctl(dst_fd.fileno(), FICLONE, src_fd.fileno())
+
+
+def _hardlink(src, dst):
+    # The volume is the cached image itself so it is the image in the cache
+    # which has to be readable by the hypervisor.
+    if stat.S_IMODE(os.stat(src).st_mode) != VOLUME_MODE:
+        log.debug("Setting mode of %s to %o for use as a volume", src,
+                  VOLUME_MODE)
+        os.chmod(src, VOLUME_MODE)
+
+    os.link(src, dst)
+
+
+def _copy_file_range(src, dst):
+    libc = ctypes.CDLL(None, use_errno=True)
+    copy_file_range = getattr(libc, 'copy_file_range', None)
+    if copy_file_range is None:
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+
+    copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                ctypes.c_void_p, ctypes.c_size_t,
+                                ctypes.c_uint]
+    copy_file_range.restype = ctypes.c_ssize_t
+    remaining = os.path.getsize(src)
+    with open(src, 'rb') as src_fd:
+        with open(dst, 'wb') as dst_fd:
+            while remaining > 0:
+                copied = copy_file_range(src_fd.fileno(), None,
+                                         dst_fd.fileno(), None,
+                                         min(remaining, 1 << 30), 0)
+                if copied < 0:
+                    err = ctypes.get_errno()
+                    raise OSError(err, os.strerror(err))
+                elif copied == 0:
+                    raise IOError("Unexpected end of file copying %s" % src)
+
+                remaining -= copied
+
+
+# Ways of placing an image in a local pool without copying it through
+# userspace, in order of preference.
+ZERO_COPY_METHODS = [
+    ('reflink', _reflink),
+    ('hardlink', _hardlink),
+    ('copy_file_range', _copy_file_range),
+]
+
+
+def import_volume(conn, pool, name, path):
+    """
+    Imports the image at path as the named volume of a local file based
+    storage pool without streaming it through libvirt, by reflink, hardlink
+    or copy_file_range.
+
+    :returns: True if the image was imported, False if the pool is not local
+              or none of the methods worked, in which case the volume should
+              be uploaded instead.
+    """
+    pool_path = get_local_pool_path(conn, pool)
+    if not pool_path:
+        return False
+
+    dst = os.path.join(pool_path, name)
+    if os.path.exists(dst):
+        return False
+
+    start = time.time()
+    for method, f in ZERO_COPY_METHODS:
+        try:
+            f(path, dst)
+        except (IOError, OSError) as e:
+            log.debug("Unable to import %s to %s by %s: %s", path, dst,
+                      method, e)
+            if os.path.exists(dst):
+                os.remove(dst)
+
+            continue
+
+        if method != 'hardlink':
+            os.chmod(dst, VOLUME_MODE)
+
+        refresh_pool(conn, pool)
+        log.info("Imported %s to volume '%s' by %s in %.3fs", path, name,
+                 method, time.time() - start)
+        return True
+
+    return False
+
+
+def _segments(fd, size):
+    """
+    Yields the (is_data, offset, length) segments of the data and holes of
+    an open file. If the filesystem cannot report holes the whole file is
+    returned as data.
+    """
+    offset = 0
+    while offset < size:
+        try:
+            data = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole remains
+                data = size
+            else:
+                yield (True, offset, size - offset)
+                return
+
+        if data > offset:
+            yield (False, offset, data - offset)
+
+        if data >= size:
+            return
+
+        hole = min(os.lseek(fd, data, SEEK_HOLE), size)
+        yield (True, data, hole - data)
+        offset = hole
+
+
+def _report(name, sent, total, start):
+    elapsed = max(time.time() - start, 0.001)
+    sys.stdout.write(" Uploading %s ... %3d%% (%.1f MiB/s)" %
+                     (name, sent * 100 / max(total, 1),
+                      sent / elapsed / (1 << 20)))
+    sys.stdout.flush()
+    sys.stdout.write('\r')
+
+
+def _send(stream, fd, size, name, sparse):
+    """
+    Sends the content of the open file on the stream, skipping holes if
+    sparse is set.
+
+    :returns: the number of bytes of data sent
+    """
+    start = time.time()
+    sent = 0
+    data_sent = 0
+    segments = _segments(fd, size) if sparse else [(True, 0, size)]
+    for is_data, offset, length in segments:
+        if not is_data:
+            stream.sendHole(length, 0)
+            sent += length
+            continue
+
+        os.lseek(fd, offset, os.SEEK_SET)
+        while length > 0:
+            chunk = os.read(fd, min(length, UPLOAD_CHUNK_SIZE))
+            if not chunk:
+                raise IOError("Unexpected end of file uploading %s" % (name))
+
+            stream.send(chunk)
+            length -= len(chunk)
+            sent += len(chunk)
+            data_sent += len(chunk)
+            _report(name, sent, size, start)
+
+    elapsed = max(time.time() - start, 0.001)
+    sys.stdout.write('\r\n')
+    log.info("Uploaded %s: %.1f MiB (%.1f MiB of data) in %.1fs "
+             "(%.1f MiB/s)", name, size / float(1 << 20),
+             data_sent / float(1 << 20), elapsed,
+             data_sent / elapsed / (1 << 20))
+    return data_sent
+
+
+def _abort(stream):
+    try:
+        stream.abort()
+    except libvirt.libvirtError:
+        pass
+
+
+def upload_volume(conn, pool, name, path):
+    """
+    Uploads the file at path into the named volume of the storage pool.
+
+    The file is streamed through libvirt in large chunks and, where the
+    hypervisor supports sparse streams, holes in the file are skipped
+    rather than sent as zeros.
+
+    :returns: the number of bytes of data sent
+    """
+    vol = conn.storagePoolLookupByName(pool).storageVolLookupByName(name)
+    size = os.path.getsize(path)
+    sparse = hasattr(libvirt, 'VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM')
+
+    stream = conn.newStream(0)
+    finished = False
+    try:
+        if sparse:
+            try:
+                vol.upload(stream, 0, size,
+                           libvirt.VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM)
+            except libvirt.libvirtError as e:
+                log.debug("Sparse upload not supported - sending all of "
+                          "%s: %s", path, e)
+                stream.abort()
+                stream = conn.newStream(0)
+                sparse = False
+
+        if not sparse:
+            vol.upload(stream, 0, size, 0)
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            data_sent = _send(stream, fd, size, name, sparse)
+        finally:
+            os.close(fd)
+
+        stream.finish()
+        finished = True
+    finally:
+        if not finished:
+            _abort(stream)
+
+    return data_sent
+
+
+def upload_data(conn, pool, name, data):
+    """Uploads data held in memory into the named volume of the storage
+    pool."""
+    vol = conn.storagePoolLookupByName(pool).storageVolLookupByName(name)
+    stream = conn.newStream(0)
+    finished = False
+    try:
+        vol.upload(stream, 0, len(data), 0)
+        for offset in xrange(0, len(data), UPLOAD_CHUNK_SIZE):
+            stream.send(data[offset:offset + UPLOAD_CHUNK_SIZE])
+
+        stream.finish()
+        finished = True
+    finally:
+        if not finished:
+            _abort(stream)
+
+    log.debug("Uploaded %d bytes to volume '%s'", len(data), name)
+
+
+def download_data(conn, pool, name, offset, length):
+    """Returns length bytes from offset of the named volume of the storage
+    pool."""
+    vol = conn.storagePoolLookupByName(pool).storageVolLookupByName(name)
+    stream = conn.newStream(0)
+    finished = False
+    chunks = []
+    try:
+        vol.download(stream, offset, length, 0)
+        while True:
+            data = stream.recv(UPLOAD_CHUNK_SIZE)
+            if not data:
+                break
+
+            chunks.append(data)
+
+        stream.finish()
+        finished = True
+    finally:
+        if not finished:
+            _abort(stream)
+
+    return ''.join(chunks)[:length]
@@ -0,0 +1,39 @@
+#!/bin/sh
+#
+# Cleans and shrinks the root disk of the vm baking a MAAS base image before
+# it is powered off and its root volume stored as the image.
+#
+# The vm is powered off whatever happens, so the deployer only stores the
+# image once it has seen the message written at the end.
+missing=
+for package in {{ packages|join(' ') }}; do
+    status=$(dpkg-query -W -f='${Status}' $package 2>/dev/null || true)
+    [ "$status" = "install ok installed" ] || missing="$missing $package"
+done
+if [ -n "$missing" ]; then
+    echo "maas-deployer: packages not installed:$missing" >&2
+    exit 1
+fi
+
+# Keep the packages in the apt archive cache volume, if it is mounted.
+umount /var/cache/apt/archives 2>/dev/null || true
+apt-get clean
+
+# Instance specific state which must be recreated when a MAAS controller is
+# booted from the image.
+rm -rf /var/lib/cloud/instances /var/lib/cloud/instance /var/lib/cloud/data
+rm -f /var/log/cloud-init.log /var/log/cloud-init-output.log
+rm -f /etc/ssh/ssh_host_*
+rm -f /etc/udev/rules.d/70-persistent-net.rules
+rm -f /var/lib/dhcp/*.leases
+rm -f /home/{{ user }}/.ssh/authorized_keys
+[ -f /etc/machine-id ] && : > /etc/machine-id
+# The address, cluster UUID and secrets of MAAS are those of this vm until
+# reset-maas.sh gives each MAAS controller cloned from the image its own.
+
+# Zero the free space so that it is left out when the volume is stored.
+fstrim / 2>/dev/null || true
+dd if=/dev/zero of=/var/tmp/zero bs=1M 2>/dev/null || true
+rm -f /var/tmp/zero
+sync
+echo "{{ message }}"
@@ -0,0 +1,13 @@
+#!/bin/sh
+#
+# Run on the hypervisor host to copy a volume of a file based storage pool to
+# a new qcow2 volume, leaving out the clusters which are unallocated or only
+# hold zeros.
+#
+set -e
+
+if ! qemu-img convert -O qcow2 "{{ src }}" "{{ dst }}"; then
+    rm -f "{{ dst }}"
+    exit 1
+fi
+chmod 0644 "{{ dst }}"
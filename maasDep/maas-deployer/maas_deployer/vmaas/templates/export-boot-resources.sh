@@ -0,0 +1,18 @@
+#!/bin/sh
+#
+# Run on the MAAS controller once the boot images have been imported to
+# archive them: the boot resources of the cluster and the boot resource rows
+# and large objects of the region database.
+#
+set -e
+
+tmp=$(mktemp -d)
+trap 'rm -rf "$tmp"' EXIT
+sudo -u postgres pg_dump --format=custom --data-only --blobs \
+{%- for table in tables %}
+    --table={{ table }} \
+{%- endfor %}
+    {{ database }} > "$tmp/boot-resources.dump"
+sudo tar -C /var/lib/maas -cf "{{ archive }}" boot-resources \
+    -C "$tmp" boot-resources.dump
+sudo chown "$(id -u)" "{{ archive }}"
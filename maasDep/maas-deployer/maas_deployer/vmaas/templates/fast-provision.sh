@@ -0,0 +1,19 @@
+#!/bin/sh
+#
+# Run once the packages have been installed with the fast provisioning
+# profile to restore the usual dpkg and apt settings. It runs before a golden
+# image is captured so that the image does not keep them.
+#
+rm -f /etc/dpkg/dpkg.cfg.d/maas-deployer-fast \
+    /etc/apt/apt.conf.d/99maas-deployer-fast
+# Turn the periodic apt jobs and unattended-upgrades back on. Releases
+# without systemd (e.g. trusty) run the periodic jobs from cron, which reads
+# the APT::Periodic settings removed above, so only the service needs
+# restarting there.
+if command -v systemctl >/dev/null 2>&1; then
+    systemctl start apt-daily.timer apt-daily-upgrade.timer >/dev/null 2>&1 || true
+    systemctl restart unattended-upgrades >/dev/null 2>&1 || true
+else
+    service unattended-upgrades restart >/dev/null 2>&1 || true
+fi
+sync
@@ -0,0 +1,70 @@
+#!/bin/sh
+#
+# Run on the hypervisor host to fetch a cloud image into a cache on the host
+# and upload it into a storage pool volume from there.
+#
+set -e
+
+cache="$HOME/.cache/maas-deployer"
+image="$cache/{{filename}}"
+# Downloads go to a partial file which is only moved into the cache once it
+# is complete and verified.
+part="$image.part"
+mkdir -p "$cache"
+
+verify ()
+{
+{%- if sha256 %}
+    echo "{{sha256}}  $1" | sha256sum -c --status
+{%- else %}
+    [ -s "$1" ]
+{%- endif %}
+}
+
+fetch ()
+{
+    wget -q -c -O "$part" "{{url}}" && verify "$part"
+}
+
+if [ -f "$image" ] && verify "$image"; then
+    echo "Using cached $image"
+else
+    rm -f "$image"
+    # Resume a partial download first and only start again if that fails.
+    if ! fetch; then
+        rm -f "$part"
+        if ! fetch; then
+            rm -f "$part"
+{%- if sha256 %}
+            echo "Unable to fetch {{url}} with sha256 {{sha256}}" >&2
+{%- else %}
+            echo "Unable to fetch {{url}}" >&2
+{%- endif %}
+            exit 1
+        fi
+    fi
+    mv "$part" "$image"
+fi
+
+# The volume is created with the format and virtual size of the image, the
+# same as when it is uploaded from the deployer host. Only the top level keys
+# of the image info, which are indented by four spaces, are used.
+if command -v qemu-img > /dev/null; then
+    info=$(qemu-img info --output=json "$image") || info=
+    format=$(echo "$info" | sed -n 's/^    "format": *"\([^"]*\)".*/\1/p' | \
+        head -n 1)
+    capacity=$(echo "$info" | \
+        sed -n 's/^    "virtual-size": *\([0-9]*\).*/\1/p' | head -n 1)
+fi
+if [ -z "$format" ] || [ -z "$capacity" ]; then
+    format=raw
+    capacity=$(stat -c %s "$image")
+fi
+
+virsh -c "{{uri}}" vol-create-as --pool "{{pool}}" --name "{{name}}" \
+    --capacity "$capacity" --format "$format" > /dev/null
+if ! virsh -c "{{uri}}" vol-upload --pool "{{pool}}" --vol "{{name}}" \
+        --file "$image"; then
+    virsh -c "{{uri}}" vol-delete --pool "{{pool}}" "{{name}}" || true
+    exit 1
+fi
@@ -0,0 +1,18 @@
+#!/bin/sh
+#
+# Run once the packages are installed and before the MAAS controller is
+# configured, so that the deployer can capture the root disk as a golden
+# image. Waits for the deployer to signal that it has been captured.
+#
+# The image keeps the cloud-init output and state of this run, which is still
+# going on. cloud-init regenerates the instance state of the clones, and the
+# bootcmd of cloud-init.cfg clears this output on them.
+#
+sync
+echo "{{message}}"
+timeout=900
+while [ ! -e "{{resume_file}}" ] && [ $timeout -gt 0 ]; do
+    sleep 1
+    timeout=$((timeout - 1))
+done
+rm -f "{{resume_file}}"
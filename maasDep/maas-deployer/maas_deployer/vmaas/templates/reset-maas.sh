@@ -0,0 +1,59 @@
+#!/bin/sh
+#
+# Run before config-maas.sh when the root disk is cloned from an image with
+# MAAS already installed, so that this MAAS controller has its own address,
+# cluster UUID and secrets rather than those of the vm the image was taken
+# from.
+#
+set -e
+
+# MAAS is reached on the address of the interface of the default route, as
+# when its packages are installed.
+address=$(ip route get 8.8.8.8 | sed -n 's/.* src \([0-9.]*\).*/\1/p')
+maas_url="http://$address/MAAS"
+maas-region-admin local_config_set --maas-url="$maas_url"
+
+psql ()
+{
+    sudo -u postgres psql -q -d {{ database }} -c "$1" > /dev/null
+}
+
+cluster_conf=/etc/maas/maas_cluster.conf
+if [ -f $cluster_conf ]; then
+    sed -i "s|^MAAS_URL=.*|MAAS_URL=\"$maas_url\"|" $cluster_conf
+    old_uuid=$(sed -n 's/^CLUSTER_UUID="\?\([^"]*\)"\?$/\1/p' $cluster_conf)
+    uuid=$(uuidgen)
+    sed -i "s|^CLUSTER_UUID=.*|CLUSTER_UUID=\"$uuid\"|" $cluster_conf
+    if [ -n "$old_uuid" ]; then
+        psql "UPDATE maasserver_nodegroup SET uuid = '$uuid'
+              WHERE uuid = '$old_uuid'"
+    fi
+fi
+
+# The secret shared by the region and cluster controllers.
+if [ -f /var/lib/maas/secret ]; then
+    secret=$(openssl rand -hex 16)
+    psql "UPDATE maasserver_config SET value = '\"$secret\"'
+          WHERE name = 'rpc_shared_secret'"
+    printf %s "$secret" > /var/lib/maas/secret
+fi
+
+# The password of the MAAS database user.
+settings=/etc/maas/maas_local_settings.py
+if [ -f $settings ]; then
+    db_user=$(sed -n "s/^ *'USER': '\([^']*\)'.*/\1/p" $settings | head -n 1)
+    password=$(openssl rand -hex 16)
+    psql "ALTER ROLE \"$db_user\" WITH PASSWORD '$password'"
+    sed -i "s/^\( *'PASSWORD': '\)[^']*'/\1$password'/" $settings
+    dbconfig=/etc/dbconfig-common/maas-region-controller.conf
+    if [ -f $dbconfig ]; then
+        sed -i "s/^dbc_dbpass=.*/dbc_dbpass='$password'/" $dbconfig
+    fi
+fi
+
+for service in apache2 maas-regiond maas-clusterd maas-cluster-celery \
+        maas-pserv; do
+    if service $service status > /dev/null 2>&1; then
+        service $service restart < /dev/null > /dev/null
+    fi
+done
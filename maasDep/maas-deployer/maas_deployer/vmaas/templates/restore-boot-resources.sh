@@ -0,0 +1,47 @@
+#!/bin/sh
+#
+# Run on a freshly installed MAAS controller to restore the boot resources
+# archived by export-boot-resources.sh before the boot images are imported,
+# so that the import finds them already in place.
+#
+set -e
+
+services="maas-regiond maas-clusterd maas-cluster-celery apache2"
+for service in $services; do
+    sudo service $service stop < /dev/null > /dev/null 2>&1 || true
+done
+
+# Replace anything imported since MAAS started.
+sudo -u postgres psql -q {{ database }} <<SQL
+SELECT lo_unlink(content) FROM maasserver_largefile;
+TRUNCATE {{ tables|join(', ') }} CASCADE;
+SQL
+tar -xOf "{{ archive }}" boot-resources.dump | \
+    sudo -u postgres pg_restore --data-only --disable-triggers \
+        --dbname={{ database }}
+# The rows keep their ids, so the sequences must be moved past them for the
+# rows MAAS creates next.
+sudo -u postgres psql -q {{ database }} <<SQL
+{%- for table in tables %}
+SELECT setval(pg_get_serial_sequence('{{ table }}', 'id'),
+              COALESCE(MAX(id), 0) + 1, false) FROM {{ table }};
+{%- endfor %}
+SQL
+sudo rm -rf /var/lib/maas/boot-resources
+sudo tar -C /var/lib/maas -xpf "{{ archive }}" boot-resources
+rm -f "{{ archive }}"
+
+for service in $services; do
+    sudo service $service start < /dev/null > /dev/null 2>&1 || true
+done
+
+# Wait for the region to serve the API again.
+timeout=300
+until curl -sf http://localhost/MAAS/api/1.0/version/ > /dev/null; do
+    if [ $timeout -le 0 ]; then
+        echo "MAAS did not restart after restoring boot resources" >&2
+        exit 1
+    fi
+    sleep 2
+    timeout=$((timeout - 2))
+done
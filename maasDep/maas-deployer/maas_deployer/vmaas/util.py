@@ -5,15 +5,21 @@
 
 import argparse
 import collections
+import hashlib
 import logging
 import os
+import select
+import socket
 import subprocess
+import threading
 import time
 
 log = logging.getLogger('vmaas.main')
 
 USER_DATA_DIR = os.path.join(os.getcwd(), 'user-files')
 USER_PRESEED_DIR = os.path.join(USER_DATA_DIR, 'preseeds')
+# Cache of data kept between runs of the deployer.
+CACHE_DIR = os.path.expanduser(os.path.join('~', '.cache', 'maas-deployer'))
 
 
 def retry_on_exception(max_retries=5, exc_tuple=None):
@@ -121,6 +127,59 @@ def execc(cmd, stdin=None, pipedcmds=None, fatal=True, suppress_stderr=False,
                  _pipe_stack=_pipe_stack)
 
 
+def stream_lines(cmd, idle_timeout=None):
+    """Execute command and yield its stdout line by line as it is produced.
+
+    If idle_timeout is given, None is yielded each time the command has
+    produced no output for that many seconds, letting the caller check on
+    other things while it waits.
+
+    Stderr is read in a thread of its own so that a command writing a lot to
+    it cannot block. The process is terminated if the generator is closed
+    before the command exits. A non-zero exit raises CalledProcessError.
+    """
+    log.debug("Streaming: '%s'", ' '.join(cmd))
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr = []
+    reader = threading.Thread(target=lambda: stderr.append(p.stderr.read()),
+                              name='stderr-%s' % (p.pid))
+    reader.daemon = True
+    reader.start()
+    try:
+        # The pipe is read unbuffered so that select() reflects whether there
+        # is output still to be processed.
+        fd = p.stdout.fileno()
+        buf = ''
+        while True:
+            if idle_timeout is not None:
+                ready, _, _ = select.select([fd], [], [], idle_timeout)
+                if not ready:
+                    yield None
+                    continue
+
+            data = os.read(fd, 4096)
+            if not data:
+                break
+
+            buf += data
+            while '\n' in buf:
+                line, buf = buf.split('\n', 1)
+                yield line + '\n'
+
+        if buf:
+            yield buf
+
+        p.wait()
+        reader.join()
+        if p.returncode:
+            raise subprocess.CalledProcessError(p.returncode, ' '.join(cmd),
+                                                output=''.join(stderr))
+    finally:
+        if p.poll() is None:
+            p.terminate()
+            p.wait()
+
+
 def exec_script_remote(user, host, script):
     """Execute a script within an SSH session."""
     log.debug("Executing script on remote host '%s'", host)
@@ -130,6 +189,46 @@ def exec_script_remote(user, host, script):
     return execc(cmd, stdin=script.strip())
 
 
+def is_port_open(host, port, timeout=2):
+    """Returns True if a TCP connection to host:port can be established."""
+    try:
+        sock = socket.create_connection((host, port), timeout)
+    except (socket.error, socket.timeout):
+        return False
+
+    sock.close()
+    return True
+
+
+def generate_mac(*keys):
+    """
+    Returns a MAC address in the locally administered 52:54:00 range used by
+    KVM which is always the same for the same keys, e.g. the environment
+    name, domain name and interface index.
+    """
+    digest = hashlib.sha1('/'.join(str(k) for k in keys)).digest()
+    return '52:54:00:%s' % ':'.join('%02x' % ord(c) for c in digest[:3])
+
+
+def parse_size(size):
+    """
+    Returns a size given as a number of bytes with an optional K, M or G
+    suffix e.g. '10G' as a number of bytes.
+    """
+    if size is None:
+        return None
+
+    size = str(size).strip().upper()
+    multiplier = 1
+    for suffix, factor in (('K', 1 << 10), ('M', 1 << 20), ('G', 1 << 30)):
+        if size.endswith(suffix):
+            size = size[:-1]
+            multiplier = factor
+            break
+
+    return int(float(size) * multiplier)
+
+
 def virsh(cmd, fatal=True):
     _cmd = ['virsh', '-c', CONF.remote]
     _cmd.extend(cmd)
@@ -6,27 +6,43 @@
 # created for an automated MAAS deployment.
 #
 
+import hashlib
+import json
 import libvirt
 import logging
 import os
 import os.path
-import re
 import shutil
 import tempfile
+import threading
 import time
+import urlparse
 
 from lxml import etree
 from subprocess import CalledProcessError
 
 import maas_deployer.vmaas.template as template
 
+from maas_deployer.vmaas import (
+    addresses,
+    cloudinit,
+    connection,
+    console,
+    download,
+    events,
+    inventory,
+    seed,
+    storage,
+)
 from maas_deployer.vmaas.exception import (
+    MAASDeployerBakeError,
     MAASDeployerConfigError,
     MAASDeployerPoolNotFound,
     MAASDeployerResourceAlreadyExists,
 )
 from maas_deployer.vmaas.util import (
     execc,
+    generate_mac,
     virsh,
     CONF as cfg,
     USER_DATA_DIR,
@@ -35,6 +51,176 @@ from maas_deployer.vmaas.util import (
 
 log = logging.getLogger('vmaas.main')
 
+CLOUD_IMAGES_URL = 'https://cloud-images.ubuntu.com'
+MAC_ADDRESS_XPATH = etree.XPath('/domain/devices/interface/mac/@address')
+DISK_SOURCE_XPATH = etree.XPath('/domain/devices/disk/source/@file | '
+                                '/domain/devices/disk/source/@dev | '
+                                '/domain/devices/disk/source/@volume')
+
+# Packages installed on the MAAS controller by cloud-init.
+PACKAGES = [
+    # MAAS Core Packages
+    'maas',
+    'maas-dhcp',
+    'maas-dns',
+    # Used to manage KVM instances via libvirt
+    'libvirt-bin',
+    'linux-image-extra-virtual',
+    'jq',
+    'juju-core',
+    'juju-deployer',
+    # Node management tools
+    'ipmitool',
+    'wakeonlan',
+    'amtterm',
+    'wsmancli',
+    # Python libraries used for the maas configuration script
+    'python-bson',
+    'python-httplib2',
+    'python-jinja2',
+    'python-maas-client',
+    'python-yaml',
+    # Misc
+    'ntp',
+]
+# Packages which do not exist on some architectures.
+ARCH_EXCLUDED_PACKAGES = {
+    'ppc64': ['linux-image-extra-virtual'],
+}
+# Packages not installed with the fast provisioning profile. The extra kernel
+# modules are not needed by a MAAS controller running under KVM.
+FAST_EXCLUDED_PACKAGES = ['linux-image-extra-virtual']
+# File created on the MAAS controller to let cloud-init continue once its
+# root disk has been captured as a golden image.
+GOLDEN_IMAGE_RESUME_FILE = '/run/maas-deployer-golden-image'
+# Name of the database of the MAAS region controller.
+MAAS_DATABASE = 'maasdb'
+# Size of the root disk of the vm used to bake a MAAS base image. The disk of
+# a MAAS controller cloned from the image is grown to its disk_size.
+BAKE_DISK_SIZE = '8G'
+# Serial number of the apt archive cache disk, by which it is found in the
+# MAAS controller.
+APT_CACHE_SERIAL = 'aptcache'
+APT_CACHE_DEVICE = '/dev/disk/by-id/virtio-%s' % (APT_CACHE_SERIAL)
+APT_CACHE_SIZE = '10G'
+
+
+def get_packages(arch, fast_provision=False):
+    """Returns the packages to install on a MAAS controller of arch."""
+    excluded = ARCH_EXCLUDED_PACKAGES.get(arch, [])
+    if fast_provision:
+        excluded = excluded + FAST_EXCLUDED_PACKAGES
+
+    return [p for p in PACKAGES if p not in excluded]
+
+
+def get_interface_macs(env_name, params, used=None):
+    """
+    Returns the MAC addresses that the interfaces of the domain described by
+    params will have.
+
+    An address given with mac= in the interface definition is used as is,
+    otherwise one is generated from the environment name, domain name and
+    interface index so that the addresses are known before the domain is
+    defined.
+
+    :param used: the names of the domains by the MAC addresses already
+                 assigned to them (see get_domain_macs()), to which the
+                 addresses returned are added. A generated address which is
+                 already assigned to another domain is generated again with
+                 an attempt count added to the keys.
+    """
+    name = params['name']
+    if used is None:
+        used = {}
+
+    macs = []
+    for idx, iface in enumerate(params.get('interfaces') or []):
+        opts = dict(opt.split('=', 1) for opt in iface.split(',')
+                    if '=' in opt)
+        mac = opts.get('mac')
+        if mac:
+            mac = mac.lower()
+            if used.get(mac, name) != name:
+                raise MAASDeployerConfigError("MAC address %s of domain '%s' "
+                                              "is already used by domain "
+                                              "'%s'" % (mac, name, used[mac]))
+        else:
+            mac = generate_mac(env_name, name, idx)
+            attempt = 0
+            while used.get(mac, name) != name:
+                log.debug("Generated MAC address %s of domain '%s' is "
+                          "already used by domain '%s'", mac, name, used[mac])
+                attempt += 1
+                mac = generate_mac(env_name, name, idx, attempt)
+
+        used[mac] = name
+        macs.append(mac)
+
+    return macs
+
+
+def get_domain_macs():
+    """
+    Returns the names of the domains defined on the configured hypervisor by
+    the MAC addresses of their interfaces.
+    """
+    conn = connection.get_connection(cfg.remote)
+    inv = inventory.get_inventory(conn, cfg.remote)
+    macs = {}
+    for name in sorted(inv.domains):
+        try:
+            xml = inv.domain_xml(name)
+        except libvirt.libvirtError as e:
+            log.debug("Unable to read domain '%s': %s", name, e)
+            continue
+
+        for mac in MAC_ADDRESS_XPATH(xml):
+            macs[str(mac).lower()] = name
+
+    return macs
+
+
+def wait_for_domain_running(name, timeout):
+    """
+    Waits for the named domain to be running on the configured hypervisor.
+
+    :returns: the number of seconds spent waiting
+    """
+    conn = connection.get_connection(cfg.remote)
+    return events.wait_for_domain_running(conn, name, timeout)
+
+
+def wait_for_ip_address(name, timeout):
+    """
+    Waits for the named domain on the configured hypervisor to obtain an IP
+    address.
+
+    :returns: the IP address of the domain
+    :raises: MAASDeployerTimeout if no address is found within timeout
+             seconds.
+    """
+    conn = connection.get_connection(cfg.remote)
+    xml = inventory.get_inventory(conn, cfg.remote).domain_xml(name)
+    macs = [str(mac) for mac in MAC_ADDRESS_XPATH(xml)]
+    return addresses.wait_for_address(conn, name, macs, timeout)
+
+
+def attach_console(name):
+    """
+    Attaches a ConsoleMonitor to the serial console of the named domain.
+
+    :returns: the started ConsoleMonitor or None if the console could not be
+              opened.
+    """
+    try:
+        conn = connection.get_connection(cfg.remote)
+        return console.ConsoleMonitor(conn, name).start()
+    except libvirt.libvirtError as e:
+        log.warning("Unable to attach to console of domain '%s': %s", name,
+                    e)
+        return None
+
 
 class Instance(object):
 
@@ -48,9 +234,16 @@ class Instance(object):
         self.pool = params.get('pool', 'default')
         self.netboot = params.get('netboot', False)
         self.video = params.get('video', 'cirrus')
+        # MAC addresses to give the interfaces, in order (see
+        # get_interface_macs()).
+        self.macs = params.get('mac_addresses') or []
 
         self.working_dir = tempfile.mkdtemp()
-        self.conn = libvirt.open(cfg.remote)
+        self._new_vols = []
+        # Parsed XML of the domain if it was defined by this instance.
+        self._domain_xml = None
+        self.conn = connection.get_connection(cfg.remote)
+        self.inventory = inventory.get_inventory(self.conn, cfg.remote)
         self.assert_pool_exists(self.pool)
         self.autostart = autostart
 
@@ -64,14 +257,12 @@ class Instance(object):
         if os.path.isdir(self.working_dir):
             shutil.rmtree(self.working_dir)
 
-    @staticmethod
-    def assert_pool_exists(pool='default'):
-        out, _ = virsh(['pool-list'])
-        m = re.search(r"\s%s\s" % pool, out)
-        if not m:
+    def assert_pool_exists(self, pool='default'):
+        if pool not in self.inventory.pools:
             raise MAASDeployerPoolNotFound(pool)
 
-    def _get_disk_param(self, image=None, pool=None, fmt='qcow2'):
+    def _get_disk_param(self, image=None, pool=None, fmt='qcow2',
+                        serial=None):
         if pool is None:
             pool = self.pool
 
@@ -79,15 +270,29 @@ class Instance(object):
             image = '{}.img'.format(self.name)
 
         tmplt = 'vol={pool}/{image},format={format},bus=virtio,io=native'
-        return tmplt.format(pool=pool, image=image, format=fmt)
+        param = tmplt.format(pool=pool, image=image, format=fmt)
+        if serial:
+            param += ',serial={}'.format(serial)
+
+        return param
 
     def _get_network_params(self):
-        return self.interfaces
+        networks = []
+        for idx, network in enumerate(self.interfaces or []):
+            if idx < len(self.macs) and 'mac=' not in network:
+                network = '%s,mac=%s' % (network, self.macs[idx])
+
+            networks.append(network)
+
+        return networks
 
     @property
     def _existing_vols(self):
-        pool = self.conn.storagePoolLookupByName(self.pool)
-        return [v.name() for v in pool.listAllVolumes()]
+        return self.inventory.volumes(self.pool)
+
+    def _delete_volume(self, name):
+        virsh(['vol-delete', '--pool', self.pool, name])
+        self.inventory.remove_volume(self.pool, name)
 
     def _get_disks(self):
         """
@@ -112,11 +317,13 @@ class Instance(object):
             elif cfg.force:
                 log.info("Deleting volume '%s' before create since force=True",
                          img_name)
-                virsh(['vol-delete', '--pool', self.pool, img_name])
+                self._delete_volume(img_name)
             else:
                 raise MAASDeployerResourceAlreadyExists(resource=img_name,
                                                         resource_type='volume')
 
+        # The volume is created by virt-install along with the domain.
+        self._new_vols.append(img_name)
         return [("size=%s,format=qcow2,bus=virtio,io=native,pool=%s" %
                  (size, self.pool))]
 
@@ -159,10 +366,16 @@ class Instance(object):
 
     def _domain_exists(self, name):
         log.debug("Checking if domain '%s' exists", (name))
-        out = virsh(['list', '--all'])[0]
-        key = re.compile(r' %s ' % name)
-        result = re.search(key, out)
-        return result is not None and result.group(0).strip() == name
+        return self.inventory.has_domain(name)
+
+    def _domain_added(self, name):
+        """Records a domain, and any volumes created along with it, in the
+        inventory."""
+        self.inventory.add_domain(name, xml=self._domain_xml)
+        for vol in self._new_vols:
+            self.inventory.add_volume(self.pool, vol)
+
+        self._new_vols = []
 
     def _undefine_domain(self, name):
         log.debug("Undefining domain '%s'", (name))
@@ -173,6 +386,7 @@ class Instance(object):
         while True:
             try:
                 virsh(['undefine', name])
+                self.inventory.remove_domain(name)
                 break
             except CalledProcessError:
                 if retries > max_retries:
@@ -211,6 +425,7 @@ class Instance(object):
             virsh(['undefine', self.name], fatal=False)
             raise
 
+        self._domain_added(self.name)
         if self.autostart:
             virsh(['autostart', self.name])
 
@@ -245,7 +460,7 @@ class Instance(object):
 
         try:
             log.debug("Creating domain '%s'", (self.name))
-            execc(cmd, pipedcmds=[['tee', xml_file]])
+            xml, _ = execc(cmd, pipedcmds=[['tee', xml_file]])
 
             # Now that the XML has been dumped, need to import it into libvirt
             # using the virsh define command.
@@ -254,6 +469,10 @@ class Instance(object):
             log.error("Failed to define domain: %s", e.output)
             raise
 
+        self._domain_xml = etree.fromstring(xml.strip())
+
+        self._domain_added(self.name)
+
         if self.autostart:
             virsh(['autostart', self.name])
 
@@ -261,35 +480,28 @@ class Instance(object):
     def mac_addresses(self):
         """
         Returns the set of mac_addresses that belong to the virtual domain.
+
+        If the domain was defined by this instance the addresses are read
+        from the XML it was defined with, otherwise from the (cached) domain
+        XML held by libvirt.
         """
-        domain_xml = ""
-        try:
-            domain_xml, _ = virsh(['dumpxml', self.name])
-        except CalledProcessError as e:
-            log.error(str(e))
-            domain_xml = ""
+        xml = self._domain_xml
+        if xml is None:
+            try:
+                xml = self.inventory.domain_xml(self.name)
+            except libvirt.libvirtError as e:
+                log.error(str(e))
+                return []
 
-        xml = etree.fromstring(domain_xml.strip())
-        return [mac.get('address') for mac in
-                xml.xpath("/domain/devices/interface/mac[@address]")]
+        return [str(mac) for mac in MAC_ADDRESS_XPATH(xml)]
 
     @property
     def ip_addresses(self):
         """
-        Discovers the IP address of this particular KVM instance. It is
-        heavily dependent upon an ARP request already being fulfilled by
-        the instance itself (which is likely the case anyways).
+        Discovers the IP addresses of this particular KVM instance from the
+        libvirt DHCP leases, the guest agent or the ARP table of the host.
         """
-        try:
-            subcmd = ['awk', '/%s/ {{ print $1 }}' % (self.mac_addresses[0])]
-            out, _ = execc(['arp'], pipedcmds=[subcmd])
-        except CalledProcessError:
-            return []
-
-        addresses = [a.strip() for a in out.split('\n') if a]
-        log.debug("Instance has address(es): %s", (','.join(addresses)))
-
-        return addresses
+        return addresses.discover(self.conn, self.name, self.mac_addresses)
 
 
 class CloudInstance(Instance):
@@ -310,6 +522,23 @@ class CloudInstance(Instance):
         self.node_group_ifaces = params.get('node_group_ifaces')
         self.apt_http_proxy = params.get('apt_http_proxy')
         self.apt_sources = params.get('apt_sources')
+        self.image_mirrors = params.get('image_mirrors') or []
+        self.image_download_connections = params.get(
+            'image_download_connections', download.DOWNLOAD_CONNECTIONS)
+        self.image_download_rate_limit = params.get(
+            'image_download_rate_limit')
+        self.golden_image = params.get('golden_image', False)
+        self.fast_provision = params.get('fast_provision', False)
+        self.apt_cache = params.get('apt_cache', False)
+        self.apt_cache_size = params.get('apt_cache_size', APT_CACHE_SIZE)
+        # The volume the root volume is cloned from if it has the packages
+        # installed already (see ensure_base_volume()).
+        self.installed_image = None
+        # Volumes which may be prepared in the background (see prefetch())
+        self._base_volume = None
+        self._base_volume_lock = threading.Lock()
+        self._seed_disk_param = None
+        self._seed_lock = threading.Lock()
 
     def _get_cloud_image_info(self):
         """
@@ -317,16 +546,28 @@ class CloudInstance(Instance):
         should be saved as.
         """
         if self.arch == "ppc64":
-            url = ('https://cloud-images.ubuntu.com/{release}/current/'
+            url = (CLOUD_IMAGES_URL + '/{release}/current/'
                    '{release}-server-cloudimg-{arch}el-disk1.img')
         else:
-            url = ('https://cloud-images.ubuntu.com/{release}/current/'
+            url = (CLOUD_IMAGES_URL + '/{release}/current/'
                    '{release}-server-cloudimg-{arch}-disk1.img')
 
         url = url.format(release=self.release, arch=self.arch)
         f = url.split('/')[-1]
         return (url, f)
 
+    def _get_image_urls(self, url):
+        """
+        Returns the urls the cloud image at url can be downloaded from, with
+        the configured mirrors of cloud-images.ubuntu.com after url itself.
+        """
+        urls = [url]
+        for mirror in self.image_mirrors:
+            if url.startswith(CLOUD_IMAGES_URL):
+                urls.append(mirror.rstrip('/') + url[len(CLOUD_IMAGES_URL):])
+
+        return urls
+
     def _create_base_volume(self, name, existing_vols):
         if name in existing_vols:
             log.debug("Base volume '%s' already exists", (name))
@@ -337,35 +578,121 @@ class CloudInstance(Instance):
             elif cfg.force:
                 log.info("Deleting volume '%s' before create since force=True",
                          name)
-                virsh(['vol-delete', '--pool', self.pool, name])
+                self._delete_volume(name)
             else:
                 raise MAASDeployerResourceAlreadyExists(resource=name,
                                                         resource_type='volume')
 
         url, fname = self._get_cloud_image_info()
+        if cfg.fetch_on_hypervisor and download.is_ssh_uri(cfg.remote):
+            download.fetch_on_hypervisor(cfg.remote, url, self.pool, name)
+            storage.refresh_pool(self.conn, self.pool)
+            self.inventory.add_volume(self.pool, name)
+            return
+
         if not os.path.isfile(fname):
             log.info("Downloading {url}".format(url=url))
-            try:
-                execc(['wget', '-O', fname, url])
-            except:
-                if os.path.exists(fname):
-                    os.remove(fname)
-
-                raise Exception("Failed to download '%s'" % (url))
-
+            urls = self._get_image_urls(url)
+            sha256 = None
+            for _url in urls:
+                sha256 = download.get_checksum(_url)
+                if sha256:
+                    break
+
+            downloader = download.Downloader(
+                urls, fname, sha256=sha256,
+                connections=self.image_download_connections,
+                max_rate=download.parse_rate(self.image_download_rate_limit))
+            downloader.run()
+
+        if storage.import_volume(self.conn, self.pool, name, fname):
+            self.inventory.add_volume(self.pool, name)
+            return
+
+        # The volume is sized from the virtual size of the image.
+        fmt, capacity = storage.get_image_info(fname)
         log.debug("Creating base volume '%s'", (name))
-        virsh(['vol-create-as', '--pool', self.pool, name, '3G'])
+        storage.create_volume(self.conn, self.pool, name, capacity, fmt)
+        self.inventory.add_volume(self.pool, name)
 
         try:
             log.debug("Uploading image '%s' to volume", (fname))
-            virsh(['vol-upload', '--pool', self.pool, '--file', fname,
-                   '--vol', name])
+            storage.upload_volume(self.conn, self.pool, name, fname)
         except Exception as e:
             log.error("Upload failed - cleaning up")
-            virsh(['vol-delete', '--pool', self.pool, '--vol', name])
+            self._delete_volume(name)
             raise Exception("Upload to vol '%s' failed - %s" % (name, e))
 
-    def _create_root_volume(self, name, basevol, existing_vols, storage_pool):
+    @property
+    def golden_image_key(self):
+        """
+        Returns the key of the golden images this instance can use: a digest
+        of everything that affects what is installed on the root disk before
+        the site-specific configuration is applied.
+        """
+        packages = get_packages(self.arch, self.fast_provision)
+        key = json.dumps([self.release, self.arch, packages,
+                          self.apt_sources or []])
+        return hashlib.sha256(key).hexdigest()[:12]
+
+    @property
+    def golden_image_volume(self):
+        return '%s-%s-maas-golden-%s' % (self.release, self.arch,
+                                         self.golden_image_key)
+
+    @property
+    def baked_image_volume(self):
+        return '%s-%s-maas-base' % (self.release, self.arch)
+
+    def _use_golden_image(self):
+        """
+        Returns True if the root volume is to be cloned from an existing
+        golden image.
+        """
+        return (self.golden_image and
+                self.golden_image_volume in self._existing_vols)
+
+    def _get_installed_image(self):
+        """
+        Returns the name of the volume with the packages already installed
+        to clone the root volume from: the golden image if one is to be
+        used, otherwise the baked MAAS base image if there is one, else None.
+        """
+        if self._use_golden_image():
+            return self.golden_image_volume
+        elif self.baked_image_volume in self._existing_vols:
+            return self.baked_image_volume
+
+        return None
+
+    def capture_golden_image(self):
+        """
+        Captures the root volume of this (running) instance as its golden
+        image. The domain is paused while the volume is cloned so that the
+        image is consistent.
+        """
+        name = self.golden_image_volume
+        if name in self._existing_vols:
+            log.debug("Golden image '%s' already exists", name)
+            return
+
+        root_img_name = '{}-root.img'.format(self.name)
+        log.info("Capturing golden image '%s' from '%s'", name,
+                 root_img_name)
+        start = time.time()
+        dom = self.conn.lookupByName(self.name)
+        dom.suspend()
+        try:
+            virsh(['vol-clone', '--pool', self.pool, root_img_name, name])
+            self.inventory.add_volume(self.pool, name)
+        finally:
+            dom.resume()
+
+        storage.refresh_pool(self.conn, self.pool)
+        log.info("Captured golden image '%s' in %.1fs", name,
+                 time.time() - start)
+
+    def _create_root_volume(self, name, basevol, existing_vols):
         if name in existing_vols:
             log.debug("Root volume '%s' already exists", (name))
             if cfg.use_existing:
@@ -375,50 +702,137 @@ class CloudInstance(Instance):
             elif cfg.force:
                 log.info("Deleting volume '%s' before create since force=True",
                          name)
-                virsh(['vol-delete', '--pool', self.pool, name])
+                self._delete_volume(name)
             else:
                 raise MAASDeployerResourceAlreadyExists(resource=name,
                                                         resource_type='volume')
 
         log.debug("Cloning '%s' from base image '%s'", name, basevol)
         virsh(['vol-clone', '--pool', self.pool, basevol, name])
+        self.inventory.add_volume(self.pool, name)
 
-        storage_pool.refresh()
+        storage.refresh_pool(self.conn, self.pool)
         log.debug("Resizing volume '%s' to %s", name, self.disk_size)
         virsh(['vol-resize', '--pool', self.pool, name, self.disk_size])
 
+    def ensure_base_volume(self):
+        """
+        Downloads the cloud image and installs it into the configured pool as
+        the base volume, if that has not already been done.
+
+        :returns: the name of the base volume
+        """
+        with self._base_volume_lock:
+            installed = None
+            if not self._base_volume:
+                installed = self._get_installed_image()
+
+            if installed:
+                log.info("Using pre-installed image '%s'", installed)
+                self._base_volume = installed
+                self.installed_image = installed
+            elif not self._base_volume:
+                basevol = "%s-%s-base" % (self.release, self.arch)
+                self._create_base_volume(basevol, self._existing_vols)
+                self._base_volume = basevol
+
+            return self._base_volume
+
     def ensure_cloud_image(self):
         """
         Downloads the cloud image and installs it into the configured pool for
         use.
         """
-        storage_pool = self.conn.storagePoolLookupByName(self.pool)
-        existing_vols = [v.name() for v in storage_pool.listAllVolumes()]
-        basevol = "%s-%s-base" % (self.release, self.arch)
-        self._create_base_volume(basevol, existing_vols)
+        basevol = self.ensure_base_volume()
+        existing_vols = self._existing_vols
         root_img_name = '{}-root.img'.format(self.name)
-        self._create_root_volume(root_img_name, basevol, existing_vols,
-                                 storage_pool)
-        storage_pool.refresh()
+        self._create_root_volume(root_img_name, basevol, existing_vols)
+        storage.refresh_pool(self.conn, self.pool)
         # Display volume info
         info = virsh(['vol-info', '--pool', self.pool, root_img_name])[0]
         info = "\n%s" % info
         log.debug(info)
         return self._get_disk_param(image=root_img_name)
 
-    def _generate_meta_data_file(self):
-        """Generates the cloud-init meta-data file.
+    @property
+    def apt_cache_volume(self):
+        return '%s-%s-apt-archives.img' % (self.release, self.arch)
+
+    def _use_apt_cache(self):
+        """
+        Returns True if the apt archive cache volume is to be attached, which
+        it is only if packages are to be installed.
+        """
+        return self.apt_cache and not self._get_installed_image()
 
-        Returns path to file.
+    def _get_volume_users(self, name):
         """
-        path = os.path.join(self.working_dir, 'meta-data')
-        params = {}
-        with open(path, 'w+') as out:
-            content = template.load('meta-data', params)
-            out.write(content)
-            out.flush()
+        Returns the names of the domains other than this one which have the
+        named volume of the pool as a disk.
+        """
+        try:
+            path = self.conn.storagePoolLookupByName(self.pool).\
+                storageVolLookupByName(name).path()
+        except libvirt.libvirtError as e:
+            log.debug("Unable to look up volume '%s': %s", name, e)
+            return []
+
+        users = []
+        for domain in sorted(self.inventory.domains):
+            if domain == self.name:
+                continue
 
-        return path
+            sources = DISK_SOURCE_XPATH(self.inventory.domain_xml(domain))
+            if path in sources or name in sources:
+                users.append(domain)
+
+        return users
+
+    def ensure_apt_cache_volume(self):
+        """
+        Creates the apt archive cache volume shared by the MAAS vms of the
+        release and arch in the pool, if it does not exist. An existing one
+        is always reused (even if force is set) since that is its purpose.
+
+        The filesystem on the volume is mounted read-write without any
+        locking so it is only attached to one domain at a time.
+
+        :returns: the disk parameter of the volume or None if it is attached
+                  to another domain.
+        """
+        name = self.apt_cache_volume
+        if name in self._existing_vols:
+            users = self._get_volume_users(name)
+            if users:
+                log.warning("Apt archive cache volume '%s' is attached to "
+                            "%s - not using it for '%s'", name,
+                            ', '.join(users), self.name)
+                return None
+
+            log.debug("Using existing apt archive cache volume '%s'", name)
+        else:
+            log.info("Creating apt archive cache volume '%s'", name)
+            virsh(['vol-create-as', '--pool', self.pool, name,
+                   str(self.apt_cache_size), '--format', 'qcow2'])
+            self.inventory.add_volume(self.pool, name)
+
+        return self._get_disk_param(image=name, serial=APT_CACHE_SERIAL)
+
+    @property
+    def instance_id(self):
+        if self._use_golden_image():
+            # cloud-init must see an instance other than the one the golden
+            # image was captured from to configure it.
+            return '%s-golden-%s' % (self.name, self.golden_image_key)
+
+        return self.name
+
+    def _generate_meta_data(self):
+        """Generates the cloud-init meta-data.
+
+        Returns the meta-data content.
+        """
+        return template.load('meta-data', {'instance_id': self.instance_id})
 
     def _get_ssh_key(self):
         """
@@ -439,13 +853,19 @@ class CloudInstance(Instance):
 
         return public_key
 
-    def _generate_user_data_file(self):
+    def _generate_user_data_parts(self):
         """
-        Generates the necessary user data files which are fed into
-        the cloud-init configuration.
+        Generates the parts of the user-data fed into the cloud-init
+        configuration: the cloud-init config, the config-maas script and
+        any user supplied files.
+
+        If the root volume is cloned from a golden or baked image the
+        packages are already installed. Otherwise, in golden image mode, a
+        script which waits for the root volume to be captured once the
+        packages are installed is run before the config-maas script. A MAAS
+        controller cloned from a golden or baked image is given its own
+        address and secrets by a script run before config-maas too.
         """
-        base_file = os.path.join(self.working_dir, 'cloud-init.cfg')
-
         if self.network_interfaces_content is None:
             msg = ("Expected the content of the /etc/network/interfaces file "
                    "to be provided.")
@@ -465,56 +885,73 @@ class CloudInstance(Instance):
             'apt_http_proxy': self.apt_http_proxy,
             'apt_sources': self.apt_sources,
             'network_config': '\n'.join(etc_net_interfaces),
-            'arch': self.arch
+            'packages': get_packages(self.arch, self.fast_provision),
+            'fast_provision': self.fast_provision,
+            'apt_cache_device': None,
+            'clone_message': None,
         }
-        content = template.load('cloud-init.cfg', parms)
-        with open(base_file, 'w+') as f:
-            f.write(content)
-            f.flush()
+        if self._use_apt_cache():
+            parms['apt_cache_device'] = APT_CACHE_DEVICE
+
+        if self._get_installed_image():
+            parms['packages'] = []
+            parms['clone_message'] = cloudinit.CLONE_START_MESSAGE
+
+        parts = [('cloud-init.cfg', template.load('cloud-init.cfg', parms))]
+
+        # Scripts are run in the order of their names, so the fast
+        # provisioning settings are gone before a golden image is captured.
+        if self.fast_provision:
+            parts.append(('00-fast-provision.sh',
+                          template.load('fast-provision.sh', {}),
+                          'text/x-shellscript'))
+
+        if self.golden_image and not self._use_golden_image():
+            parms = {
+                'message': cloudinit.GOLDEN_IMAGE_READY_MESSAGE,
+                'resume_file': GOLDEN_IMAGE_RESUME_FILE,
+            }
+            parts.append(('00-golden-image.sh',
+                          template.load('golden-image.sh', parms),
+                          'text/x-shellscript'))
+        elif self._get_installed_image():
+            parts.append(('00-reset-maas.sh',
+                          template.load('reset-maas.sh',
+                                        {'database': MAAS_DATABASE}),
+                          'text/x-shellscript'))
 
         # Generate the script file...
-        config_maas_script = os.path.join(self.working_dir, 'config-maas.sh')
         parms = {
             'user': self.user,
             'password': self.password,
             'node_group_ifaces': self.node_group_ifaces,
         }
-        content = template.load('config-maas.sh', parms)
-        with open(config_maas_script, 'w+') as f:
-            f.write(content)
-            f.flush()
+        parts.append(('config-maas.sh',
+                      template.load('config-maas.sh', parms),
+                      'text/x-shellscript'))
 
-        user_data_file = os.path.join(self.working_dir, 'user-data.txt')
-        cmd = ['write-mime-multipart', '--output={}'.format(user_data_file),
-               base_file, '{}:text/x-shellscript'.format(config_maas_script)]
-
-        cmd = cmd + self._get_user_supplied_files()
-        log.debug('Generating mime-multipart user data file using: %s',
-                  str(cmd))
-        execc(cmd)
-
-        return user_data_file
+        parts += self._get_user_supplied_files()
+        return parts
 
     def _get_user_supplied_files(self):
         """
-        Returns a list of the user supplied files to include in the cloud-init
-        user-data file.
+        Returns a list of the (filename, content) of the user supplied files
+        to include in the cloud-init user-data.
         """
         user_files = []
 
         if os.path.exists(USER_DATA_DIR) and \
            os.path.isdir(USER_DATA_DIR):
             try:
-                for f in os.listdir(USER_DATA_DIR):
+                for f in sorted(os.listdir(USER_DATA_DIR)):
                     src = os.path.join(USER_DATA_DIR, f)
                     # Do not include directories
                     if os.path.isdir(src):
                         continue
-                    dest = os.path.join(self.working_dir, 'user_data_%s' % f)
-                    shutil.copy(src, dest)
-                    user_files.append(dest)
-            except OSError as e:
-                log.error('Error copying user file: %s', str(e))
+                    with open(src, 'r') as fd:
+                        user_files.append(('user_data_%s' % f, fd.read()))
+            except (IOError, OSError) as e:
+                log.error('Error reading user file: %s', str(e))
                 raise e
 
         return user_files
@@ -522,61 +959,93 @@ class CloudInstance(Instance):
     def create_seed_image(self):
         """
         Creates the seed image fed into the cloud-init bootstrap.
+
+        The digest of the seed content is recorded in the image so that an
+        existing seed volume is only replaced when the content has changed.
         """
         log.debug("Creating cloud-init seed image for MAAS...")
-        storage_pool = self.conn.storagePoolLookupByName(self.pool)
         disk_parm = self._get_disk_param(image='{}-seed.img'.format(self.name),
                                          pool=self.pool, fmt='raw')
 
         seed_name = '%s-seed.img' % self.name
-        existing_vols = [v.name() for v in storage_pool.listAllVolumes()]
-        if seed_name in existing_vols:
-            log.info("Seed volume '%s' already exists", (seed_name))
-            if not cfg.force:
-                log.warning("Skipping create since force=False")
-                return disk_parm
-            else:
-                log.info("Deleting volume '%s' before create since force=True",
+        parts = self._generate_user_data_parts()
+        meta_data = self._generate_meta_data()
+        digest = seed.get_digest(parts, meta_data)
+        if seed_name in self._existing_vols:
+            if self._get_seed_digest(seed_name) == digest:
+                log.info("Seed volume '%s' is up to date - using it",
                          seed_name)
-                virsh(['vol-delete', '--pool', self.pool, seed_name])
+                return disk_parm
 
-        # Generate meta-data
-        meta_data_file = self._generate_meta_data_file()
+            log.info("Seed volume '%s' content has changed - replacing it",
+                     seed_name)
+            self._delete_volume(seed_name)
 
-        # Generate user-data files.
-        user_data_file = self._generate_user_data_file()
+        log.debug('Creating seed image from: %s',
+                  ', '.join(part[0] for part in parts))
+        # The MIME boundary is derived from the digest so that the same
+        # content always gives the same image.
+        user_data = seed.make_user_data(parts, boundary=digest)
+        image = seed.make_seed_image(user_data, meta_data, digest=digest)
 
-        log.debug('Creating local seed file')
-        img_path = os.path.join(self.working_dir, seed_name)
-        execc(['cloud-localds', img_path, user_data_file,
-               meta_data_file])
+        log.debug('Creating volume')
+        # Now create the volume and then upload the seed image into it
+        storage.create_volume(self.conn, self.pool, seed_name, len(image),
+                              'raw')
+        self.inventory.add_volume(self.pool, seed_name)
 
-        stat = os.stat(img_path)
+        log.debug('Uploading seed to volume...')
+        storage.upload_data(self.conn, self.pool, seed_name, image)
 
-        log.debug('Creating volume')
-        # Now create the volume locally and then upload the volume
-        virsh(['vol-create-as',
-               '--pool', self.pool,
-               '--name', seed_name,
-               '--capacity', str(stat.st_size),
-               '--format', 'raw'])
+        storage.refresh_pool(self.conn, self.pool)
+        return disk_parm
 
-        storage_pool.refresh()
+    def ensure_seed_image(self):
+        """
+        Creates the seed image, if that has not already been done.
 
-        log.debug('Uploading seed %s to volume...', img_path)
-        virsh(['vol-upload', '--pool', self.pool, '--file', img_path,
-               '--vol', seed_name])
+        :returns: the disk parameter of the seed volume
+        """
+        with self._seed_lock:
+            if not self._seed_disk_param:
+                self._seed_disk_param = self.create_seed_image()
 
-        storage_pool.refresh()
-        return disk_parm
+            return self._seed_disk_param
+
+    def prefetch(self, pool):
+        """
+        Starts creating the base volume and seed image in the background
+        using the worker pool.
+
+        :returns: the AsyncResults of the work started.
+        """
+        log.debug("Preparing volumes of '%s' in the background", self.name)
+        return [pool.apply_async(self.ensure_base_volume),
+                pool.apply_async(self.ensure_seed_image)]
+
+    def _get_seed_digest(self, seed_name):
+        """Returns the digest of the content of an existing seed volume."""
+        try:
+            pvd = storage.download_data(self.conn, self.pool, seed_name,
+                                        16 * seed.SECTOR_SIZE,
+                                        seed.SECTOR_SIZE)
+        except libvirt.libvirtError as e:
+            log.debug("Unable to read seed volume '%s': %s", seed_name, e)
+            return None
+
+        return seed.read_digest(pvd)
 
     def _get_disks(self):
         """
         Returns the disks used for cloud image booting.
         """
-        root_img = self.ensure_cloud_image()
-        seed_img = self.create_seed_image()
-        return [root_img, seed_img]
+        disks = [self.ensure_cloud_image(), self.ensure_seed_image()]
+        if self._use_apt_cache():
+            apt_cache = self.ensure_apt_cache_volume()
+            if apt_cache:
+                disks.append(apt_cache)
+
+        return disks
 
     def create(self):
         if self._domain_exists(self.name):
@@ -595,7 +1064,9 @@ class CloudInstance(Instance):
 
         try:
             log.debug("Creating domain '%s'", (self.name))
-            execc(self._get_virsh_command(extras=['--import']))
+            # The serial console is used to monitor the boot.
+            extras = ['--import', '--console', 'pty,target_type=serial']
+            execc(self._get_virsh_command(extras=extras))
         except CalledProcessError:
             log.error("Failed to create vm - cleaning up")
             # Cleanup (non-fatal since instance may not have been created)
@@ -603,5 +1074,131 @@ class CloudInstance(Instance):
             virsh(['undefine', self.name], fatal=False)
             raise
 
+        self._domain_added(self.name)
         if self.autostart:
             virsh(['autostart', self.name])
+
+
+class BakeInstance(CloudInstance):
+    """
+    A vm which boots the cloud image once to install the MAAS controller
+    packages and powers itself off, leaving its root volume to be stored as
+    the baked MAAS base image.
+    """
+
+    def __init__(self, params, autostart=False):
+        super(BakeInstance, self).__init__(params, autostart)
+        self.disk_size = params.get('bake_disk_size', BAKE_DISK_SIZE)
+        self.golden_image = False
+
+    def _get_installed_image(self):
+        # Always bake from the cloud image.
+        return None
+
+    def _generate_user_data_parts(self):
+        parms = {
+            'user': self.user,
+            'password': self.password,
+            'ssh_key': self._get_ssh_key(),
+            'apt_http_proxy': self.apt_http_proxy,
+            'apt_sources': self.apt_sources,
+            'packages': get_packages(self.arch, self.fast_provision),
+            'apt_cache_device': None,
+            'message': cloudinit.BAKE_SUCCEEDED_MESSAGE,
+        }
+        if self._use_apt_cache():
+            parms['apt_cache_device'] = APT_CACHE_DEVICE
+
+        return [('bake.cfg', template.load('bake.cfg', parms)),
+                ('bake-clean.sh', template.load('bake-clean.sh', parms),
+                 'text/x-shellscript')]
+
+    def _delete_bake_resources(self):
+        if self._domain_exists(self.name):
+            self._undefine_domain(self.name)
+
+        for name in ('%s-root.img' % self.name, '%s-seed.img' % self.name):
+            if name in self._existing_vols:
+                self._delete_volume(name)
+
+    def _store_image(self, src, name):
+        """
+        Stores the root volume src as the volume name. In a file based pool it
+        is converted with qemu-img on the hypervisor host, which leaves out
+        the free space zeroed by bake-clean.sh, otherwise it is cloned whole.
+        """
+        storage_pool = self.conn.storagePoolLookupByName(self.pool)
+        pool_type = etree.fromstring(storage_pool.XMLDesc(0)).get('type')
+        if pool_type in storage.FILE_POOL_TYPES:
+            path = storage_pool.storageVolLookupByName(src).path()
+            script = template.load('compact-volume.sh', {
+                'src': path,
+                'dst': os.path.join(os.path.dirname(path), name),
+            })
+            cmd = ['sh', '-s']
+            uri = self.conn.getURI()
+            if urlparse.urlparse(uri).netloc:
+                cmd = download.get_hypervisor_ssh_cmd(uri) + cmd
+
+            try:
+                execc(cmd, stdin=script)
+                return
+            except CalledProcessError as e:
+                log.warning("Unable to convert '%s' to '%s' - cloning it "
+                            "whole: %s", src, name, e)
+
+        virsh(['vol-clone', '--pool', self.pool, src, name])
+
+    def bake(self, timeout):
+        """
+        Bakes the MAAS base image, replacing an existing one only if force is
+        set. The image is only stored if the vm reports on its console that
+        the packages were installed.
+
+        :param timeout: number of seconds to wait for the packages to be
+                        installed and the vm to power off.
+        :returns: the name of the baked image volume
+        """
+        name = self.baked_image_volume
+        if name in self._existing_vols:
+            log.debug("Baked image '%s' already exists", name)
+            if cfg.use_existing:
+                log.debug("use_existing=True so skipping bake and using "
+                          "existing volume")
+                return name
+            elif cfg.force:
+                log.info("Deleting volume '%s' before bake since force=True",
+                         name)
+                self._delete_volume(name)
+            else:
+                raise MAASDeployerResourceAlreadyExists(resource=name,
+                                                        resource_type='volume')
+
+        start = time.time()
+        monitor = None
+        try:
+            self.create()
+            monitor = attach_console(self.name)
+            log.info("Baking '%s' - waiting for '%s' to install packages and "
+                     "power off", name, self.name)
+            events.wait_for_domain_stopped(self.conn, self.name, timeout)
+            if not monitor:
+                raise MAASDeployerBakeError(
+                    "Unable to check that '%s' installed the packages "
+                    "without its console" % (self.name))
+
+            if console.MARKER_BAKED not in monitor.seen:
+                raise MAASDeployerBakeError(
+                    "Baking '%s' failed - see %s" % (name, monitor.log_path))
+
+            self._store_image('{}-root.img'.format(self.name), name)
+            self.inventory.add_volume(self.pool, name)
+            storage.refresh_pool(self.conn, self.pool)
+        finally:
+            if monitor:
+                monitor.stop()
+
+            self._delete_bake_resources()
+
+        log.info("Baked image '%s' in %.1fs", name, time.time() - start)
+        return name